@@ -1,9 +1,10 @@
 import os
 import sys
+import click
 # DON'T CHANGE THIS !!!
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
-from flask import Flask, send_from_directory
+from flask import Flask, send_from_directory, jsonify
 from flask_cors import CORS
 from src.models.user import db
 from src.routes.user import user_bp
@@ -11,6 +12,15 @@ from src.routes.auth import auth_bp
 from src.routes.posts import posts_bp
 from src.routes.notes import notes_bp
 from src.routes.folders import folders_bp
+from src.routes.auth import token_required
+from src.services.cache import entity_cache
+from src.services import timeline
+from src.services.counter_buffer import counter_buffer
+from src.services.follow_graph import follow_graph
+from src.services.principals import principal_cache
+from src.services.password_hashing import password_hasher
+from src.services.counters import reconcile_user_counters
+from src.services import collab, collab_check, compression, migrations, note_search, query_plans, revisions, suggestions, tokens
 
 app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
 app.config['SECRET_KEY'] = 'asdf#FGSgvasgf$5$WGT'
@@ -19,18 +29,181 @@ app.config['SECRET_KEY'] = 'asdf#FGSgvasgf$5$WGT'
 CORS(app, origins=['*'])
 
 # Register blueprints
-app.register_blueprint(auth_bp, url_prefix='/api/auth')
-app.register_blueprint(user_bp, url_prefix='/api')
-app.register_blueprint(posts_bp, url_prefix='/api')
-app.register_blueprint(notes_bp, url_prefix='/api')
-app.register_blueprint(folders_bp, url_prefix='/api')
+BLUEPRINTS = [
+    (auth_bp, '/api/auth'),
+    (user_bp, '/api'),
+    (posts_bp, '/api'),
+    (notes_bp, '/api'),
+    (folders_bp, '/api'),
+]
+for blueprint, url_prefix in BLUEPRINTS:
+    app.register_blueprint(blueprint, url_prefix=url_prefix)
 
 # Database configuration
 app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(os.path.dirname(__file__), 'database', 'app.db')}"
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 db.init_app(app)
+
+# Engagement counters: set COUNTER_BUFFER_ENABLED to coalesce like/comment count
+# updates in memory and flush them in batches every COUNTER_BUFFER_FLUSH_INTERVAL seconds
+app.config['COUNTER_BUFFER_ENABLED'] = False
+app.config['COUNTER_BUFFER_FLUSH_INTERVAL'] = 0.5
+counter_buffer.init_app(app)
+
+# Follow graph: set FOLLOW_GRAPH_ENABLED to answer follow flags, mutual followers and
+# degrees from sorted in-memory arrays loaded at startup. With several worker
+# processes set FOLLOW_GRAPH_RELOAD_INTERVAL (seconds) so each picks up the others' writes.
+app.config['FOLLOW_GRAPH_ENABLED'] = False
+app.config['FOLLOW_GRAPH_RELOAD_INTERVAL'] = None
+
+# Entity cache for posts, profiles and notes: 'memory' (per-process LRU), 'sqlite'
+# (shared by all workers through CACHE_PATH) or 'none'
+app.config['CACHE_BACKEND'] = 'memory'
+app.config['CACHE_TTL'] = 300
+app.config['CACHE_MAX_ENTRIES'] = 10000
+entity_cache.init_app(app)
+
+# Users allowed to read /api/cache/stats (cache, follow graph, principal and
+# password hashing counters)
+app.config['ADMIN_USER_IDS'] = set()
+
+# Token lifetimes in seconds: access tokens are short-lived JWTs, refresh tokens
+# are stored server-side and rotated on every use
+app.config['ACCESS_TOKEN_TTL'] = 15 * 60
+app.config['REFRESH_TOKEN_TTL'] = 30 * 24 * 3600
+
+# Authenticated principals: verified tokens are cached for up to PRINCIPAL_CACHE_TTL
+# seconds (never past their expiry). Revocations reach every worker through the
+# entity cache backend, so with several workers use CACHE_BACKEND 'sqlite'; with
+# 'memory' they only reach the worker that made them, and with 'none' nothing is cached.
+app.config['PRINCIPAL_CACHE_ENABLED'] = True
+app.config['PRINCIPAL_CACHE_TTL'] = 60
+app.config['PRINCIPAL_CACHE_MAX_ENTRIES'] = 10000
+principal_cache.init_app(app)
+
+# Password hashing: PASSWORD_HASH_WORKERS processes hash passwords off the request
+# threads (0 hashes inline); beyond PASSWORD_HASH_MAX_QUEUE running or waiting hashes,
+# register and login answer 503 with Retry-After. Changing PASSWORD_HASH_METHOD
+# rehashes each user's password at their next login.
+app.config['PASSWORD_HASH_METHOD'] = 'scrypt'
+app.config['PASSWORD_HASH_WORKERS'] = 2
+app.config['PASSWORD_HASH_MAX_QUEUE'] = 8
+app.config['PASSWORD_HASH_TIMEOUT'] = 30
+app.config['PASSWORD_HASH_RETRY_AFTER'] = 1
+password_hasher.init_app(app)
+
+# Create new tables and apply pending schema migrations to existing databases
 with app.app_context():
-    db.create_all()
+    migrations.upgrade()
+
+# Loaded after migrations so the follow table is in its current shape
+follow_graph.init_app(app)
+
+@app.cli.command('db-upgrade')
+def db_upgrade():
+    # Buffered counter deltas are written before migrations rewrite post rows
+    counter_buffer.drain()
+    ran = migrations.upgrade()
+    for version, name in ran:
+        print(f'Applied migration {version}: {name}')
+    print(f'{len(ran)} migrations applied')
+
+@app.cli.command('db-status')
+def db_status():
+    for version, name, applied in migrations.status():
+        print(f"{version:>4}  {'applied' if applied else 'pending'}  {name}")
+
+@app.cli.command('check-query-plans')
+def check_query_plans():
+    # Exercise every GET route on a scratch database and fail on full table scans
+    # or on routes that answer with an unexpected status
+    plans, violations, failures = query_plans.check(BLUEPRINTS)
+    for route, detail, statement in violations:
+        print(f'{route}: {detail}\n    {statement}')
+    for route, status in failures:
+        print(f'{route}: answered {status}')
+    print(f'Checked {len(plans)} plan steps, {len(violations)} full scans of large tables, '
+          f'{len(failures)} unexpected statuses')
+    if violations or failures:
+        sys.exit(1)
+
+@app.cli.command('check-collab-convergence')
+@click.option('--runs', default=20, help='Number of random runs, one seed each')
+@click.option('--editors', default=3, help='Simulated editors per run')
+@click.option('--steps', default=200, help='Random edits, sends and deliveries per run')
+@click.option('--seed', default=0, help='First seed; failures print theirs so they can be replayed')
+def check_collab_convergence(runs, editors, steps, seed):
+    # Drive the ops routes with simulated editors on a scratch database and fail
+    # unless every editor ends up with the stored document
+    results = collab_check.check(BLUEPRINTS, runs, editors, steps, seed)
+    failures = [error for _, _, error in results if error]
+    for error in failures:
+        print(error)
+    batches = sum(version for _, version, _ in results if version)
+    print(f'Ran {len(results)} simulations ({batches} batches), {len(failures)} diverged')
+    if failures:
+        sys.exit(1)
+
+@app.cli.command('rebuild-timelines')
+def rebuild_timelines():
+    # Backfill the materialized home timelines from existing posts and follows
+    count = timeline.rebuild_all()
+    print(f'Rebuilt timelines with {count} feed entries')
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters():
+    # Recompute denormalized follower/following/post counters from the source tables
+    repaired = reconcile_user_counters()
+    print(f'Reconciled counters, {repaired} users repaired')
+
+@app.cli.command('rebuild-suggestions')
+def rebuild_suggestions():
+    # Recompute every user's "people you may know" list from the follow graph
+    count = suggestions.rebuild_all()
+    print(f'Rebuilt suggestions, {count} stored')
+
+@app.cli.command('prune-refresh-tokens')
+def prune_refresh_tokens():
+    # Drop expired refresh tokens; revoked ones stay until expiry for reuse detection
+    count = tokens.prune_expired()
+    print(f'Pruned {count} expired refresh tokens')
+
+@app.cli.command('compact-revisions')
+def compact_revisions():
+    # Thin out old note revisions: daily after a week, weekly after three months
+    notes, removed = revisions.compact()
+    print(f'Compacted {notes} notes, {removed} revisions removed')
+
+@app.cli.command('compact-note-ops')
+def compact_note_ops():
+    # Reindex and snapshot notes edited collaboratively, and trim their op logs
+    count = collab.compact_all()
+    print(f'Compacted op logs of {count} notes')
+
+@app.cli.command('compress-notes')
+def compress_notes():
+    # Pack large note content, blocks and revisions written before compression
+    total_before = total_after = 0
+    for table, (rows, before, after) in compression.compress_all().items():
+        print(f'{table}: {rows} rows compressed, {before} -> {after} bytes')
+        total_before += before
+        total_after += after
+    print(f'Saved {total_before - total_after} bytes; run VACUUM to return the space to the filesystem')
+    if not note_search.fts5_supported():
+        print('Warning: SQLite lacks FTS5, and the LIKE search fallback cannot match compressed note bodies')
+
+@app.route('/api/cache/stats', methods=['GET'])
+@token_required
+def cache_stats(current_user):
+    # Operational counters are for the accounts listed in ADMIN_USER_IDS only
+    if current_user.id not in app.config['ADMIN_USER_IDS']:
+        return jsonify({'message': 'Admin access required'}), 403
+    return jsonify({
+        'cache': entity_cache.stats(),
+        'follow_graph': follow_graph.stats(),
+        'principals': principal_cache.stats(),
+        'password_hashing': password_hasher.stats()
+    }), 200
 
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
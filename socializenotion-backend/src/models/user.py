@@ -1,9 +1,21 @@
+import json
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy.orm import validates
+from src.services.compression import pack, unpack
+from src.services.counter_buffer import counter_buffer
+from src.services.follow_graph import follow_graph
+from src.services.password_hashing import password_hasher
 
 db = SQLAlchemy()
 
+
+def pick(fields, values):
+    # Builds a to_dict result from {key: getter}, calling only the getters for keys the
+    # fieldset wants so unrequested columns are never loaded
+    return {key: get() for key, get in values.items() if fields is None or fields.wants(key)}
+
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
@@ -11,6 +23,14 @@ class User(db.Model):
     password_hash = db.Column(db.String(255), nullable=False)
     profile_picture_url = db.Column(db.String(255), nullable=True)
     bio = db.Column(db.Text, nullable=True)
+    # Denormalized counters, kept in step by follow/unfollow and post create/delete
+    followers_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    following_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    posts_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Stamped into issued tokens; bumping it revokes every token issued before
+    token_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # When UserSuggestion rows were last recomputed for this user, even if none were found
+    suggestions_refreshed_at = db.Column(db.DateTime, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -28,47 +48,73 @@ class User(db.Model):
     
     # Collaboration relationships
     collaborations = db.relationship('Collaboration', backref='collaborator', lazy=True, cascade='all, delete-orphan')
+    folder_grants = db.relationship('FolderGrant', backref='grantee', lazy=True, cascade='all, delete-orphan')
+    refresh_tokens = db.relationship('RefreshToken', backref='user', lazy=True, cascade='all, delete-orphan')
+
+    # Covers the most-followed-first walk autocomplete uses for short prefixes
+    __table_args__ = (db.Index('ix_user_followers_username', 'followers_count', 'username'),)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        # Both hash in the password worker pool and may raise PasswordHasherBusy
+        self.password_hash = password_hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.verify(self.password_hash, password)
 
     def follow(self, user):
         if not self.is_following(user):
             follow = Follow(follower_id=self.id, following_id=user.id)
             db.session.add(follow)
+            User.adjust_counter(self.id, User.following_count, 1)
+            User.adjust_counter(user.id, User.followers_count, 1)
+            follow_graph.record(db.session, self.id, user.id, True)
 
     def unfollow(self, user):
         follow = Follow.query.filter_by(follower_id=self.id, following_id=user.id).first()
         if follow:
             db.session.delete(follow)
+            User.adjust_counter(self.id, User.following_count, -1)
+            User.adjust_counter(user.id, User.followers_count, -1)
+            follow_graph.record(db.session, self.id, user.id, False)
 
     def is_following(self, user):
         return Follow.query.filter_by(follower_id=self.id, following_id=user.id).first() is not None
 
     def get_follower_count(self):
-        return self.followers.count()
+        return self.followers_count or 0
 
     def get_following_count(self):
-        return self.following.count()
+        return self.following_count or 0
+
+    @staticmethod
+    def adjust_counter(user_id, column, delta):
+        # Single UPDATE ... SET col = max(col + delta, 0), so concurrent writers never lose
+        # updates. updated_at is pinned so counter churn doesn't look like a profile edit.
+        User.query.filter_by(id=user_id).update({
+            column: db.func.max(column + delta, 0),
+            User.updated_at: User.updated_at
+        })
 
     def __repr__(self):
         return f'<User {self.username}>'
 
-    def to_dict(self):
-        return {
+    def to_dict(self, include_email=False):
+        # Email is private: only the user's own record (auth responses, own profile)
+        # includes it; authors, search results and user lists never do
+        user_dict = {
             'id': self.id,
             'username': self.username,
-            'email': self.email,
             'profile_picture_url': self.profile_picture_url,
             'bio': self.bio,
             'follower_count': self.get_follower_count(),
             'following_count': self.get_following_count(),
+            'posts_count': self.posts_count or 0,
             'created_at': self.created_at.isoformat() if self.created_at else None,
             'updated_at': self.updated_at.isoformat() if self.updated_at else None
         }
+        if include_email:
+            user_dict['email'] = self.email
+        return user_dict
 
 
 class Post(db.Model):
@@ -79,6 +125,8 @@ class Post(db.Model):
     caption = db.Column(db.Text, nullable=True)
     likes_count = db.Column(db.Integer, default=0)
     comments_count = db.Column(db.Integer, default=0)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')  # Bumped by every ORM update, for ETags
+    fanned_out = db.Column(db.Boolean, nullable=False, default=True, server_default='1')  # False: pulled into timelines on read
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -86,50 +134,226 @@ class Post(db.Model):
     likes = db.relationship('Like', backref='post', lazy=True, cascade='all, delete-orphan')
     comments = db.relationship('Comment', backref='post', lazy=True, cascade='all, delete-orphan')
 
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'user_id': self.user_id,
-            'author': self.author.to_dict() if self.author else None,
-            'content_type': self.content_type,
-            'media_url': self.media_url,
-            'caption': self.caption,
-            'likes_count': self.likes_count,
-            'comments_count': self.comments_count,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'updated_at': self.updated_at.isoformat() if self.updated_at else None
-        }
+    __table_args__ = (
+        db.Index('ix_post_user_created', 'user_id', 'created_at'),
+        # Only the posts timelines pull on read, so probing it per followee stays cheap
+        db.Index('ix_post_pulled', 'user_id', 'created_at', sqlite_where=db.text('fanned_out = 0')),
+    )
+    # Updates check the version they loaded, so a concurrent edit fails instead of
+    # being overwritten. Counter updates bypass this on purpose.
+    __mapper_args__ = {'version_id_col': version}
+
+    @staticmethod
+    def adjust_counter(post_id, column, delta):
+        # Atomic server-side increment, or staged in the write-behind buffer when enabled
+        if counter_buffer.enabled:
+            counter_buffer.record(db.session, post_id, column.key, delta)
+        else:
+            Post.query.filter_by(id=post_id).update({
+                column: db.func.max(column + delta, 0),
+                Post.updated_at: Post.updated_at
+            })
+
+    def get_likes_count(self):
+        if counter_buffer.enabled:
+            return counter_buffer.value(self.id, 'likes_count', self.likes_count or 0)
+        return self.likes_count or 0
+
+    def get_comments_count(self):
+        if counter_buffer.enabled:
+            return counter_buffer.value(self.id, 'comments_count', self.comments_count or 0)
+        return self.comments_count or 0
+
+    # Attributes behind to_dict keys that aren't a column of the same name
+    field_sources = {'author': ('user_id', 'author')}
+
+    def to_dict(self, include_author=True, fields=None):
+        post_dict = pick(fields, {
+            'id': lambda: self.id,
+            'user_id': lambda: self.user_id,
+            'content_type': lambda: self.content_type,
+            'media_url': lambda: self.media_url,
+            'caption': lambda: self.caption,
+            'likes_count': self.get_likes_count,
+            'comments_count': self.get_comments_count,
+            'created_at': lambda: self.created_at.isoformat() if self.created_at else None,
+            'updated_at': lambda: self.updated_at.isoformat() if self.updated_at else None
+        })
+        if include_author and (fields is None or fields.wants('author')):
+            post_dict['author'] = self.author.to_dict() if self.author else None
+        return post_dict
 
 
 class Note(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     title = db.Column(db.String(255), nullable=False)
-    content = db.Column(db.Text, nullable=True)  # JSON string for rich text blocks
+    content = db.Column(db.Text, nullable=True)  # Plain content, packed when large; NULL when stored as NoteBlock rows
+    content_format = db.Column(db.String(10), nullable=False, default='text', server_default='text')  # 'text' or 'blocks'
+    block_shape = db.Column(db.String(10), nullable=True)  # 'list' or 'object': how the client sent its block document
+    op_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # Last NoteOp batch applied
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')  # Bumped by every write, for ETags
     folder_id = db.Column(db.Integer, db.ForeignKey('folder.id'), nullable=True)
-    tags = db.Column(db.String(500), nullable=True)  # Comma-separated tags
+    tags = db.Column(db.String(500), nullable=True)  # Comma-separated copy of the NoteTag rows, for display
     is_public = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     # Relationships
     collaborations = db.relationship('Collaboration', backref='note', lazy=True, cascade='all, delete-orphan')
+    tag_links = db.relationship('NoteTag', backref='note', lazy=True, cascade='all, delete-orphan')
+    blocks = db.relationship('NoteBlock', backref='note', lazy=True, cascade='all, delete-orphan',
+                             order_by='NoteBlock.position')
+    revisions = db.relationship('NoteRevision', backref='note', lazy=True, cascade='all, delete-orphan')
+    ops = db.relationship('NoteOp', backref='note', lazy=True, cascade='all, delete-orphan')
+
+    __table_args__ = (
+        db.Index('ix_note_user_updated', 'user_id', 'updated_at'),
+        db.Index('ix_note_folder_updated', 'folder_id', 'updated_at'),
+    )
+    __mapper_args__ = {'version_id_col': version}
+
+    # Attributes behind to_dict keys that aren't a column of the same name
+    field_sources = {'content': ('content', 'content_format', 'block_shape', 'blocks'), 'author': ('user_id', 'author')}
+
+    def to_dict(self, include_author=True, fields=None):
+        note_dict = pick(fields, {
+            'id': lambda: self.id,
+            'user_id': lambda: self.user_id,
+            'title': lambda: self.title,
+            'content': self.get_content,
+            'content_format': lambda: self.content_format,
+            'op_version': lambda: self.op_version,
+            'folder_id': lambda: self.folder_id,
+            'tags': lambda: self.tags.split(',') if self.tags else [],
+            'is_public': lambda: self.is_public,
+            'created_at': lambda: self.created_at.isoformat() if self.created_at else None,
+            'updated_at': lambda: self.updated_at.isoformat() if self.updated_at else None
+        })
+        if include_author and (fields is None or fields.wants('author')):
+            note_dict['author'] = self.author.to_dict() if self.author else None
+        return note_dict
+
+    @validates('content')
+    def pack_content(self, key, value):
+        return pack(value)
+
+    def get_content(self):
+        # Block-format notes are assembled from their NoteBlock rows, in the shape the
+        # client sent them and without the ids the server generated
+        if self.content_format != 'blocks':
+            return unpack(self.content)
+        document = [block.to_document() for block in self.blocks]
+        return json.dumps(document if self.block_shape == 'list' else {'blocks': document})
+
+
+class NoteBlock(db.Model):
+    note_id = db.Column(db.Integer, db.ForeignKey('note.id'), primary_key=True)
+    block_id = db.Column(db.String(64), primary_key=True)  # Stable id chosen by the client or generated
+    position = db.Column(db.String(64), nullable=False)  # Fractional ordering key, compared bytewise
+    data = db.Column(db.Text, nullable=False)  # JSON of the block without its id, packed when large
+    generated_id = db.Column(db.Boolean, nullable=False, default=False, server_default='0')  # Client sent no id
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (db.Index('ix_note_block_note_position', 'note_id', 'position'),)
+
+    @validates('data')
+    def pack_data(self, key, value):
+        return pack(value)
+
+    def get_data(self):
+        return unpack(self.data)
+
+    def to_dict(self):
+        block = {'id': self.block_id}
+        block.update(json.loads(self.get_data()))
+        return block
+
+    def to_document(self):
+        # The block as it appears in the note's content
+        if self.generated_id:
+            return json.loads(self.get_data())
+        return self.to_dict()
+
+
+class NoteRevision(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    note_id = db.Column(db.Integer, db.ForeignKey('note.id'), nullable=False)
+    number = db.Column(db.Integer, nullable=False)  # Per-note sequence; gaps appear after compaction
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)  # Who saved it
+    title = db.Column(db.String(255), nullable=False)
+    kind = db.Column(db.String(10), nullable=False)  # 'snapshot' or 'delta'
+    data = db.Column(db.Text, nullable=True)  # Full content, or JSON edits against the previous revision; packed when large
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)  # Last autosave folded into this revision
+
+    __table_args__ = (db.UniqueConstraint('note_id', 'number', name='unique_note_revision'),)
+
+    @validates('data')
+    def pack_data(self, key, value):
+        return pack(value)
+
+    def get_data(self):
+        return unpack(self.data)
 
     def to_dict(self):
         return {
             'id': self.id,
+            'note_id': self.note_id,
+            'number': self.number,
             'user_id': self.user_id,
-            'author': self.author.to_dict() if self.author else None,
             'title': self.title,
-            'content': self.content,
-            'folder_id': self.folder_id,
-            'tags': self.tags.split(',') if self.tags else [],
-            'is_public': self.is_public,
             'created_at': self.created_at.isoformat() if self.created_at else None,
             'updated_at': self.updated_at.isoformat() if self.updated_at else None
         }
 
 
+class NoteOp(db.Model):
+    # One batch of collaborative edits, in the form the server applied it
+    id = db.Column(db.Integer, primary_key=True)
+    note_id = db.Column(db.Integer, db.ForeignKey('note.id'), nullable=False)
+    version = db.Column(db.Integer, nullable=False)  # Note.op_version after this batch
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    client_id = db.Column(db.String(64), nullable=True)  # Editor session that sent it
+    ops = db.Column(db.Text, nullable=False)  # JSON list of ops
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (db.UniqueConstraint('note_id', 'version', name='unique_note_op_version'),)
+
+    def to_dict(self):
+        return {
+            'version': self.version,
+            'user_id': self.user_id,
+            'client_id': self.client_id,
+            'ops': json.loads(self.ops),
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
+
+class Tag(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)  # Owner of the tagged notes
+    name = db.Column(db.String(100), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (db.UniqueConstraint('user_id', 'name', name='unique_user_tag'),)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'name': self.name,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
+
+class NoteTag(db.Model):
+    note_id = db.Column(db.Integer, db.ForeignKey('note.id'), primary_key=True)
+    tag_id = db.Column(db.Integer, db.ForeignKey('tag.id'), primary_key=True)
+
+    __table_args__ = (db.Index('ix_note_tag_tag_note', 'tag_id', 'note_id'),)
+
+
 class Folder(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -140,6 +364,12 @@ class Folder(db.Model):
     # Relationships
     notes = db.relationship('Note', backref='folder', lazy=True)
     subfolders = db.relationship('Folder', backref=db.backref('parent', remote_side=[id]), lazy=True)
+    grants = db.relationship('FolderGrant', backref='folder', lazy=True, cascade='all, delete-orphan')
+
+    __table_args__ = (
+        db.Index('ix_folder_parent', 'parent_folder_id'),
+        db.Index('ix_folder_user_parent_name', 'user_id', 'parent_folder_id', 'name'),
+    )
 
     def to_dict(self):
         return {
@@ -151,24 +381,66 @@ class Folder(db.Model):
         }
 
 
-class Collaboration(db.Model):
+class FolderClosure(db.Model):
+    # Every (ancestor, descendant) pair of the folder hierarchy, including each
+    # folder paired with itself at depth 0; maintained by services/folders.py
+    ancestor_id = db.Column(db.Integer, db.ForeignKey('folder.id'), primary_key=True)
+    descendant_id = db.Column(db.Integer, db.ForeignKey('folder.id'), primary_key=True)
+    depth = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (db.Index('ix_folder_closure_descendant', 'descendant_id', 'depth', 'ancestor_id'),)
+
+
+class FolderGrant(db.Model):
+    # Shares a folder and every note below it, at any depth
     id = db.Column(db.Integer, primary_key=True)
-    note_id = db.Column(db.Integer, db.ForeignKey('note.id'), nullable=False)
+    folder_id = db.Column(db.Integer, db.ForeignKey('folder.id'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     permission_level = db.Column(db.String(20), nullable=False)  # 'view', 'edit', 'admin'
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.UniqueConstraint('folder_id', 'user_id', name='unique_folder_grant'),
+        db.Index('ix_folder_grant_user_folder', 'user_id', 'folder_id'),
+    )
+
     def to_dict(self):
         return {
             'id': self.id,
-            'note_id': self.note_id,
+            'folder_id': self.folder_id,
             'user_id': self.user_id,
-            'collaborator': self.collaborator.to_dict() if self.collaborator else None,
+            'collaborator': self.grantee.to_dict() if self.grantee else None,
             'permission_level': self.permission_level,
             'created_at': self.created_at.isoformat() if self.created_at else None
         }
 
 
+class Collaboration(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    note_id = db.Column(db.Integer, db.ForeignKey('note.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    permission_level = db.Column(db.String(20), nullable=False)  # 'view', 'edit', 'admin'
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_collaboration_user_note', 'user_id', 'note_id'),
+        db.Index('ix_collaboration_note_user', 'note_id', 'user_id'),
+    )
+
+    # Attributes behind to_dict keys that aren't a column of the same name
+    field_sources = {'collaborator': ('user_id', 'collaborator')}
+
+    def to_dict(self, fields=None):
+        return pick(fields, {
+            'id': lambda: self.id,
+            'note_id': lambda: self.note_id,
+            'user_id': lambda: self.user_id,
+            'collaborator': lambda: self.collaborator.to_dict() if self.collaborator else None,
+            'permission_level': lambda: self.permission_level,
+            'created_at': lambda: self.created_at.isoformat() if self.created_at else None
+        })
+
+
 class Like(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -191,17 +463,35 @@ class Comment(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
     content = db.Column(db.Text, nullable=False)
+    # Threading: root_id is the top-level comment of the thread and path is the
+    # concatenation of fixed-width ids from the root, so a subtree is one range scan
+    parent_id = db.Column(db.Integer, db.ForeignKey('comment.id'), nullable=True)
+    root_id = db.Column(db.Integer, nullable=True)
+    path = db.Column(db.String(255), nullable=True)
+    depth = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    reply_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'user_id': self.user_id,
-            'post_id': self.post_id,
-            'author': self.author.to_dict() if self.author else None,
-            'content': self.content,
-            'created_at': self.created_at.isoformat() if self.created_at else None
-        }
+    __table_args__ = (
+        db.Index('ix_comment_post_created', 'post_id', 'created_at'),
+        db.Index('ix_comment_root_path', 'root_id', 'path'),
+    )
+
+    # Attributes behind to_dict keys that aren't a column of the same name
+    field_sources = {'author': ('user_id', 'author')}
+
+    def to_dict(self, fields=None):
+        return pick(fields, {
+            'id': lambda: self.id,
+            'user_id': lambda: self.user_id,
+            'post_id': lambda: self.post_id,
+            'parent_id': lambda: self.parent_id,
+            'depth': lambda: self.depth or 0,
+            'reply_count': lambda: self.reply_count or 0,
+            'author': lambda: self.author.to_dict() if self.author else None,
+            'content': lambda: self.content,
+            'created_at': lambda: self.created_at.isoformat() if self.created_at else None
+        })
 
 
 class Follow(db.Model):
@@ -210,7 +500,10 @@ class Follow(db.Model):
     following_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
-    __table_args__ = (db.UniqueConstraint('follower_id', 'following_id', name='unique_follow'),)
+    __table_args__ = (
+        db.UniqueConstraint('follower_id', 'following_id', name='unique_follow'),
+        db.Index('ix_follow_following_created', 'following_id', 'created_at'),
+    )
 
     def to_dict(self):
         return {
@@ -229,6 +522,10 @@ class Notification(db.Model):
     is_read = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_notification_user_read_created', 'user_id', 'is_read', 'created_at'),
+    )
+
     def to_dict(self):
         return {
             'id': self.id,
@@ -238,3 +535,65 @@ class Notification(db.Model):
             'is_read': self.is_read,
             'created_at': self.created_at.isoformat() if self.created_at else None
         }
+
+
+class FeedEntry(db.Model):
+    # Materialized home timeline: one row per (viewer, post), filled on write
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)  # Timeline owner
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
+    author_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)  # Copied from the post for range scans
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'post_id', name='unique_feed_entry'),
+        db.Index('ix_feed_entry_user_created', 'user_id', 'created_at', 'post_id'),
+        db.Index('ix_feed_entry_user_author', 'user_id', 'author_id'),
+        db.Index('ix_feed_entry_post', 'post_id'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'post_id': self.post_id,
+            'author_id': self.author_id,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
+
+class UserSuggestion(db.Model):
+    # Precomputed "people you may know": the best-scored candidates per user, filled
+    # in batch and adjusted when follows change
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    suggested_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    score = db.Column(db.Float, nullable=False)
+    mutual_count = db.Column(db.Integer, nullable=False, default=0)  # Followees who follow them
+    shared_notes_count = db.Column(db.Integer, nullable=False, default=0)  # Notes both work on
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    suggested = db.relationship('User', foreign_keys=[suggested_id])
+
+    __table_args__ = (
+        db.Index('ix_user_suggestion_user_score', 'user_id', 'score', 'suggested_id'),
+        db.Index('ix_user_suggestion_suggested', 'suggested_id', 'user_id'),
+    )
+
+
+class RefreshToken(db.Model):
+    # Server-side refresh tokens, kept as SHA-256 digests. A login starts a family
+    # (one signed-in session); each refresh revokes the presented token and issues
+    # its successor in the same family, and access tokens name their family as `sid`
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    family_id = db.Column(db.String(32), nullable=False)
+    token_hash = db.Column(db.String(64), unique=True, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    revoked_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_refresh_token_family_revoked', 'family_id', 'revoked_at'),
+        db.Index('ix_refresh_token_user_revoked', 'user_id', 'revoked_at'),
+        db.Index('ix_refresh_token_expires', 'expires_at'),
+    )
@@ -1,14 +1,15 @@
 from flask import Blueprint, request, jsonify, session
 from src.models.user import db, User
+from src.services import cache, tokens, user_search
+from src.services.cache import entity_cache
+from src.services.principals import Principal, principal_cache
+from src.services.password_hashing import PasswordHasherBusy, password_hasher
+from src.services.tokens import InvalidRefreshToken
 import jwt
-import datetime
 from functools import wraps
 
 auth_bp = Blueprint('auth', __name__)
 
-# JWT secret key (in production, use environment variable)
-JWT_SECRET = 'your-secret-key-here'
-
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -16,13 +17,29 @@ def token_required(f):
         if not token:
             return jsonify({'message': 'Token is missing'}), 401
         
+        if token.startswith('Bearer '):
+            token = token[7:]
+        
+        # Cached principals skip the signature check and the user lookup; the full
+        # User row is loaded only if the handler reads more than the id
+        current_user = principal_cache.get(token)
+        if current_user is not None:
+            return f(current_user, *args, **kwargs)
+        
         try:
-            if token.startswith('Bearer '):
-                token = token[7:]
-            data = jwt.decode(token, JWT_SECRET, algorithms=['HS256'])
-            current_user = User.query.get(data['user_id'])
-            if not current_user:
+            data = tokens.decode(token)
+            session_id = data.get('sid')
+            # Read before the check, so a revocation committed after it is still seen
+            stamp = principal_cache.stamp(data['user_id'])
+            row = db.session.query(User.id, User.username, User.token_version,
+                                   tokens.session_active(session_id).label('active'))\
+                            .filter(User.id == data['user_id']).first()
+            if not row:
                 return jsonify({'message': 'User not found'}), 401
+            if data.get('ver', 0) != row.token_version or not row.active:
+                return jsonify({'message': 'Token has been revoked'}), 401
+            current_user = Principal(row.id, row.username, row.token_version, session_id)
+            principal_cache.put(token, current_user, data.get('exp'), stamp)
         except jwt.ExpiredSignatureError:
             return jsonify({'message': 'Token has expired'}), 401
         except jwt.InvalidTokenError:
@@ -31,6 +48,11 @@ def token_required(f):
         return f(current_user, *args, **kwargs)
     return decorated
 
+def hasher_busy(e):
+    response = jsonify({'message': str(e)})
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 503
+
 @auth_bp.route('/register', methods=['POST'])
 def register():
     try:
@@ -55,20 +77,20 @@ def register():
         user.set_password(data['password'])
         
         db.session.add(user)
+        db.session.flush()
+        user_search.index_user(user)
+        session_tokens = tokens.start_session(user)
         db.session.commit()
         
-        # Generate JWT token
-        token = jwt.encode({
-            'user_id': user.id,
-            'exp': datetime.datetime.utcnow() + datetime.timedelta(days=30)
-        }, JWT_SECRET, algorithm='HS256')
-        
         return jsonify({
             'message': 'User created successfully',
-            'token': token,
-            'user': user.to_dict()
+            **session_tokens,
+            'user': user.to_dict(include_email=True)
         }), 201
         
+    except PasswordHasherBusy as e:
+        db.session.rollback()
+        return hasher_busy(e)
     except Exception as e:
         db.session.rollback()
         return jsonify({'message': f'Error creating user: {str(e)}'}), 500
@@ -89,66 +111,161 @@ def login():
         if not user or not user.check_password(data['password']):
             return jsonify({'message': 'Invalid credentials'}), 401
         
-        # Generate JWT token
-        token = jwt.encode({
-            'user_id': user.id,
-            'exp': datetime.datetime.utcnow() + datetime.timedelta(days=30)
-        }, JWT_SECRET, algorithm='HS256')
+        # Upgrade hashes made with old parameters while the password is at hand
+        if password_hasher.needs_rehash(user.password_hash):
+            user.set_password(data['password'])
+        
+        session_tokens = tokens.start_session(user)
+        db.session.commit()
         
         return jsonify({
             'message': 'Login successful',
-            'token': token,
-            'user': user.to_dict()
+            **session_tokens,
+            'user': user.to_dict(include_email=True)
         }), 200
         
+    except PasswordHasherBusy as e:
+        db.session.rollback()
+        return hasher_busy(e)
     except Exception as e:
+        db.session.rollback()
         return jsonify({'message': f'Error during login: {str(e)}'}), 500
 
+@auth_bp.route('/refresh', methods=['POST'])
+def refresh():
+    try:
+        data = request.get_json() or {}
+        
+        if not data.get('refresh_token'):
+            return jsonify({'message': 'Missing refresh token'}), 400
+        
+        user, session_tokens = tokens.rotate(data['refresh_token'])
+        db.session.commit()
+        
+        return jsonify(session_tokens), 200
+        
+    except InvalidRefreshToken as e:
+        # Commit, since reusing a rotated token revokes its whole session
+        db.session.commit()
+        if e.revoked_user_id:
+            principal_cache.invalidate(e.revoked_user_id)
+        return jsonify({'message': str(e)}), 401
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'message': f'Error refreshing token: {str(e)}'}), 500
+
 @auth_bp.route('/profile', methods=['GET'])
 @token_required
 def get_profile(current_user):
-    return jsonify({'user': current_user.to_dict()}), 200
+    user_dict = cache.user_dict(current_user.id)
+    user_dict['email'] = current_user.email
+    return jsonify({'user': user_dict}), 200
 
 @auth_bp.route('/profile', methods=['PUT'])
 @token_required
 def update_profile(current_user):
     try:
         data = request.get_json()
+        user = current_user.user
         
         if data.get('username'):
             # Check if username is already taken by another user
             existing_user = User.query.filter_by(username=data['username']).first()
             if existing_user and existing_user.id != current_user.id:
                 return jsonify({'message': 'Username already exists'}), 400
-            current_user.username = data['username']
+            user.username = data['username']
         
         if data.get('email'):
             # Check if email is already taken by another user
             existing_user = User.query.filter_by(email=data['email']).first()
             if existing_user and existing_user.id != current_user.id:
                 return jsonify({'message': 'Email already exists'}), 400
-            current_user.email = data['email']
+            user.email = data['email']
         
         if data.get('bio') is not None:
-            current_user.bio = data['bio']
+            user.bio = data['bio']
         
         if data.get('profile_picture_url'):
-            current_user.profile_picture_url = data['profile_picture_url']
+            user.profile_picture_url = data['profile_picture_url']
         
+        if data.get('username') or data.get('bio') is not None:
+            user_search.index_user(user)
         db.session.commit()
+        entity_cache.invalidate('user', current_user.id)
         
         return jsonify({
             'message': 'Profile updated successfully',
-            'user': current_user.to_dict()
+            'user': user.to_dict(include_email=True)
         }), 200
         
     except Exception as e:
         db.session.rollback()
         return jsonify({'message': f'Error updating profile: {str(e)}'}), 500
 
-@auth_bp.route('/logout', methods=['POST'])
+@auth_bp.route('/password', methods=['PUT'])
 @token_required
-def logout(current_user):
-    # With JWT, logout is handled client-side by removing the token
-    return jsonify({'message': 'Logout successful'}), 200
+def change_password(current_user):
+    try:
+        data = request.get_json()
+        
+        if not data or not data.get('current_password') or not data.get('new_password'):
+            return jsonify({'message': 'Missing current or new password'}), 400
+        
+        user = current_user.user
+        if not user.check_password(data['current_password']):
+            return jsonify({'message': 'Current password is incorrect'}), 401
+        
+        # Sign out every session, then start a fresh one for this client
+        user.set_password(data['new_password'])
+        tokens.revoke_all(user)
+        session_tokens = tokens.start_session(user)
+        db.session.commit()
+        
+        return jsonify({'message': 'Password changed successfully', **session_tokens}), 200
+        
+    except PasswordHasherBusy as e:
+        db.session.rollback()
+        return hasher_busy(e)
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'message': f'Error changing password: {str(e)}'}), 500
+
+@auth_bp.route('/logout', methods=['POST'])
+def logout():
+    data = request.get_json(silent=True) or {}
+    
+    # The refresh token alone signs its session out, so a client whose access token
+    # has expired can still end the session instead of leaving it valid for 30 days
+    if data.get('refresh_token'):
+        return logout_by_refresh_token(data)
+    return logout_by_access_token(data)
+
+def logout_by_refresh_token(data):
+    try:
+        user_id = tokens.sign_out(data['refresh_token'], all_sessions=bool(data.get('all')))
+        db.session.commit()
+        if user_id:
+            principal_cache.invalidate(user_id)
+        
+        return jsonify({'message': 'Logout successful'}), 200
+        
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'message': f'Error logging out: {str(e)}'}), 500
 
+@token_required
+def logout_by_access_token(current_user, data):
+    try:
+        # `all` signs out every session of the user, otherwise just this one
+        if data.get('all'):
+            tokens.revoke_all(current_user.user)
+        elif current_user.session_id:
+            tokens.revoke_session(current_user.id, current_user.session_id)
+        db.session.commit()
+        principal_cache.invalidate(current_user.id)
+        
+        return jsonify({'message': 'Logout successful'}), 200
+        
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'message': f'Error logging out: {str(e)}'}), 500
@@ -1,6 +1,8 @@
 from flask import Blueprint, request, jsonify
-from src.models.user import db, Folder
+from src.models.user import db, Folder, FolderGrant, User
 from src.routes.auth import token_required
+from src.services import folders as folder_tree, permissions
+from src.services.cache import entity_cache
 from sqlalchemy import desc
 
 folders_bp = Blueprint('folders', __name__)
@@ -60,6 +62,8 @@ def create_folder(current_user):
         )
         
         db.session.add(folder)
+        db.session.flush()
+        folder_tree.add_folder(folder)
         db.session.commit()
         
         return jsonify({
@@ -83,8 +87,12 @@ def get_folder(current_user, folder_id):
         folder_dict = folder.to_dict()
         
         # Add subfolders and notes count
-        folder_dict['subfolders_count'] = len(folder.subfolders)
-        folder_dict['notes_count'] = len(folder.notes)
+        folder_dict['subfolders_count'], folder_dict['notes_count'] = folder_tree.folder_counts(folder_id)
+        
+        # Breadcrumb from the root folder down to this one
+        folder_dict['path'] = [
+            {'id': ancestor.id, 'name': ancestor.name} for ancestor in folder_tree.path(folder_id)
+        ]
         
         return jsonify({'folder': folder_dict}), 200
         
@@ -127,18 +135,12 @@ def update_folder(current_user, folder_id):
                     return jsonify({'message': 'Folder cannot be its own parent'}), 400
                 
                 # Check if the new parent is a descendant of this folder
-                def is_descendant(parent_id, ancestor_id):
-                    if parent_id == ancestor_id:
-                        return True
-                    parent = Folder.query.get(parent_id)
-                    if parent and parent.parent_folder_id:
-                        return is_descendant(parent.parent_folder_id, ancestor_id)
-                    return False
-                
-                if is_descendant(data['parent_folder_id'], folder_id):
+                if folder_tree.is_within(data['parent_folder_id'], folder_id):
                     return jsonify({'message': 'Cannot move folder to its own descendant'}), 400
             
-            folder.parent_folder_id = data['parent_folder_id']
+            # Moves the whole subtree in the closure table
+            if (data['parent_folder_id'] or None) != folder.parent_folder_id:
+                folder_tree.move(folder, data['parent_folder_id'])
         
         db.session.commit()
         
@@ -160,14 +162,19 @@ def delete_folder(current_user, folder_id):
         if folder.user_id != current_user.id:
             return jsonify({'message': 'Access denied'}), 403
         
-        # Check if folder has subfolders or notes
-        if folder.subfolders or folder.notes:
+        # Non-empty folders are only deleted with recursive=1, along with everything in them
+        recursive = request.args.get('recursive', type=int) == 1
+        if not recursive and any(folder_tree.folder_counts(folder_id)):
             return jsonify({'message': 'Cannot delete folder that contains subfolders or notes'}), 400
         
-        db.session.delete(folder)
+        deleted_notes = folder_tree.delete_subtree(folder_id)
         db.session.commit()
+        entity_cache.invalidate('note', *deleted_notes)
         
-        return jsonify({'message': 'Folder deleted successfully'}), 200
+        return jsonify({
+            'message': 'Folder deleted successfully',
+            'deleted_notes': len(deleted_notes)
+        }), 200
         
     except Exception as e:
         db.session.rollback()
@@ -177,24 +184,102 @@ def delete_folder(current_user, folder_id):
 @token_required
 def get_folder_tree(current_user):
     try:
-        # Get all folders for the user
-        folders = Folder.query.filter_by(user_id=current_user.id).order_by(Folder.name).all()
-        
-        # Build tree structure
-        def build_tree(parent_id=None):
-            tree = []
-            for folder in folders:
-                if folder.parent_folder_id == parent_id:
-                    folder_dict = folder.to_dict()
-                    folder_dict['children'] = build_tree(folder.id)
-                    folder_dict['notes_count'] = len(folder.notes)
-                    tree.append(folder_dict)
-            return tree
-        
-        tree = build_tree()
+        # depth=N returns only the top N levels, e.g. depth=1 for a collapsed sidebar
+        depth = request.args.get('depth', type=int)
+        if depth is not None and depth < 1:
+            return jsonify({'message': 'depth must be at least 1'}), 400
+        
+        tree = folder_tree.build_tree(current_user.id, max_depth=depth)
         
         return jsonify({'folder_tree': tree}), 200
         
     except Exception as e:
         return jsonify({'message': f'Error building folder tree: {str(e)}'}), 500
 
+@folders_bp.route('/folders/<int:folder_id>/collaborate', methods=['POST'])
+@token_required
+def add_folder_collaborator(current_user, folder_id):
+    try:
+        folder = Folder.query.get_or_404(folder_id)
+        
+        # Only owner can share a folder
+        if folder.user_id != current_user.id:
+            return jsonify({'message': 'Only owner can add collaborators'}), 403
+        
+        data = request.get_json()
+        
+        if not data or not data.get('username') or not data.get('permission_level'):
+            return jsonify({'message': 'Username and permission level are required'}), 400
+        
+        collaborator = User.query.filter_by(username=data['username']).first()
+        if not collaborator:
+            return jsonify({'message': 'User not found'}), 404
+        
+        if collaborator.id == current_user.id:
+            return jsonify({'message': 'Cannot collaborate with yourself'}), 400
+        
+        if data['permission_level'] not in permissions.GRANT_LEVELS:
+            return jsonify({'message': 'Invalid permission level'}), 400
+        
+        # Sharing again changes the level; the grant covers every note below the folder
+        grant = FolderGrant.query.filter_by(folder_id=folder_id, user_id=collaborator.id).first()
+        if grant:
+            grant.permission_level = data['permission_level']
+        else:
+            grant = FolderGrant(
+                folder_id=folder_id,
+                user_id=collaborator.id,
+                permission_level=data['permission_level']
+            )
+            db.session.add(grant)
+        db.session.commit()
+        
+        return jsonify({
+            'message': 'Collaborator added successfully',
+            'grant': grant.to_dict()
+        }), 201
+        
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'message': f'Error adding collaborator: {str(e)}'}), 500
+
+@folders_bp.route('/folders/<int:folder_id>/collaborators', methods=['GET'])
+@token_required
+def get_folder_collaborators(current_user, folder_id):
+    try:
+        Folder.query.get_or_404(folder_id)
+        
+        if permissions.folder_level(current_user.id, folder_id) is None:
+            return jsonify({'message': 'Access denied'}), 403
+        
+        # Includes grants inherited from parent folders; folder_id tells them apart
+        grants = permissions.folder_grants(folder_id)
+        
+        return jsonify({
+            'collaborators': [grant.to_dict() for grant in grants]
+        }), 200
+        
+    except Exception as e:
+        return jsonify({'message': f'Error fetching collaborators: {str(e)}'}), 500
+
+@folders_bp.route('/folders/<int:folder_id>/collaborators/<int:user_id>', methods=['DELETE'])
+@token_required
+def remove_folder_collaborator(current_user, folder_id, user_id):
+    try:
+        folder = Folder.query.get_or_404(folder_id)
+        
+        if folder.user_id != current_user.id:
+            return jsonify({'message': 'Only owner can remove collaborators'}), 403
+        
+        grant = FolderGrant.query.filter_by(folder_id=folder_id, user_id=user_id).first()
+        if not grant:
+            return jsonify({'message': 'User is not a collaborator'}), 404
+        
+        db.session.delete(grant)
+        db.session.commit()
+        
+        return jsonify({'message': 'Collaborator removed successfully'}), 200
+        
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'message': f'Error removing collaborator: {str(e)}'}), 500
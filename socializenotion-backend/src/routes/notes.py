@@ -1,7 +1,15 @@
 from flask import Blueprint, request, jsonify
-from src.models.user import db, Note, Folder, Collaboration, User
+from src.models.user import db, Note, NoteBlock, NoteRevision, Folder, Collaboration, User
 from src.routes.auth import token_required
-from sqlalchemy import desc, or_
+from src.services import blocks, cache, collab, etags, note_search, permissions, revisions, tags
+from src.services import folders as folder_tree
+from src.services.blocks import InvalidBlockOp
+from src.services.collab import StaleVersion
+from src.services.fields import Fieldset
+from src.services.cache import entity_cache
+from src.services.pagination import paginate, InvalidCursor
+from sqlalchemy import and_, func, or_
+from sqlalchemy.orm.exc import StaleDataError
 
 notes_bp = Blueprint('notes', __name__)
 
@@ -9,55 +17,80 @@ notes_bp = Blueprint('notes', __name__)
 @token_required
 def get_notes(current_user):
     try:
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 20, type=int)
         folder_id = request.args.get('folder_id', type=int)
-        tag = request.args.get('tag')
+        tag_names = tags.normalize(request.args.get('tags') or request.args.get('tag'))
+        tag_mode = request.args.get('tag_mode', 'all')
         search = request.args.get('search')
         
-        # Base query for user's notes and shared notes
+        # Base query for user's notes and notes shared with them, directly or by folder
         query = Note.query.filter(
             or_(
                 Note.user_id == current_user.id,
-                Note.id.in_(
-                    db.session.query(Collaboration.note_id)
-                    .filter_by(user_id=current_user.id)
-                )
+                Note.id.in_(permissions.shared_note_ids(current_user.id))
             )
         )
         
-        # Filter by folder
-        if folder_id:
+        # Filter by folder; recursive=1 includes every folder below it
+        if folder_id and request.args.get('recursive', type=int) == 1:
+            query = query.filter(Note.folder_id.in_(folder_tree.subtree_ids(folder_id)))
+        elif folder_id:
             query = query.filter_by(folder_id=folder_id)
         
-        # Filter by tag
-        if tag:
-            query = query.filter(Note.tags.contains(tag))
-        
-        # Search in title and content
-        if search:
+        # Filter by tags (tag_mode=all needs every tag, tag_mode=any needs one)
+        if tag_names:
+            query = tags.filter_notes(query, current_user.id, tag_names, tag_mode)
+        
+        # Full-text search ranks by bm25 instead of recency
+        order_by = (Note.updated_at, Note.id)
+        if search and note_search.fts5_supported():
+            matches = note_search.matches(search)
+            if matches is None:
+                query = query.filter(db.false())
+            else:
+                query = query.join(matches, matches.c.note_id == Note.id)
+                order_by = (-matches.c.rank, Note.id)
+        elif search:
+            # Without FTS5, LIKE only sees bodies stored as text: content and block data
+            # compressed at rest (see services/compression.py) match on the title alone
             query = query.filter(
                 or_(
                     Note.title.contains(search),
-                    Note.content.contains(search)
+                    and_(func.typeof(Note.content) == 'text', Note.content.contains(search)),
+                    Note.id.in_(
+                        db.session.query(NoteBlock.note_id)
+                        .filter(func.typeof(NoteBlock.data) == 'text', NoteBlock.data.contains(search))
+                    )
                 )
             )
         
-        notes = query.order_by(desc(Note.updated_at))\
-                    .paginate(page=page, per_page=per_page, error_out=False)
-        
-        return jsonify({
-            'notes': [note.to_dict() for note in notes.items],
-            'pagination': {
-                'page': notes.page,
-                'pages': notes.pages,
-                'per_page': notes.per_page,
-                'total': notes.total,
-                'has_next': notes.has_next,
-                'has_prev': notes.has_prev
-            }
-        }), 200
-        
+        # Collection ETag from one aggregate, so unchanged lists aren't rebuilt
+        tag = etags.notes_tag('notes', query, current_user.id)
+        not_modified = etags.not_modified(tag)
+        if not_modified:
+            return not_modified
+        
+        # Only the columns behind the requested fields are read
+        fields = Fieldset.from_request()
+        notes = paginate(query.options(*fields.load_options(Note)), order_by)
+        
+        notes_data = [note.to_dict(fields=fields) for note in notes.items]
+        if fields.wants('user_permission'):
+            # One query resolves the caller's level on the whole page
+            levels = permissions.levels(current_user.id, [note.id for note in notes.items])
+            for note_dict in notes_data:
+                note_dict['user_permission'] = levels.get(note_dict['id'])
+        if search and note_search.fts5_supported() and fields.wants('snippet'):
+            snippets = note_search.snippets(search, [note.id for note in notes.items])
+            for note_dict in notes_data:
+                note_dict['snippet'] = snippets.get(note_dict['id'])
+        
+        return etags.tagged(jsonify({
+            'notes': notes_data,
+            'pagination': notes.pagination
+        }), tag), 200
+        
+    except InvalidCursor as e:
+        return jsonify({'message': str(e)}), 400
     except Exception as e:
         return jsonify({'message': f'Error fetching notes: {str(e)}'}), 500
 
@@ -79,13 +112,19 @@ def create_note(current_user):
         note = Note(
             user_id=current_user.id,
             title=data['title'],
-            content=data.get('content', ''),
             folder_id=data.get('folder_id'),
-            tags=','.join(data.get('tags', [])) if data.get('tags') else None,
             is_public=data.get('is_public', False)
         )
         
+        if data.get('content_format') not in (None, 'text', 'blocks'):
+            return jsonify({'message': "content_format must be 'text' or 'blocks'"}), 400
+        
         db.session.add(note)
+        db.session.flush()
+        blocks.set_content(note, data.get('content', ''), data.get('content_format'))
+        tags.set_note_tags(note, data.get('tags'))
+        note_search.index_note(note)
+        revisions.record(note, current_user.id)
         db.session.commit()
         
         return jsonify({
@@ -93,6 +132,9 @@ def create_note(current_user):
             'note': note.to_dict()
         }), 201
         
+    except InvalidBlockOp as e:
+        db.session.rollback()
+        return jsonify({'message': str(e)}), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({'message': f'Error creating note: {str(e)}'}), 500
@@ -101,30 +143,26 @@ def create_note(current_user):
 @token_required
 def get_note(current_user, note_id):
     try:
-        note = Note.query.get_or_404(note_id)
-        
-        # Check if user has access to this note
-        has_access = (
-            note.user_id == current_user.id or
-            note.is_public or
-            Collaboration.query.filter_by(note_id=note_id, user_id=current_user.id).first()
-        )
-        
-        if not has_access:
+        # Owner, collaborator, folder grant or public, resolved in one query
+        level = permissions.level(current_user.id, note_id)
+        if level is None:
+            if not db.session.query(Note.id).filter(Note.id == note_id).first():
+                return jsonify({'message': 'Note not found'}), 404
             return jsonify({'message': 'Access denied'}), 403
         
-        note_dict = note.to_dict()
+        # Answer polling clients from the version columns before loading the note
+        tag = etags.note_tag(note_id, level)
+        not_modified = etags.not_modified(tag)
+        if not_modified:
+            return not_modified
         
-        # Add collaboration info if user is a collaborator
-        collaboration = Collaboration.query.filter_by(note_id=note_id, user_id=current_user.id).first()
-        if collaboration:
-            note_dict['user_permission'] = collaboration.permission_level
-        elif note.user_id == current_user.id:
-            note_dict['user_permission'] = 'admin'
-        else:
-            note_dict['user_permission'] = 'view'
+        note_dict = cache.note_dict(note_id)
+        if note_dict is None:
+            return jsonify({'message': 'Note not found'}), 404
         
-        return jsonify({'note': note_dict}), 200
+        note_dict['user_permission'] = level
+        
+        return etags.tagged(jsonify({'note': Fieldset.from_request().filter(note_dict)}), tag), 200
         
     except Exception as e:
         return jsonify({'message': f'Error fetching note: {str(e)}'}), 500
@@ -136,25 +174,29 @@ def update_note(current_user, note_id):
         note = Note.query.get_or_404(note_id)
         
         # Check if user has edit permission
-        collaboration = Collaboration.query.filter_by(note_id=note_id, user_id=current_user.id).first()
-        has_edit_permission = (
-            note.user_id == current_user.id or
-            (collaboration and collaboration.permission_level in ['edit', 'admin'])
-        )
-        
-        if not has_edit_permission:
+        level = permissions.level(current_user.id, note_id)
+        if not permissions.at_least(level, 'edit'):
             return jsonify({'message': 'No edit permission'}), 403
         
+        # If-Match: refuse to overwrite a version the client hasn't seen
+        if etags.if_match_failed(etags.state('note', note.id, note.version)):
+            return jsonify({'message': 'Note was changed by someone else', 'version': note.version}), 412
+        
         data = request.get_json()
         
         if data.get('title'):
             note.title = data['title']
         
+        if data.get('content_format') not in (None, 'text', 'blocks'):
+            return jsonify({'message': "content_format must be 'text' or 'blocks'"}), 400
+        
         if data.get('content') is not None:
-            note.content = data['content']
+            # Block documents are diffed so only changed blocks are written
+            blocks.set_content(note, data['content'], data.get('content_format'))
+            collab.reset(note, current_user.id)
         
         if data.get('tags') is not None:
-            note.tags = ','.join(data['tags']) if data['tags'] else None
+            tags.set_note_tags(note, data['tags'])
         
         # Only owner can change folder and public status
         if note.user_id == current_user.id:
@@ -168,17 +210,245 @@ def update_note(current_user, note_id):
             if data.get('is_public') is not None:
                 note.is_public = data['is_public']
         
+        if data.get('title') or data.get('content') is not None:
+            note_search.index_note(note)
+            revisions.record(note, current_user.id)
+        
         db.session.commit()
+        entity_cache.invalidate('note', note_id)
+        collab.notify()
         
-        return jsonify({
+        response = jsonify({
             'message': 'Note updated successfully',
             'note': note.to_dict()
+        })
+        return etags.tagged(response, etags.note_tag(note_id, level)), 200
+        
+    except StaleDataError:
+        # Another write committed between our read and our update
+        db.session.rollback()
+        return jsonify({'message': 'Note was changed by someone else'}), 412
+    except InvalidBlockOp as e:
+        db.session.rollback()
+        return jsonify({'message': str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'message': f'Error updating note: {str(e)}'}), 500
+
+@notes_bp.route('/notes/<int:note_id>/blocks', methods=['GET'])
+@token_required
+def get_note_blocks(current_user, note_id):
+    try:
+        note = Note.query.get_or_404(note_id)
+        
+        # Check if user has access to this note
+        if permissions.level(current_user.id, note_id) is None:
+            return jsonify({'message': 'Access denied'}), 403
+        
+        # A range of blocks in document order, starting after block `after`
+        note_blocks, has_more = blocks.load_range(
+            note,
+            after=request.args.get('after'),
+            limit=request.args.get('limit', blocks.DEFAULT_RANGE_LIMIT, type=int)
+        )
+        
+        return jsonify({
+            'blocks': note_blocks,
+            'has_more': has_more,
+            'next_after': note_blocks[-1]['id'] if has_more else None,
+            'op_version': note.op_version
         }), 200
         
+    except InvalidBlockOp as e:
+        return jsonify({'message': str(e)}), 400
+    except Exception as e:
+        return jsonify({'message': f'Error fetching blocks: {str(e)}'}), 500
+
+@notes_bp.route('/notes/<int:note_id>/blocks', methods=['PATCH'])
+@token_required
+def patch_note_blocks(current_user, note_id):
+    try:
+        note = Note.query.get_or_404(note_id)
+        
+        # Check if user has edit permission
+        if not permissions.at_least(permissions.level(current_user.id, note_id), 'edit'):
+            return jsonify({'message': 'No edit permission'}), 403
+        
+        data = request.get_json()
+        
+        if not data or 'ops' not in data:
+            return jsonify({'message': 'ops are required'}), 400
+        
+        touched = blocks.apply_ops(note, data['ops'])
+        note_search.index_note(note)
+        revisions.record(note, current_user.id)
+        collab.reset(note, current_user.id)
+        db.session.commit()
+        entity_cache.invalidate('note', note_id)
+        collab.notify()
+        
+        # Only the blocks this request wrote are sent back
+        touched_blocks = NoteBlock.query.filter(
+            NoteBlock.note_id == note_id,
+            NoteBlock.block_id.in_(touched)
+        ).order_by(NoteBlock.position).all() if touched else []
+        
+        return jsonify({
+            'message': 'Note updated successfully',
+            'blocks': [dict(block.to_dict(), position=block.position) for block in touched_blocks],
+            'updated_at': note.updated_at.isoformat()
+        }), 200
+        
+    except InvalidBlockOp as e:
+        db.session.rollback()
+        return jsonify({'message': str(e)}), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({'message': f'Error updating note: {str(e)}'}), 500
 
+@notes_bp.route('/notes/<int:note_id>/ops', methods=['POST'])
+@token_required
+def submit_note_ops(current_user, note_id):
+    try:
+        note = Note.query.get_or_404(note_id)
+        
+        # Check if user has edit permission
+        if not permissions.at_least(permissions.level(current_user.id, note_id), 'edit'):
+            return jsonify({'message': 'No edit permission'}), 403
+        
+        data = request.get_json()
+        
+        if not data or not data.get('client_id') or 'version' not in data or 'ops' not in data:
+            return jsonify({'message': 'client_id, version and ops are required'}), 400
+        
+        entry = collab.submit(note, current_user.id, str(data['client_id'])[:64], data['version'], data['ops'])
+        db.session.commit()
+        entity_cache.invalidate('note', note_id)
+        collab.notify()
+        
+        return jsonify({'entry': entry.to_dict()}), 200
+        
+    except StaleVersion:
+        db.session.rollback()
+        return jsonify({
+            'message': 'Note changed since this version; reload it',
+            'version': db.session.query(Note.op_version).filter(Note.id == note_id).scalar()
+        }), 409
+    except InvalidBlockOp as e:
+        db.session.rollback()
+        return jsonify({'message': str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'message': f'Error applying ops: {str(e)}'}), 500
+
+@notes_bp.route('/notes/<int:note_id>/ops', methods=['GET'])
+@token_required
+def get_note_ops(current_user, note_id):
+    try:
+        note = Note.query.get_or_404(note_id)
+        
+        # Check if user has access to this note
+        if permissions.level(current_user.id, note_id) is None:
+            return jsonify({'message': 'Access denied'}), 403
+        
+        since = request.args.get('since', type=int)
+        if since is None:
+            return jsonify({'message': 'since is required'}), 400
+        
+        # Long-poll: waits up to `wait` seconds when there is nothing new yet
+        version, entries = collab.entries_since(note_id, since, request.args.get('wait', 0, type=float))
+        
+        return jsonify({
+            'version': version,
+            'entries': [entry.to_dict() for entry in entries]
+        }), 200
+        
+    except StaleVersion:
+        return jsonify({
+            'message': 'Version is no longer in the log; reload the note',
+            'version': db.session.query(Note.op_version).filter(Note.id == note_id).scalar()
+        }), 409
+    except Exception as e:
+        return jsonify({'message': f'Error fetching ops: {str(e)}'}), 500
+
+@notes_bp.route('/notes/<int:note_id>/revisions', methods=['GET'])
+@token_required
+def get_note_revisions(current_user, note_id):
+    try:
+        note = Note.query.get_or_404(note_id)
+        
+        # Check if user has access to this note
+        if permissions.level(current_user.id, note_id) is None:
+            return jsonify({'message': 'Access denied'}), 403
+        
+        note_revisions = paginate(NoteRevision.query.filter_by(note_id=note_id),
+                                  (NoteRevision.number, NoteRevision.id))
+        
+        return jsonify({
+            'revisions': [revision.to_dict() for revision in note_revisions.items],
+            'pagination': note_revisions.pagination
+        }), 200
+        
+    except InvalidCursor as e:
+        return jsonify({'message': str(e)}), 400
+    except Exception as e:
+        return jsonify({'message': f'Error fetching revisions: {str(e)}'}), 500
+
+@notes_bp.route('/notes/<int:note_id>/revisions/<int:number>', methods=['GET'])
+@token_required
+def get_note_revision(current_user, note_id, number):
+    try:
+        note = Note.query.get_or_404(note_id)
+        
+        # Check if user has access to this note
+        if permissions.level(current_user.id, note_id) is None:
+            return jsonify({'message': 'Access denied'}), 403
+        
+        revision = NoteRevision.query.filter_by(note_id=note_id, number=number).first()
+        if not revision:
+            return jsonify({'message': 'Revision not found'}), 404
+        
+        revision_dict = revision.to_dict()
+        revision_dict['content'] = revisions.content_at(revision)
+        
+        return jsonify({'revision': revision_dict}), 200
+        
+    except Exception as e:
+        return jsonify({'message': f'Error fetching revision: {str(e)}'}), 500
+
+@notes_bp.route('/notes/<int:note_id>/revisions/<int:number>/restore', methods=['POST'])
+@token_required
+def restore_note_revision(current_user, note_id, number):
+    try:
+        note = Note.query.get_or_404(note_id)
+        
+        # Check if user has edit permission
+        if not permissions.at_least(permissions.level(current_user.id, note_id), 'edit'):
+            return jsonify({'message': 'No edit permission'}), 403
+        
+        revision = NoteRevision.query.filter_by(note_id=note_id, number=number).first()
+        if not revision:
+            return jsonify({'message': 'Revision not found'}), 404
+        
+        note.title = revision.title
+        blocks.set_content(note, revisions.content_at(revision))
+        note_search.index_note(note)
+        # A restore is always its own revision so it can be undone
+        revisions.record(note, current_user.id, force_new=True)
+        collab.reset(note, current_user.id)
+        db.session.commit()
+        entity_cache.invalidate('note', note_id)
+        collab.notify()
+        
+        return jsonify({
+            'message': 'Note restored successfully',
+            'note': note.to_dict()
+        }), 200
+        
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'message': f'Error restoring note: {str(e)}'}), 500
+
 @notes_bp.route('/notes/<int:note_id>', methods=['DELETE'])
 @token_required
 def delete_note(current_user, note_id):
@@ -189,8 +459,10 @@ def delete_note(current_user, note_id):
         if note.user_id != current_user.id:
             return jsonify({'message': 'Only owner can delete note'}), 403
         
+        note_search.remove_note(note_id)
         db.session.delete(note)
         db.session.commit()
+        entity_cache.invalidate('note', note_id)
         
         return jsonify({'message': 'Note deleted successfully'}), 200
         
@@ -238,6 +510,7 @@ def add_collaborator(current_user, note_id):
         
         db.session.add(collaboration)
         db.session.commit()
+        entity_cache.invalidate('note', note_id)
         
         return jsonify({
             'message': 'Collaborator added successfully',
@@ -254,64 +527,51 @@ def get_collaborators(current_user, note_id):
     try:
         note = Note.query.get_or_404(note_id)
         
-        # Check if user has access to this note
-        has_access = (
-            note.user_id == current_user.id or
-            Collaboration.query.filter_by(note_id=note_id, user_id=current_user.id).first()
-        )
-        
-        if not has_access:
+        # Public readers don't see who a note is shared with
+        if not permissions.at_least(permissions.level(current_user.id, note_id), 'view'):
             return jsonify({'message': 'Access denied'}), 403
         
-        collaborations = Collaboration.query.filter_by(note_id=note_id).all()
+        fields = Fieldset.from_request()
+        collaborations = Collaboration.query.filter_by(note_id=note_id)\
+                                            .options(*fields.load_options(Collaboration)).all()
         
         return jsonify({
-            'collaborators': [collab.to_dict() for collab in collaborations]
+            'collaborators': [collaboration.to_dict(fields=fields) for collaboration in collaborations]
         }), 200
         
     except Exception as e:
         return jsonify({'message': f'Error fetching collaborators: {str(e)}'}), 500
 
+@notes_bp.route('/notes/tags', methods=['GET'])
+@token_required
+def get_tag_facets(current_user):
+    try:
+        return jsonify({'tags': tags.facets(current_user.id)}), 200
+        
+    except Exception as e:
+        return jsonify({'message': f'Error fetching tags: {str(e)}'}), 500
+
 @notes_bp.route('/notes/shared', methods=['GET'])
 @token_required
 def get_shared_notes(current_user):
     try:
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 20, type=int)
-        
-        # Get notes where user is a collaborator
-        collaborations = Collaboration.query.filter_by(user_id=current_user.id).all()
-        note_ids = [collab.note_id for collab in collaborations]
-        
-        if not note_ids:
-            return jsonify({
-                'notes': [],
-                'pagination': {
-                    'page': 1,
-                    'pages': 0,
-                    'per_page': per_page,
-                    'total': 0,
-                    'has_next': False,
-                    'has_prev': False
-                }
-            }), 200
-        
-        notes = Note.query.filter(Note.id.in_(note_ids))\
-                         .order_by(desc(Note.updated_at))\
-                         .paginate(page=page, per_page=per_page, error_out=False)
-        
-        return jsonify({
-            'notes': [note.to_dict() for note in notes.items],
-            'pagination': {
-                'page': notes.page,
-                'pages': notes.pages,
-                'per_page': notes.per_page,
-                'total': notes.total,
-                'has_next': notes.has_next,
-                'has_prev': notes.has_prev
-            }
-        }), 200
-        
+        # Get notes shared with the user, directly or through a folder
+        query = Note.query.filter(Note.id.in_(permissions.shared_note_ids(current_user.id)))
+        tag = etags.collection_tag('shared-notes', query, Note)
+        not_modified = etags.not_modified(tag)
+        if not_modified:
+            return not_modified
+        
+        fields = Fieldset.from_request()
+        notes = paginate(query.options(*fields.load_options(Note)), (Note.updated_at, Note.id))
+        
+        return etags.tagged(jsonify({
+            'notes': [note.to_dict(fields=fields) for note in notes.items],
+            'pagination': notes.pagination
+        }), tag), 200
+        
+    except InvalidCursor as e:
+        return jsonify({'message': str(e)}), 400
     except Exception as e:
         return jsonify({'message': f'Error fetching shared notes: {str(e)}'}), 500
 
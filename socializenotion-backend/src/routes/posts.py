@@ -1,7 +1,12 @@
 from flask import Blueprint, request, jsonify
 from src.models.user import db, Post, Like, Comment, User, Follow
 from src.routes.auth import token_required
-from sqlalchemy import desc
+from src.services import cache, etags, threads, timeline
+from src.services.cache import entity_cache
+from src.services.fields import Fieldset
+from src.services.pagination import paginate, InvalidCursor
+from src.services.viewer import ViewerContext
+from sqlalchemy.orm.exc import StaleDataError
 
 posts_bp = Blueprint('posts', __name__)
 
@@ -9,37 +14,25 @@ posts_bp = Blueprint('posts', __name__)
 @token_required
 def get_feed(current_user):
     try:
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 10, type=int)
+        # Read the materialized timeline (own posts and followed users' posts)
+        query, order_by = timeline.timeline_query(current_user)
         
-        # Get posts from followed users and own posts
-        following_ids = [f.following_id for f in current_user.following.all()]
-        following_ids.append(current_user.id)  # Include own posts
+        # Covers counters, buffered deltas and the viewer's likes as well as the posts
+        tag = etags.feed_tag(query, current_user.id)
+        not_modified = etags.not_modified(tag)
+        if not_modified:
+            return not_modified
         
-        posts = Post.query.filter(Post.user_id.in_(following_ids))\
-                         .order_by(desc(Post.created_at))\
-                         .paginate(page=page, per_page=per_page, error_out=False)
+        fields = Fieldset.from_request()
+        posts = paginate(query.options(*fields.load_options(Post)), order_by, per_page=10)
         
-        posts_data = []
-        for post in posts.items:
-            post_dict = post.to_dict()
-            # Check if current user liked this post
-            liked = Like.query.filter_by(user_id=current_user.id, post_id=post.id).first() is not None
-            post_dict['liked_by_user'] = liked
-            posts_data.append(post_dict)
-        
-        return jsonify({
-            'posts': posts_data,
-            'pagination': {
-                'page': posts.page,
-                'pages': posts.pages,
-                'per_page': posts.per_page,
-                'total': posts.total,
-                'has_next': posts.has_next,
-                'has_prev': posts.has_prev
-            }
-        }), 200
+        return etags.tagged(jsonify({
+            'posts': ViewerContext(current_user.id).post_dicts(posts.items, fields),
+            'pagination': posts.pagination
+        }), tag), 200
         
+    except InvalidCursor as e:
+        return jsonify({'message': str(e)}), 400
     except Exception as e:
         return jsonify({'message': f'Error fetching feed: {str(e)}'}), 500
 
@@ -56,11 +49,19 @@ def create_post(current_user):
             user_id=current_user.id,
             content_type=data['content_type'],
             media_url=data.get('media_url'),
-            caption=data.get('caption', '')
+            caption=data.get('caption', ''),
+            # Decided once, so the post stays reachable if the author crosses the limit later
+            fanned_out=not timeline.is_high_fanout(current_user.id)
         )
         
         db.session.add(post)
+        db.session.flush()
+        User.adjust_counter(current_user.id, User.posts_count, 1)
+        
+        # Push the post into followers' timelines
+        timeline.fan_out_post(post)
         db.session.commit()
+        entity_cache.invalidate('user', current_user.id)
         
         return jsonify({
             'message': 'Post created successfully',
@@ -75,14 +76,24 @@ def create_post(current_user):
 @token_required
 def get_post(current_user, post_id):
     try:
-        post = Post.query.get_or_404(post_id)
-        post_dict = post.to_dict()
-        
         # Check if current user liked this post
-        liked = Like.query.filter_by(user_id=current_user.id, post_id=post.id).first() is not None
+        liked = post_id in ViewerContext(current_user.id).liked_post_ids([post_id])
+        
+        # Answer polling clients from the version and counter columns before loading the post
+        tag = etags.post_tag(post_id, liked)
+        if tag is None:
+            return jsonify({'message': 'Post not found'}), 404
+        not_modified = etags.not_modified(tag)
+        if not_modified:
+            return not_modified
+        
+        post_dict = cache.post_dict(post_id)
+        if post_dict is None:
+            return jsonify({'message': 'Post not found'}), 404
+        
         post_dict['liked_by_user'] = liked
         
-        return jsonify({'post': post_dict}), 200
+        return etags.tagged(jsonify({'post': Fieldset.from_request().filter(post_dict)}), tag), 200
         
     except Exception as e:
         return jsonify({'message': f'Error fetching post: {str(e)}'}), 500
@@ -96,6 +107,10 @@ def update_post(current_user, post_id):
         if post.user_id != current_user.id:
             return jsonify({'message': 'Unauthorized to edit this post'}), 403
         
+        # If-Match: refuse to overwrite a version the client hasn't seen
+        if etags.if_match_failed(etags.state('post', post.id, post.version)):
+            return jsonify({'message': 'Post was changed elsewhere', 'version': post.version}), 412
+        
         data = request.get_json()
         
         if data.get('caption') is not None:
@@ -105,12 +120,19 @@ def update_post(current_user, post_id):
             post.media_url = data['media_url']
         
         db.session.commit()
+        entity_cache.invalidate('post', post_id)
         
-        return jsonify({
+        response = jsonify({
             'message': 'Post updated successfully',
             'post': post.to_dict()
-        }), 200
+        })
+        liked = post_id in ViewerContext(current_user.id).liked_post_ids([post_id])
+        return etags.tagged(response, etags.post_tag(post_id, liked)), 200
         
+    except StaleDataError:
+        # Another write committed between our read and our update
+        db.session.rollback()
+        return jsonify({'message': 'Post was changed elsewhere'}), 412
     except Exception as e:
         db.session.rollback()
         return jsonify({'message': f'Error updating post: {str(e)}'}), 500
@@ -124,8 +146,12 @@ def delete_post(current_user, post_id):
         if post.user_id != current_user.id:
             return jsonify({'message': 'Unauthorized to delete this post'}), 403
         
+        timeline.remove_post(post.id)
         db.session.delete(post)
+        User.adjust_counter(current_user.id, User.posts_count, -1)
         db.session.commit()
+        entity_cache.invalidate('post', post_id)
+        entity_cache.invalidate('user', current_user.id)
         
         return jsonify({'message': 'Post deleted successfully'}), 200
         
@@ -149,12 +175,13 @@ def like_post(current_user, post_id):
         db.session.add(like)
         
         # Update likes count
-        post.likes_count += 1
+        Post.adjust_counter(post_id, Post.likes_count, 1)
         db.session.commit()
+        entity_cache.invalidate('post', post_id)
         
         return jsonify({
             'message': 'Post liked successfully',
-            'likes_count': post.likes_count
+            'likes_count': post.get_likes_count()
         }), 200
         
     except Exception as e:
@@ -175,12 +202,13 @@ def unlike_post(current_user, post_id):
         db.session.delete(like)
         
         # Update likes count
-        post.likes_count = max(0, post.likes_count - 1)
+        Post.adjust_counter(post_id, Post.likes_count, -1)
         db.session.commit()
+        entity_cache.invalidate('post', post_id)
         
         return jsonify({
             'message': 'Post unliked successfully',
-            'likes_count': post.likes_count
+            'likes_count': post.get_likes_count()
         }), 200
         
     except Exception as e:
@@ -191,25 +219,32 @@ def unlike_post(current_user, post_id):
 @token_required
 def get_comments(current_user, post_id):
     try:
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 20, type=int)
+        # Top-level comments only; `replies` asks for the first N replies of each thread
+        replies_per_comment = min(request.args.get('replies', 0, type=int), 20)
+        
+        fields = Fieldset.from_request()
+        if not fields.wants('replies'):
+            replies_per_comment = 0
         
-        comments = Comment.query.filter_by(post_id=post_id)\
-                               .order_by(desc(Comment.created_at))\
-                               .paginate(page=page, per_page=per_page, error_out=False)
+        top_level = Comment.query.filter_by(post_id=post_id, parent_id=None)\
+                                 .options(*fields.load_options(Comment))
+        comments = paginate(top_level, (Comment.created_at, Comment.id), per_page=20)
+        
+        comments_data = []
+        replies = threads.top_replies([comment.id for comment in comments.items], replies_per_comment)
+        for comment in comments.items:
+            comment_dict = comment.to_dict(fields=fields)
+            if replies_per_comment > 0:
+                comment_dict['replies'] = [reply.to_dict(fields=fields) for reply in replies.get(comment.id, [])]
+            comments_data.append(comment_dict)
         
         return jsonify({
-            'comments': [comment.to_dict() for comment in comments.items],
-            'pagination': {
-                'page': comments.page,
-                'pages': comments.pages,
-                'per_page': comments.per_page,
-                'total': comments.total,
-                'has_next': comments.has_next,
-                'has_prev': comments.has_prev
-            }
+            'comments': comments_data,
+            'pagination': comments.pagination
         }), 200
         
+    except InvalidCursor as e:
+        return jsonify({'message': str(e)}), 400
     except Exception as e:
         return jsonify({'message': f'Error fetching comments: {str(e)}'}), 500
 
@@ -223,17 +258,30 @@ def create_comment(current_user, post_id):
         if not data or not data.get('content'):
             return jsonify({'message': 'Comment content is required'}), 400
         
+        # Replies must target a comment on the same post
+        parent = None
+        if data.get('parent_id'):
+            parent = Comment.query.get(data['parent_id'])
+            if not parent or parent.post_id != post_id:
+                return jsonify({'message': 'Invalid parent comment'}), 400
+            if (parent.depth or 0) >= threads.MAX_DEPTH:
+                return jsonify({'message': 'Reply thread is too deep'}), 400
+        
         comment = Comment(
             user_id=current_user.id,
             post_id=post_id,
+            parent_id=parent.id if parent else None,
             content=data['content']
         )
         
         db.session.add(comment)
+        db.session.flush()
+        threads.place_comment(comment, parent)
         
         # Update comments count
-        post.comments_count += 1
+        Post.adjust_counter(post_id, Post.comments_count, 1)
         db.session.commit()
+        entity_cache.invalidate('post', post_id)
         
         return jsonify({
             'message': 'Comment created successfully',
@@ -244,37 +292,44 @@ def create_comment(current_user, post_id):
         db.session.rollback()
         return jsonify({'message': f'Error creating comment: {str(e)}'}), 500
 
-@posts_bp.route('/users/<int:user_id>/posts', methods=['GET'])
+@posts_bp.route('/comments/<int:comment_id>/replies', methods=['GET'])
 @token_required
-def get_user_posts(current_user, user_id):
+def get_replies(current_user, comment_id):
     try:
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 10, type=int)
+        limit = min(request.args.get('limit', 200, type=int), 500)
         
-        posts = Post.query.filter_by(user_id=user_id)\
-                         .order_by(desc(Post.created_at))\
-                         .paginate(page=page, per_page=per_page, error_out=False)
+        comment = Comment.query.get(comment_id)
+        if not comment:
+            return jsonify({'message': 'Comment not found'}), 404
+        
+        # Whole subtree in thread order from one range scan on the path index
+        fields = Fieldset.from_request()
+        replies = threads.subtree(comment, limit + 1, options=fields.load_options(Comment))
+        
+        return jsonify({
+            'comment': comment.to_dict(fields=fields),
+            'replies': [reply.to_dict(fields=fields) for reply in replies[:limit]],
+            'has_more': len(replies) > limit
+        }), 200
         
-        posts_data = []
-        for post in posts.items:
-            post_dict = post.to_dict()
-            # Check if current user liked this post
-            liked = Like.query.filter_by(user_id=current_user.id, post_id=post.id).first() is not None
-            post_dict['liked_by_user'] = liked
-            posts_data.append(post_dict)
+    except Exception as e:
+        return jsonify({'message': f'Error fetching replies: {str(e)}'}), 500
+
+@posts_bp.route('/users/<int:user_id>/posts', methods=['GET'])
+@token_required
+def get_user_posts(current_user, user_id):
+    try:
+        fields = Fieldset.from_request()
+        posts = paginate(Post.query.filter_by(user_id=user_id).options(*fields.load_options(Post)),
+                         (Post.created_at, Post.id), per_page=10)
         
         return jsonify({
-            'posts': posts_data,
-            'pagination': {
-                'page': posts.page,
-                'pages': posts.pages,
-                'per_page': posts.per_page,
-                'total': posts.total,
-                'has_next': posts.has_next,
-                'has_prev': posts.has_prev
-            }
+            'posts': ViewerContext(current_user.id).post_dicts(posts.items, fields),
+            'pagination': posts.pagination
         }), 200
         
+    except InvalidCursor as e:
+        return jsonify({'message': str(e)}), 400
     except Exception as e:
         return jsonify({'message': f'Error fetching user posts: {str(e)}'}), 500
 
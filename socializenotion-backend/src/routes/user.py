@@ -1,7 +1,12 @@
 from flask import Blueprint, request, jsonify
-from src.models.user import db, User, Follow
+from src.models.user import db, User, Follow, UserSuggestion
 from src.routes.auth import token_required
+from src.services import cache, suggestions, timeline, user_search
+from src.services.cache import entity_cache
+from src.services.pagination import paginate, InvalidCursor
+from src.services.viewer import ViewerContext
 from sqlalchemy import or_
+from sqlalchemy.orm import joinedload
 
 user_bp = Blueprint('user', __name__)
 
@@ -10,67 +15,66 @@ user_bp = Blueprint('user', __name__)
 def search_users(current_user):
     try:
         query = request.args.get('q', '').strip()
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 20, type=int)
         
         if not query:
             return jsonify({'users': [], 'pagination': {}}), 200
         
-        users = User.query.filter(
-            or_(
-                User.username.contains(query),
-                User.email.contains(query),
-                User.bio.contains(query)
-            )
-        ).filter(User.id != current_user.id)\
-         .paginate(page=page, per_page=per_page, error_out=False)
-        
-        users_data = []
-        for user in users.items:
-            user_dict = user.to_dict()
-            # Check if current user is following this user
-            is_following = Follow.query.filter_by(
-                follower_id=current_user.id,
-                following_id=user.id
-            ).first() is not None
-            user_dict['is_following'] = is_following
-            users_data.append(user_dict)
+        # Username and bio only; email is deliberately not searchable
+        users = User.query.filter(User.id != current_user.id)
+        order_by = (User.created_at, User.id)
+        if user_search.fts5_supported():
+            matches = user_search.matches(query)
+            if matches is None:
+                users = users.filter(db.false())
+            else:
+                users = users.join(matches, matches.c.user_id == User.id)
+                order_by = (-matches.c.rank, User.id)
+        else:
+            users = users.filter(or_(User.username.contains(query), User.bio.contains(query)))
+        users = paginate(users, order_by)
         
         return jsonify({
-            'users': users_data,
-            'pagination': {
-                'page': users.page,
-                'pages': users.pages,
-                'per_page': users.per_page,
-                'total': users.total,
-                'has_next': users.has_next,
-                'has_prev': users.has_prev
-            }
+            'users': ViewerContext(current_user.id).user_dicts(users.items),
+            'pagination': users.pagination
         }), 200
         
+    except InvalidCursor as e:
+        return jsonify({'message': str(e)}), 400
     except Exception as e:
         return jsonify({'message': f'Error searching users: {str(e)}'}), 500
 
+@user_bp.route('/users/autocomplete', methods=['GET'])
+@token_required
+def autocomplete_users(current_user):
+    try:
+        query = request.args.get('q', '').strip()
+        limit = min(max(request.args.get('limit', user_search.DEFAULT_LIMIT, type=int), 1),
+                    user_search.MAX_LIMIT)
+        return jsonify({'users': user_search.autocomplete(current_user.id, query, limit)}), 200
+        
+    except Exception as e:
+        return jsonify({'message': f'Error autocompleting users: {str(e)}'}), 500
+
 @user_bp.route('/users/<int:user_id>', methods=['GET'])
 @token_required
 def get_user_profile(current_user, user_id):
     try:
-        user = User.query.get_or_404(user_id)
-        user_dict = user.to_dict()
-        
-        # Add relationship info if not viewing own profile
-        if user_id != current_user.id:
-            is_following = Follow.query.filter_by(
-                follower_id=current_user.id,
-                following_id=user_id
-            ).first() is not None
-            user_dict['is_following'] = is_following
-            
-            follows_back = Follow.query.filter_by(
-                follower_id=user_id,
-                following_id=current_user.id
-            ).first() is not None
-            user_dict['follows_back'] = follows_back
+        user_dict = cache.user_dict(user_id)
+        if user_dict is None:
+            return jsonify({'message': 'User not found'}), 404
+        
+        # Add relationship info if not viewing own profile; the cached dict is shared
+        # by every viewer, so the owner's email is added here
+        if user_id == current_user.id:
+            user_dict['email'] = current_user.email
+        else:
+            viewer = ViewerContext(current_user.id)
+            user_dict['is_following'] = user_id in viewer.following_ids([user_id])
+            user_dict['follows_back'] = user_id in viewer.follower_ids([user_id])
+            # "Followed by X people you know"
+            count, sample = viewer.mutual_followers(user_id)
+            user_dict['mutual_followers_count'] = count
+            user_dict['mutual_follower_ids'] = sample
         
         return jsonify({'user': user_dict}), 200
         
@@ -97,7 +101,10 @@ def follow_user(current_user, user_id):
         
         # Create follow relationship
         current_user.follow(user_to_follow)
+        timeline.backfill_follow(current_user.id, user_id)
+        suggestions.on_follow(current_user.id, user_id)
         db.session.commit()
+        entity_cache.invalidate('user', current_user.id, user_id)
         
         return jsonify({
             'message': f'Now following {user_to_follow.username}',
@@ -128,7 +135,10 @@ def unfollow_user(current_user, user_id):
         
         # Remove follow relationship
         current_user.unfollow(user_to_unfollow)
+        timeline.prune_unfollow(current_user.id, user_id)
+        suggestions.on_unfollow(current_user.id, user_id)
         db.session.commit()
+        entity_cache.invalidate('user', current_user.id, user_id)
         
         return jsonify({
             'message': f'Unfollowed {user_to_unfollow.username}',
@@ -143,37 +153,21 @@ def unfollow_user(current_user, user_id):
 @token_required
 def get_followers(current_user, user_id):
     try:
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 20, type=int)
-        
         user = User.query.get_or_404(user_id)
         
-        followers = Follow.query.filter_by(following_id=user_id)\
-                               .paginate(page=page, per_page=per_page, error_out=False)
+        followers = paginate(Follow.query.filter_by(following_id=user_id)
+                                         .options(joinedload(Follow.follower)),
+                             (Follow.created_at, Follow.id))
         
-        followers_data = []
-        for follow in followers.items:
-            follower_dict = follow.follower.to_dict()
-            # Check if current user is following this follower
-            is_following = Follow.query.filter_by(
-                follower_id=current_user.id,
-                following_id=follow.follower_id
-            ).first() is not None
-            follower_dict['is_following'] = is_following
-            followers_data.append(follower_dict)
+        follower_users = [follow.follower for follow in followers.items]
         
         return jsonify({
-            'followers': followers_data,
-            'pagination': {
-                'page': followers.page,
-                'pages': followers.pages,
-                'per_page': followers.per_page,
-                'total': followers.total,
-                'has_next': followers.has_next,
-                'has_prev': followers.has_prev
-            }
+            'followers': ViewerContext(current_user.id).user_dicts(follower_users),
+            'pagination': followers.pagination
         }), 200
         
+    except InvalidCursor as e:
+        return jsonify({'message': str(e)}), 400
     except Exception as e:
         return jsonify({'message': f'Error fetching followers: {str(e)}'}), 500
 
@@ -181,37 +175,21 @@ def get_followers(current_user, user_id):
 @token_required
 def get_following(current_user, user_id):
     try:
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 20, type=int)
-        
         user = User.query.get_or_404(user_id)
         
-        following = Follow.query.filter_by(follower_id=user_id)\
-                               .paginate(page=page, per_page=per_page, error_out=False)
+        following = paginate(Follow.query.filter_by(follower_id=user_id)
+                                         .options(joinedload(Follow.followed)),
+                             (Follow.created_at, Follow.id))
         
-        following_data = []
-        for follow in following.items:
-            followed_dict = follow.followed.to_dict()
-            # Check if current user is following this person
-            is_following = Follow.query.filter_by(
-                follower_id=current_user.id,
-                following_id=follow.following_id
-            ).first() is not None
-            followed_dict['is_following'] = is_following
-            following_data.append(followed_dict)
+        followed_users = [follow.followed for follow in following.items]
         
         return jsonify({
-            'following': following_data,
-            'pagination': {
-                'page': following.page,
-                'pages': following.pages,
-                'per_page': following.per_page,
-                'total': following.total,
-                'has_next': following.has_next,
-                'has_prev': following.has_prev
-            }
+            'following': ViewerContext(current_user.id).user_dicts(followed_users),
+            'pagination': following.pagination
         }), 200
         
+    except InvalidCursor as e:
+        return jsonify({'message': str(e)}), 400
     except Exception as e:
         return jsonify({'message': f'Error fetching following: {str(e)}'}), 500
 
@@ -219,34 +197,30 @@ def get_following(current_user, user_id):
 @token_required
 def discover_users(current_user):
     try:
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 20, type=int)
-        
-        # Get users that current user is not following
-        following_ids = [f.following_id for f in current_user.following.all()]
-        following_ids.append(current_user.id)  # Exclude self
+        # Precomputed suggestions, best first; users who have none get theirs computed
+        # on a visit, at most once per suggestions.EMPTY_RETRY while none are found
+        query = UserSuggestion.query.filter_by(user_id=current_user.id)
+        if suggestions.needs_refresh(current_user.id):
+            suggestions.refresh_user(current_user.id)
+            db.session.commit()
         
-        users = User.query.filter(~User.id.in_(following_ids))\
-                         .order_by(User.created_at.desc())\
-                         .paginate(page=page, per_page=per_page, error_out=False)
+        users = paginate(query.options(joinedload(UserSuggestion.suggested)),
+                         (UserSuggestion.score, UserSuggestion.suggested_id))
         
         users_data = []
-        for user in users.items:
-            user_dict = user.to_dict()
-            user_dict['is_following'] = False  # By definition, not following these users
+        for suggestion in users.items:
+            user_dict = suggestion.suggested.to_dict()
+            user_dict['is_following'] = False  # Followed users are removed from suggestions
+            user_dict['mutual_count'] = suggestion.mutual_count
+            user_dict['shared_notes_count'] = suggestion.shared_notes_count
             users_data.append(user_dict)
         
         return jsonify({
             'users': users_data,
-            'pagination': {
-                'page': users.page,
-                'pages': users.pages,
-                'per_page': users.per_page,
-                'total': users.total,
-                'has_next': users.has_next,
-                'has_prev': users.has_prev
-            }
+            'pagination': users.pagination
         }), 200
         
+    except InvalidCursor as e:
+        return jsonify({'message': str(e)}), 400
     except Exception as e:
         return jsonify({'message': f'Error discovering users: {str(e)}'}), 500
\ No newline at end of file
@@ -0,0 +1,335 @@
+import json
+import uuid
+from datetime import datetime
+from src.models.user import db, Note, NoteBlock
+from sqlalchemy import func
+
+# Block storage for rich-text notes. When the client asks for content_format 'blocks',
+# a block document ({"blocks": [...]} or a bare list of block objects) is stored one
+# NoteBlock row per block, ordered by a fractional position key, so an edit only writes
+# the blocks it touches. Everything else, including text that merely looks like a
+# document, stays in Note.content with content_format 'text'.
+
+DIGITS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+MAX_BLOCK_ID_LENGTH = 64
+REBALANCE_KEY_LENGTH = 48
+MAX_OPS = 500
+DEFAULT_RANGE_LIMIT = 100
+MAX_RANGE_LIMIT = 500
+
+
+class InvalidBlockOp(ValueError):
+    pass
+
+
+def _midpoint(a, b):
+    # Key strictly between a and b (b None means unbounded). Keys never end in the
+    # zero digit, so there is always room for another key on either side.
+    if b is not None:
+        n = 0
+        while (a[n] if n < len(a) else DIGITS[0]) == b[n]:
+            n += 1
+        if n > 0:
+            return b[:n] + _midpoint(a[n:], b[n:])
+    digit_a = DIGITS.index(a[0]) if a else 0
+    digit_b = DIGITS.index(b[0]) if b is not None else len(DIGITS)
+    if digit_b - digit_a > 1:
+        return DIGITS[(digit_a + digit_b + 1) // 2]
+    if b is not None and len(b) > 1:
+        return b[:1]
+    return DIGITS[digit_a] + _midpoint(a[1:], None)
+
+
+def key_between(a, b):
+    if a is not None and b is not None and a >= b:
+        raise ValueError(f'{a!r} is not before {b!r}')
+    return _midpoint(a or '', b)
+
+
+def keys_between(a, b, count):
+    # Evenly spread keys by bisection, so key length grows with log(count)
+    if count <= 0:
+        return []
+    middle = key_between(a, b)
+    left = count // 2
+    return keys_between(a, middle, left) + [middle] + keys_between(middle, b, count - left - 1)
+
+
+def _block_id(block):
+    block_id = block.get('id')
+    if block_id is None:
+        return uuid.uuid4().hex
+    if not isinstance(block_id, (str, int)) or isinstance(block_id, bool):
+        return None
+    block_id = str(block_id)
+    if not block_id or len(block_id) > MAX_BLOCK_ID_LENGTH:
+        return None
+    return block_id
+
+
+def block_data(block):
+    return json.dumps({key: value for key, value in block.items() if key != 'id'}, separators=(',', ':'))
+
+
+def parse_document(content):
+    # Returns (shape, [(block_id, data, generated_id)]) for block documents, None for
+    # anything else. shape is 'list' or 'object', so the note is served back that way.
+    try:
+        document = json.loads(content) if content else None
+    except (ValueError, TypeError):
+        return None
+    shape = 'list'
+    if isinstance(document, dict) and set(document) == {'blocks'}:
+        document = document['blocks']
+        shape = 'object'
+    if not isinstance(document, list) or not all(isinstance(block, dict) for block in document):
+        return None
+
+    blocks = []
+    seen = set()
+    for block in document:
+        block_id = _block_id(block)
+        if block_id is None or block_id in seen:
+            return None
+        seen.add(block_id)
+        blocks.append((block_id, block_data(block), block.get('id') is None))
+    return shape, blocks
+
+
+def _ordered_subset(ids, positions):
+    # Longest run of `ids` (in document order) whose stored positions are already
+    # increasing; those blocks keep their keys and everything else is placed around them
+    tails, tail_index, previous = [], [], {}
+    for block_id in ids:
+        position = positions[block_id]
+        low, high = 0, len(tails)
+        while low < high:
+            mid = (low + high) // 2
+            if tails[mid] < position:
+                low = mid + 1
+            else:
+                high = mid
+        previous[block_id] = tail_index[low - 1] if low else None
+        if low == len(tails):
+            tails.append(position)
+            tail_index.append(block_id)
+        else:
+            tails[low] = position
+            tail_index[low] = block_id
+
+    kept = set()
+    block_id = tail_index[-1] if tail_index else None
+    while block_id is not None:
+        kept.add(block_id)
+        block_id = previous[block_id]
+    return kept
+
+
+def save_document(note, blocks):
+    # Diff `blocks` against the stored rows and write only what changed
+    existing = {block.block_id: block for block in note.blocks}
+    ids = [block_id for block_id, _, _ in blocks]
+    kept = _ordered_subset(
+        [block_id for block_id in ids if block_id in existing],
+        {block_id: block.position for block_id, block in existing.items()}
+    )
+
+    positions = {}
+    pending = []
+    previous = None
+    for block_id in ids + [None]:
+        if block_id is not None and block_id not in kept:
+            pending.append(block_id)
+            continue
+        anchor = existing[block_id].position if block_id is not None else None
+        for pending_id, key in zip(pending, keys_between(previous, anchor, len(pending))):
+            positions[pending_id] = key
+        pending = []
+        if block_id is not None:
+            positions[block_id] = anchor
+            previous = anchor
+
+    changes = {'inserted': 0, 'updated': 0, 'moved': 0, 'deleted': 0}
+    new_ids = set(ids)
+    for block_id, block in existing.items():
+        if block_id not in new_ids:
+            db.session.delete(block)
+            changes['deleted'] += 1
+    for block_id, data, generated_id in blocks:
+        block = existing.get(block_id)
+        if block is None:
+            db.session.add(NoteBlock(note_id=note.id, block_id=block_id, position=positions[block_id],
+                                     data=data, generated_id=generated_id))
+            changes['inserted'] += 1
+            continue
+        if block.get_data() != data:
+            block.data = data
+            changes['updated'] += 1
+        if block.position != positions[block_id]:
+            block.position = positions[block_id]
+            changes['moved'] += 1
+
+    db.session.flush()
+    rebalance_if_needed(note)
+    db.session.expire(note, ['blocks'])
+    return changes
+
+
+def rebalance_if_needed(note):
+    # Repeated inserts at the same spot (typically appending) lengthen keys by one
+    # digit every few dozen inserts; once any gets long, respace the whole note
+    longest = db.session.query(func.max(func.length(NoteBlock.position)))\
+                        .filter(NoteBlock.note_id == note.id).scalar()
+    if not longest or longest <= REBALANCE_KEY_LENGTH:
+        return False
+    rows = NoteBlock.query.filter_by(note_id=note.id).order_by(NoteBlock.position).all()
+    for row, key in zip(rows, keys_between(None, None, len(rows))):
+        row.position = key
+    db.session.flush()
+    return True
+
+
+def set_content(note, content, content_format=None):
+    # Stores full content sent by PUT/POST; the note must already have an id. Without
+    # an explicit content_format the note keeps its current one, and a block note that
+    # is sent something other than a document falls back to text.
+    document = None
+    if (content_format or note.content_format) == 'blocks':
+        document = parse_document(content)
+        if document is None and content_format == 'blocks':
+            raise InvalidBlockOp('Content is not a block document')
+    if document is None:
+        if note.content_format == 'blocks':
+            NoteBlock.query.filter_by(note_id=note.id).delete(synchronize_session=False)
+            db.session.expire(note, ['blocks'])
+        note.content_format = 'text'
+        note.block_shape = None
+        note.content = content
+        return None
+
+    shape, blocks = document
+    note.content = None
+    note.content_format = 'blocks'
+    note.block_shape = shape
+    return save_document(note, blocks)
+
+
+def ensure_blocks(note):
+    # Block ops and collaborative edits are an explicit request for block storage
+    if note.content_format == 'blocks':
+        return
+    set_content(note, note.get_content() or '[]', 'blocks')
+
+
+def _get_block(note, block_id):
+    block = NoteBlock.query.get((note.id, str(block_id)))
+    if block is None:
+        raise InvalidBlockOp(f'Block {block_id} not found')
+    return block
+
+
+def _neighbour(note, position, after, exclude):
+    query = NoteBlock.query.filter(NoteBlock.note_id == note.id, NoteBlock.block_id != exclude)
+    if after:
+        if position is not None:
+            query = query.filter(NoteBlock.position > position)
+        query = query.order_by(NoteBlock.position)
+    else:
+        if position is not None:
+            query = query.filter(NoteBlock.position < position)
+        query = query.order_by(NoteBlock.position.desc())
+    block = query.first()
+    return block.position if block else None
+
+
+def position_after(note, block_id, exclude=None):
+    # Key right after block `block_id`, or before the first block when it is None
+    if block_id is None:
+        return key_between(None, _neighbour(note, None, True, exclude))
+    anchor = _get_block(note, block_id).position
+    return key_between(anchor, _neighbour(note, anchor, True, exclude))
+
+
+def position_near(note, position, exclude=None):
+    # Key for the slot a since-removed block used to occupy
+    before = _neighbour(note, position, False, exclude)
+    after = _neighbour(note, before, True, exclude)
+    return key_between(before, after)
+
+
+def _place(note, op, exclude=None):
+    # Position for an insert/move: after a block, before a block, or at the end
+    if op.get('after') is not None:
+        anchor = _get_block(note, op['after']).position
+        return key_between(anchor, _neighbour(note, anchor, True, exclude))
+    if op.get('before') is not None:
+        anchor = _get_block(note, op['before']).position
+        return key_between(_neighbour(note, anchor, False, exclude), anchor)
+    return key_between(_neighbour(note, None, False, exclude), None)
+
+
+def apply_ops(note, ops):
+    # ops: [{"op": "insert", "block": {...}, "after"|"before": id},
+    #       {"op": "update", "id": id, "block": {...}},
+    #       {"op": "move", "id": id, "after"|"before": id},
+    #       {"op": "delete", "id": id}]
+    if not isinstance(ops, list) or not ops:
+        raise InvalidBlockOp('ops must be a non-empty list')
+    if len(ops) > MAX_OPS:
+        raise InvalidBlockOp(f'At most {MAX_OPS} ops per request')
+
+    ensure_blocks(note)
+    touched = []
+    for op in ops:
+        kind = op.get('op') if isinstance(op, dict) else None
+        if kind == 'insert':
+            block = op.get('block')
+            if not isinstance(block, dict):
+                raise InvalidBlockOp('insert needs a block object')
+            block_id = _block_id(block)
+            if block_id is None:
+                raise InvalidBlockOp('Invalid block id')
+            if NoteBlock.query.get((note.id, block_id)) is not None:
+                raise InvalidBlockOp(f'Block {block_id} already exists')
+            db.session.add(NoteBlock(
+                note_id=note.id, block_id=block_id, position=_place(note, op), data=block_data(block),
+                generated_id=block.get('id') is None
+            ))
+            touched.append(block_id)
+        elif kind == 'update':
+            block = op.get('block')
+            if not isinstance(block, dict):
+                raise InvalidBlockOp('update needs a block object')
+            _get_block(note, op.get('id')).data = block_data(block)
+            touched.append(str(op['id']))
+        elif kind == 'move':
+            block = _get_block(note, op.get('id'))
+            block.position = _place(note, op, exclude=block.block_id)
+            touched.append(block.block_id)
+        elif kind == 'delete':
+            db.session.delete(_get_block(note, op.get('id')))
+        else:
+            raise InvalidBlockOp(f'Unknown op: {kind}')
+        db.session.flush()
+
+    rebalance_if_needed(note)
+    # The note row itself is small now; bump it so listings and caches see the edit
+    note.updated_at = datetime.utcnow()
+    db.session.expire(note, ['blocks'])
+    return touched
+
+
+def load_range(note, after=None, limit=DEFAULT_RANGE_LIMIT):
+    # Blocks in document order starting after block `after`; returns (blocks, has_more)
+    limit = max(1, min(limit or DEFAULT_RANGE_LIMIT, MAX_RANGE_LIMIT))
+    if note.content_format != 'blocks':
+        if note.content:
+            raise InvalidBlockOp('Note content is not a block document')
+        return [], False
+
+    query = NoteBlock.query.filter(NoteBlock.note_id == note.id)
+    if after is not None:
+        query = query.filter(NoteBlock.position > _get_block(note, after).position)
+    rows = query.order_by(NoteBlock.position).limit(limit + 1).all()
+    return [dict(row.to_dict(), position=row.position) for row in rows[:limit]], len(rows) > limit
+
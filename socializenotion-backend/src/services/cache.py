@@ -0,0 +1,249 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from src.models.user import User, Post, Note
+
+# Entity cache for the dicts served by get_post, get_user_profile, get_profile and
+# get_note. Entries are keyed by entity, id and a per-entity version number; write
+# routes bump the version after commit, which makes every older entry unreachable
+# in this worker and, with the sqlite backend, in every other worker too.
+
+
+class MemoryBackend:
+    # In-process LRU with a TTL and an entry bound. A version is only remembered for
+    # two TTLs after its last bump, by when every entry written under an older version
+    # (even by a build that started before the bump) has expired. Bumps draw from one
+    # sequence, so a key that was forgotten and is bumped again never returns to a
+    # version an entry might still be stored under.
+
+    def __init__(self, max_entries=10000, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._versions = OrderedDict()  # key -> (version, bumped_at), oldest bump first
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_version(self, key):
+        with self._lock:
+            entry = self._versions.get(key)
+            return entry[0] if entry is not None else 0
+
+    def bump_version(self, key):
+        with self._lock:
+            now = time.monotonic()
+            self._sequence += 1
+            self._versions[key] = (self._sequence, now)
+            self._versions.move_to_end(key)
+            while self._versions:
+                _, (_, bumped_at) = next(iter(self._versions.items()))
+                if bumped_at + 2 * self.ttl >= now:
+                    break
+                self._versions.popitem(last=False)
+            return self._sequence
+
+    def size(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+
+
+class SQLiteBackend:
+    # Cache shared by every worker on the host through a local SQLite file. Versions
+    # live in their own table so evicting entries can never resurrect a stale one.
+
+    PRUNE_EVERY = 500
+
+    def __init__(self, path, max_entries=100000, ttl=300):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._local = threading.local()
+        self._writes = 0
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache_entry '
+                '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache_version '
+                '(key TEXT PRIMARY KEY, version INTEGER NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_cache_entry_expires ON cache_entry (expires_at)')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._conn().execute(
+            'SELECT value FROM cache_entry WHERE key = ? AND expires_at >= ?',
+            (key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value):
+        conn = self._conn()
+        conn.execute(
+            'INSERT OR REPLACE INTO cache_entry (key, value, expires_at) VALUES (?, ?, ?)',
+            (key, json.dumps(value), time.time() + self.ttl)
+        )
+        self._writes += 1
+        if self._writes % self.PRUNE_EVERY == 0:
+            self._prune(conn)
+
+    def _prune(self, conn):
+        conn.execute('DELETE FROM cache_entry WHERE expires_at < ?', (time.time(),))
+        conn.execute(
+            'DELETE FROM cache_entry WHERE key IN ('
+            'SELECT key FROM cache_entry ORDER BY expires_at DESC LIMIT -1 OFFSET ?)',
+            (self.max_entries,)
+        )
+
+    def get_version(self, key):
+        row = self._conn().execute('SELECT version FROM cache_version WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else 0
+
+    def bump_version(self, key):
+        conn = self._conn()
+        conn.execute(
+            'INSERT INTO cache_version (key, version) VALUES (?, 1) '
+            'ON CONFLICT(key) DO UPDATE SET version = version + 1',
+            (key,)
+        )
+        return self.get_version(key)
+
+    def size(self):
+        return self._conn().execute('SELECT COUNT(*) FROM cache_entry').fetchone()[0]
+
+    def clear(self):
+        conn = self._conn()
+        conn.execute('DELETE FROM cache_entry')
+        conn.execute('DELETE FROM cache_version')
+
+
+class EntityCache:
+
+    def __init__(self):
+        self.backend = None
+        self._stats = defaultdict(lambda: {'hits': 0, 'misses': 0, 'invalidations': 0})
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        backend = app.config.get('CACHE_BACKEND', 'memory')
+        ttl = app.config.get('CACHE_TTL', 300)
+        max_entries = app.config.get('CACHE_MAX_ENTRIES', 10000)
+        if backend == 'memory':
+            self.backend = MemoryBackend(max_entries=max_entries, ttl=ttl)
+        elif backend == 'sqlite':
+            path = app.config.get('CACHE_PATH') or os.path.join(app.root_path, 'database', 'cache.db')
+            self.backend = SQLiteBackend(path, max_entries=max_entries, ttl=ttl)
+        else:
+            self.backend = None
+
+    def _count(self, entity, stat):
+        with self._lock:
+            self._stats[entity][stat] += 1
+
+    def get(self, entity, entity_id, build):
+        # Returns a copy of the cached dict, calling `build` on a miss. A None result
+        # from `build` (missing row) is not cached.
+        if self.backend is None:
+            return build()
+
+        version = self.backend.get_version(f'{entity}:{entity_id}')
+        key = f'{entity}:{entity_id}:v{version}'
+        value = self.backend.get(key)
+        if value is not None:
+            self._count(entity, 'hits')
+            return dict(value)
+
+        self._count(entity, 'misses')
+        value = build()
+        if value is not None:
+            self.backend.set(key, value)
+            return dict(value)
+        return None
+
+    def invalidate(self, entity, *entity_ids):
+        if self.backend is None:
+            return
+        for entity_id in entity_ids:
+            self.backend.bump_version(f'{entity}:{entity_id}')
+            self._count(entity, 'invalidations')
+
+    def stats(self):
+        with self._lock:
+            entities = {entity: dict(stats) for entity, stats in self._stats.items()}
+        hits = sum(stats['hits'] for stats in entities.values())
+        lookups = hits + sum(stats['misses'] for stats in entities.values())
+        return {
+            'backend': type(self.backend).__name__ if self.backend else None,
+            'entries': self.backend.size() if self.backend else 0,
+            'hits': hits,
+            'misses': lookups - hits,
+            'hit_rate': round(hits / lookups, 4) if lookups else None,
+            'entities': entities
+        }
+
+
+entity_cache = EntityCache()
+
+
+def user_dict(user_id):
+    def build():
+        user = User.query.get(user_id)
+        return user.to_dict() if user else None
+
+    return entity_cache.get('user', user_id, build)
+
+
+def post_dict(post_id):
+    def build():
+        post = Post.query.get(post_id)
+        return post.to_dict(include_author=False) if post else None
+
+    post_data = entity_cache.get('post', post_id, build)
+    if post_data is not None:
+        post_data['author'] = user_dict(post_data['user_id'])
+    return post_data
+
+
+def note_dict(note_id):
+    def build():
+        note = Note.query.get(note_id)
+        return note.to_dict(include_author=False) if note else None
+
+    note_data = entity_cache.get('note', note_id, build)
+    if note_data is not None:
+        note_data['author'] = user_dict(note_data['user_id'])
+    return note_data
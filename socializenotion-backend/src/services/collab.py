@@ -0,0 +1,225 @@
+import json
+import threading
+import time
+from datetime import datetime
+from src.models.user import db, Note, NoteBlock, NoteOp
+from src.services import blocks, note_search, ot, revisions
+from src.services.blocks import InvalidBlockOp
+from sqlalchemy import update
+
+# Server side of collaborative note editing (see ot.py for the op format). Editors
+# POST batches of ops written against the op_version they last saw; the server
+# transforms each batch past the batches logged since then, applies it to the
+# NoteBlock rows and logs it as the next version. Other editors long-poll the log.
+#
+# Merge cost per op is bounded by MAX_BEHIND: an editor further behind than that
+# gets a 409 and reloads. Full-document work (search index, revision history) is
+# done by compact() every COMPACT_EVERY batches instead of per op; it also trims
+# the log. PUT, block PATCH and restore log a reset, which makes editors reload.
+
+MAX_OPS_PER_BATCH = 100
+MAX_BEHIND = 100
+COMPACT_EVERY = 50
+MAX_WAIT = 25  # seconds a long-poll may block
+POLL_INTERVAL = 1.0  # seconds between log checks, for batches written by other workers
+MAX_ENTRIES = 200
+
+_log_changed = threading.Condition()
+
+
+class StaleVersion(Exception):
+    pass
+
+
+def _validate(op):
+    if not isinstance(op, dict) or not isinstance(op.get('id'), str) or not op['id']:
+        raise InvalidBlockOp('Every op needs a block id')
+    kind = op.get('op')
+    if kind == 'insert':
+        if not isinstance(op.get('block'), dict) or len(op['id']) > blocks.MAX_BLOCK_ID_LENGTH:
+            raise InvalidBlockOp('insert needs a block object and an id of at most 64 characters')
+    elif kind == 'set':
+        if not isinstance(op.get('attrs'), dict) or 'id' in op['attrs']:
+            raise InvalidBlockOp('set needs attrs without an id')
+    elif kind == 'text':
+        if not isinstance(op.get('field'), str) or op['field'] == 'id':
+            raise InvalidBlockOp('text needs a field')
+        if not isinstance(op.get('pos'), int) or op['pos'] < 0:
+            raise InvalidBlockOp('text needs a position')
+        has_insert = isinstance(op.get('insert'), str) and op['insert']
+        has_delete = isinstance(op.get('delete'), int) and op['delete'] > 0
+        if has_insert == has_delete:
+            raise InvalidBlockOp('text needs exactly one of insert or delete')
+    elif kind not in ('move', 'delete'):
+        raise InvalidBlockOp(f'Unknown op: {kind}')
+    if kind in ('insert', 'move') and op.get('after') is not None and not isinstance(op['after'], str):
+        raise InvalidBlockOp('after must be a block id')
+
+
+def _next_version(note):
+    # Bumping the version first takes SQLite's write lock, so batches for the same
+    # note are applied one at a time and each sees every batch before it
+    version = db.session.execute(
+        update(Note).where(Note.id == note.id)
+        .values(op_version=Note.op_version + 1, version=Note.version + 1, updated_at=datetime.utcnow())
+        .returning(Note.op_version)
+    ).scalar_one()
+    db.session.expire(note, ['op_version', 'version', 'updated_at', 'blocks'])
+    return version
+
+
+def _deleted_position(note, block_id, since_version):
+    # Where a block deleted by a recent batch used to be, for ops anchored on it
+    entries = NoteOp.query.filter(NoteOp.note_id == note.id, NoteOp.version > since_version)\
+                          .order_by(NoteOp.version.desc()).all()
+    for entry in entries:
+        for op in json.loads(entry.ops):
+            if op['op'] == 'delete' and op['id'] == block_id:
+                return op['position']
+    return None
+
+
+def _position(note, anchor, exclude, since_version):
+    if anchor is None or NoteBlock.query.get((note.id, anchor)) is not None:
+        return blocks.position_after(note, anchor, exclude=exclude)
+    position = _deleted_position(note, anchor, since_version)
+    if position is None:
+        return blocks.position_after(note, None, exclude=exclude)
+    return blocks.position_near(note, position, exclude=exclude)
+
+
+def _apply(note, op, since_version):
+    # Applies one op to the stored blocks; returns it in server form or None
+    block = NoteBlock.query.get((note.id, op['id']))
+    kind = op['op']
+    if kind == 'insert':
+        if block is not None:
+            raise InvalidBlockOp(f"Block {op['id']} already exists")
+        position = _position(note, op.get('after'), None, since_version)
+        data = {key: value for key, value in op['block'].items() if key != 'id'}
+        db.session.add(NoteBlock(note_id=note.id, block_id=op['id'], position=position, data=blocks.block_data(data)))
+        return {'op': 'insert', 'id': op['id'], 'position': position, 'block': data}
+    if block is None:
+        return None
+    if kind == 'delete':
+        db.session.delete(block)
+        return {'op': 'delete', 'id': op['id'], 'position': block.position}
+    if kind == 'move':
+        block.position = _position(note, op.get('after'), block.block_id, since_version)
+        return {'op': 'move', 'id': op['id'], 'position': block.position}
+
+    data = json.loads(block.get_data())
+    if kind == 'set':
+        ot.set_attrs(data, op['attrs'])
+    else:
+        try:
+            data[op['field']] = ot.splice(data.get(op['field']), op)
+        except ValueError as e:
+            raise InvalidBlockOp(str(e))
+    block.data = blocks.block_data(data)
+    return op
+
+
+def submit(note, user_id, client_id, base_version, ops):
+    # Returns the logged entry; raises StaleVersion when the editor has to reload
+    if not isinstance(ops, list) or len(ops) > MAX_OPS_PER_BATCH:
+        raise InvalidBlockOp(f'ops must be a list of at most {MAX_OPS_PER_BATCH} ops')
+    if not isinstance(base_version, int):
+        raise InvalidBlockOp('version is required')
+    for op in ops:
+        _validate(op)
+
+    version = _next_version(note)
+    if not version - 1 - MAX_BEHIND <= base_version < version:
+        raise StaleVersion()
+    blocks.ensure_blocks(note)
+
+    missed = NoteOp.query.filter(NoteOp.note_id == note.id, NoteOp.version > base_version)\
+                         .order_by(NoteOp.version).all()
+    if len(missed) != version - 1 - base_version:
+        raise StaleVersion()
+    for entry in missed:
+        logged = json.loads(entry.ops)
+        if any(op['op'] == 'reset' for op in logged):
+            raise StaleVersion()
+        ops, _ = ot.transform_lists(ops, logged, True)
+
+    applied = []
+    for op in ops:
+        result = _apply(note, op, base_version)
+        if result is not None:
+            applied.append(result)
+        db.session.flush()
+
+    if blocks.rebalance_if_needed(note):
+        # Respaced keys reach the other editors as moves
+        applied.extend(
+            {'op': 'move', 'id': block.block_id, 'position': block.position}
+            for block in NoteBlock.query.filter_by(note_id=note.id).order_by(NoteBlock.position)
+        )
+
+    entry = NoteOp(note_id=note.id, version=version, user_id=user_id, client_id=client_id,
+                   ops=json.dumps(applied, separators=(',', ':')))
+    db.session.add(entry)
+    if version % COMPACT_EVERY == 0:
+        compact(note, user_id)
+    return entry
+
+
+def reset(note, user_id):
+    # Logs that the note was rewritten outside the op log
+    version = _next_version(note)
+    entry = NoteOp(note_id=note.id, version=version, user_id=user_id, ops=json.dumps([{'op': 'reset'}]))
+    db.session.add(entry)
+    return entry
+
+
+def compact(note, user_id=None):
+    # Brings the search index and revision history up to date with the blocks and
+    # drops log entries no editor can still be based on
+    db.session.flush()
+    db.session.expire(note, ['blocks'])
+    note_search.index_note(note)
+    revisions.record(note, user_id if user_id is not None else note.user_id)
+    NoteOp.query.filter(
+        NoteOp.note_id == note.id,
+        NoteOp.version <= note.op_version - MAX_BEHIND
+    ).delete(synchronize_session=False)
+
+
+def compact_all():
+    note_ids = [row[0] for row in db.session.query(NoteOp.note_id).distinct().all()]
+    for note_id in note_ids:
+        note = Note.query.get(note_id)
+        last = NoteOp.query.filter_by(note_id=note_id).order_by(NoteOp.version.desc()).first()
+        compact(note, last.user_id if last else None)
+        db.session.commit()
+    return len(note_ids)
+
+
+def notify():
+    with _log_changed:
+        _log_changed.notify_all()
+
+
+def entries_since(note_id, since, wait=0):
+    # Log entries after version `since`, blocking up to `wait` seconds for one to arrive
+    deadline = time.monotonic() + min(max(wait, 0), MAX_WAIT)
+    while True:
+        current = db.session.query(Note.op_version).filter(Note.id == note_id).scalar()
+        if since > current:
+            raise StaleVersion()
+        if since < current:
+            entries = NoteOp.query.filter(NoteOp.note_id == note_id, NoteOp.version > since)\
+                                  .order_by(NoteOp.version).limit(MAX_ENTRIES).all()
+            if not entries or entries[0].version != since + 1:
+                raise StaleVersion()
+            return current, entries
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return current, []
+        # Release the connection while waiting; other workers' batches show up on the next check
+        db.session.rollback()
+        with _log_changed:
+            _log_changed.wait(min(remaining, POLL_INTERVAL))
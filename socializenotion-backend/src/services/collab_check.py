@@ -0,0 +1,159 @@
+import json
+import random
+from flask import Flask
+from src.models.user import db
+from src.services import migrations, ot
+
+# Convergence check for collaborative editing. Simulated editors (ot.Client) make
+# random edits to one note on a scratch database and talk to the real ops routes
+# through the test client: batches are sent and log entries delivered in random
+# interleavings, so editors keep editing on top of unacknowledged batches and
+# concurrent entries. Once everything is sent and delivered, every editor's document
+# must equal the stored blocks. Used by `flask --app src.main check-collab-convergence`,
+# which exits non-zero on any divergence or rejected batch.
+
+WORDS = ['alpha', 'beta', 'gamma', 'delta', 'echo', 'zulu']
+TYPES = ['paragraph', 'heading', 'todo', 'quote']
+
+
+def random_op(rng, editor, serial):
+    # An op that is valid against the editor's local document
+    document = editor.document
+    ids = document.ordered_ids()
+    kinds = ['insert'] + (['delete', 'move', 'set', 'text', 'text', 'text'] if ids else [])
+    kind = rng.choice(kinds)
+    if kind == 'insert':
+        return {'op': 'insert', 'id': f'{editor.client_id}-{serial}', 'after': rng.choice(ids + [None]),
+                'block': {'type': rng.choice(TYPES), 'text': rng.choice(WORDS)}}
+    block_id = rng.choice(ids)
+    if kind == 'delete':
+        return {'op': 'delete', 'id': block_id}
+    if kind == 'move':
+        return {'op': 'move', 'id': block_id, 'after': rng.choice([i for i in ids if i != block_id] + [None])}
+    if kind == 'set':
+        return {'op': 'set', 'id': block_id, 'attrs': rng.choice([
+            {'type': rng.choice(TYPES)}, {'checked': True}, {'checked': None}, {'text': rng.choice(WORDS)}
+        ])}
+    text = document.blocks[block_id][1].get('text') or ''
+    if text and rng.random() < 0.4:
+        pos = rng.randrange(len(text))
+        return {'op': 'text', 'id': block_id, 'field': 'text', 'pos': pos,
+                'delete': rng.randint(1, len(text) - pos)}
+    return {'op': 'text', 'id': block_id, 'field': 'text', 'pos': rng.randint(0, len(text)),
+            'insert': rng.choice(WORDS)[:rng.randint(1, 3)]}
+
+
+class Divergence(Exception):
+    pass
+
+
+def _session(client, name):
+    response = client.post('/api/auth/register', json={
+        'username': name, 'email': f'{name}@example.com', 'password': 'sim-password'
+    })
+    return {'Authorization': f"Bearer {response.get_json()['token']}"}
+
+
+def simulate(client, seed, editors=3, steps=200):
+    # One run; returns the number of batches the server applied or raises Divergence
+    rng = random.Random(seed)
+    owner = _session(client, f'sim{seed}owner')
+    headers = [owner]
+    for index in range(1, editors):
+        headers.append(_session(client, f'sim{seed}editor{index}'))
+
+    initial = [{'id': f'seed-{index}', 'type': 'paragraph', 'text': rng.choice(WORDS)} for index in range(3)]
+    note_id = client.post('/api/notes', headers=owner, json={
+        'title': 'simulation', 'content_format': 'blocks', 'content': json.dumps({'blocks': initial})
+    }).get_json()['note']['id']
+    for index in range(1, editors):
+        client.post(f'/api/notes/{note_id}/collaborate', headers=owner, json={
+            'username': f'sim{seed}editor{index}', 'permission_level': 'edit'
+        })
+
+    def stored():
+        response = client.get(f'/api/notes/{note_id}/blocks?limit=500', headers=owner).get_json()
+        return response['blocks'], response['op_version']
+
+    blocks, version = stored()
+    clients = [ot.Client(f'e{index}', blocks, version) for index in range(editors)]
+    log = []
+    delivered = [0] * editors
+
+    def send(index):
+        batch = clients[index].flush()
+        if batch is None:
+            return
+        response = client.post(f'/api/notes/{note_id}/ops', headers=headers[index], json=batch)
+        if response.status_code != 200:
+            raise Divergence(f"seed {seed}: batch from e{index} rejected: {response.get_json()['message']}")
+
+    def fetch():
+        while True:
+            since = log[-1]['version'] if log else version
+            entries = client.get(f'/api/notes/{note_id}/ops?since={since}', headers=owner).get_json()['entries']
+            if not entries:
+                return
+            log.extend(entries)
+
+    def deliver(index, count=None):
+        # Hands the editor its next `count` log entries (all when None), in order
+        if delivered[index] == len(log):
+            fetch()
+        end = len(log) if count is None else min(len(log), delivered[index] + count)
+        for entry in log[delivered[index]:end]:
+            try:
+                clients[index].receive(entry)
+            except ValueError as e:
+                raise Divergence(f'seed {seed}: e{index} could not apply version {entry["version"]}: {e}')
+        delivered[index] = end
+
+    for serial in range(steps):
+        index = rng.randrange(editors)
+        action = rng.random()
+        if action < 0.5:
+            clients[index].edit(random_op(rng, clients[index], serial))
+        elif action < 0.75:
+            send(index)
+        else:
+            deliver(index, rng.randint(1, 3))
+
+    # Drain: keep sending and delivering until no editor has anything outstanding
+    while any(editor.inflight or editor.buffer for editor in clients) or any(d < len(log) for d in delivered):
+        for index in range(editors):
+            deliver(index)
+            send(index)
+        for index in range(editors):
+            deliver(index)
+
+    blocks, final_version = stored()
+    expected = [{key: value for key, value in block.items() if key != 'position'} for block in blocks]
+    for editor in clients:
+        if editor.version != final_version:
+            raise Divergence(f'seed {seed}: {editor.client_id} stopped at version {editor.version} of {final_version}')
+        if editor.document.to_list() != expected:
+            raise Divergence(f'seed {seed}: {editor.client_id} diverged from the stored note\n'
+                             f'    editor: {editor.document.to_list()}\n    stored: {expected}')
+    return final_version
+
+
+def check(blueprints, runs=20, editors=3, steps=200, seed=0):
+    # Returns [(seed, batches applied or None, error or None)] for `runs` seeds
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['TESTING'] = True
+    for blueprint, url_prefix in blueprints:
+        app.register_blueprint(blueprint, url_prefix=url_prefix)
+    db.init_app(app)
+
+    results = []
+    with app.app_context():
+        migrations.upgrade()
+        client = app.test_client()
+        for run_seed in range(seed, seed + runs):
+            try:
+                results.append((run_seed, simulate(client, run_seed, editors, steps), None))
+            except Divergence as e:
+                results.append((run_seed, None, str(e)))
+    return results
@@ -0,0 +1,134 @@
+import threading
+import zlib
+from collections import OrderedDict
+from sqlalchemy import bindparam, func, tuple_, update
+
+# Transparent compression for large text stored at rest: plain note content, block
+# data and revision data. The models pack values on assignment and unpack them only
+# when read, so queries that don't use the content don't pay to decompress it.
+# Packed values are bytes (SQLite keeps them as BLOBs in the same TEXT columns) and
+# start with a codec tag byte, so the codec can change without rewriting old rows.
+# Anything that is still a str is stored as is.
+#
+# SQL can't see inside packed values: note search over compressed bodies needs the
+# FTS5 index (note_search), which is fed the unpacked text. The LIKE fallback used
+# when FTS5 is unavailable only matches bodies under THRESHOLD and older rows that
+# `compress-notes` hasn't packed yet.
+
+THRESHOLD = 2048  # UTF-8 bytes below which values are left uncompressed
+MIN_SAVING = 0.1  # keep the packed form only if it is at least this much smaller
+ZLIB_LEVEL = 6
+ZLIB = b'\x01'
+
+CODECS = {ZLIB: zlib.decompress}
+
+# Bound on the decoded values kept for repeated reads, counting each packed key and
+# its decoded text; values larger than a quarter of it are never kept
+UNPACK_CACHE_BYTES = 8 * 1024 * 1024
+
+_unpacked = OrderedDict()
+_unpacked_bytes = 0
+_unpacked_lock = threading.Lock()
+
+
+def pack(value):
+    # Tagged compressed bytes for large text, the value unchanged otherwise
+    if not isinstance(value, str):
+        return value
+    raw = value.encode('utf-8')
+    if len(raw) < THRESHOLD:
+        return value
+    packed = ZLIB + zlib.compress(raw, ZLIB_LEVEL)
+    if len(packed) > len(raw) * (1 - MIN_SAVING):
+        return value
+    return packed
+
+
+def _unpack(value):
+    decompress = CODECS.get(value[:1])
+    if decompress is None:
+        raise ValueError(f'Unknown codec tag {value[:1]!r}')
+    return decompress(value[1:]).decode('utf-8')
+
+
+def unpack(value):
+    # Repeated reads of the same stored value (index, revision, response) decode once
+    # while the value stays in the byte-bounded LRU
+    global _unpacked_bytes
+    if not isinstance(value, bytes):
+        return value
+    with _unpacked_lock:
+        text = _unpacked.get(value)
+        if text is not None:
+            _unpacked.move_to_end(value)
+            return text
+
+    text = _unpack(value)
+    size = len(value) + len(text.encode('utf-8'))
+    if size > UNPACK_CACHE_BYTES // 4:
+        return text
+    with _unpacked_lock:
+        if value not in _unpacked:
+            _unpacked[value] = text
+            _unpacked_bytes += size
+        while _unpacked_bytes > UNPACK_CACHE_BYTES:
+            key, evicted = _unpacked.popitem(last=False)
+            _unpacked_bytes -= len(key) + len(evicted.encode('utf-8'))
+    return text
+
+
+def stored_size(value):
+    if value is None:
+        return 0
+    return len(value) if isinstance(value, bytes) else len(value.encode('utf-8'))
+
+
+def _compress_column(column, key_columns, batch_size):
+    # Packs the stored str values of `column` above the threshold, in primary key
+    # order and one batch per transaction; returns (rows packed, bytes before, bytes after)
+    from src.models.user import db
+    table = column.table
+    keys = [table.c[name] for name in key_columns]
+    packed_rows = before = after = 0
+    last = None
+    while True:
+        query = db.session.query(*keys, column).filter(
+            func.typeof(column) == 'text',
+            func.length(column) >= THRESHOLD // 4
+        )
+        if last is not None:
+            query = query.filter(tuple_(*keys) > tuple_(*last))
+        rows = query.order_by(*keys).limit(batch_size).all()
+        if not rows:
+            break
+
+        changes = []
+        for row in rows:
+            value = row[-1]
+            packed = pack(value)
+            if isinstance(packed, bytes):
+                changes.append(dict({f'b_{name}': key for name, key in zip(key_columns, row)}, b_value=packed))
+                packed_rows += 1
+                before += stored_size(value)
+                after += len(packed)
+        if changes:
+            # Core update, so updated_at keeps its value instead of taking onupdate
+            statement = update(table).values({column.name: bindparam('b_value')})
+            for name in key_columns:
+                statement = statement.where(table.c[name] == bindparam(f'b_{name}'))
+            if 'updated_at' in table.c:
+                statement = statement.values(updated_at=table.c.updated_at)
+            db.session.execute(statement, changes)
+        db.session.commit()
+        last = tuple(rows[-1][:-1])
+    return packed_rows, before, after
+
+
+def compress_all(batch_size=500):
+    # Converts rows written before compression; returns {table: (rows, bytes before, bytes after)}
+    from src.models.user import Note, NoteBlock, NoteRevision
+    return {
+        'note': _compress_column(Note.__table__.c.content, ['id'], batch_size),
+        'note_block': _compress_column(NoteBlock.__table__.c.data, ['note_id', 'block_id'], batch_size),
+        'note_revision': _compress_column(NoteRevision.__table__.c.data, ['id'], batch_size),
+    }
@@ -0,0 +1,170 @@
+import atexit
+import threading
+import time
+from collections import defaultdict
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
+BUFFERED_COLUMNS = ('likes_count', 'comments_count')
+
+# One statement for both counters so a flush is a single executemany
+FLUSH_SQL = text(
+    'UPDATE post SET '
+    'likes_count = max(likes_count + :likes_count, 0), '
+    'comments_count = max(comments_count + :comments_count, 0) '
+    'WHERE id = :post_id'
+)
+
+# How long the values a flush wrote stand in for the row. A request that loaded a
+# post just before a flush committed still shows the flushed count instead of its
+# stale row plus deltas that are no longer pending.
+SETTLED_TTL = 5.0
+
+
+class CounterBuffer:
+    # Write-behind buffer for Post engagement counters. Deltas recorded inside a
+    # request are staged on the session and only enter the buffer once that
+    # transaction commits; a background thread then applies them in batched
+    # UPDATEs. Post.to_dict merges pending deltas so clients never see a count
+    # go backwards between a like and the next flush. Buffered deltas are flushed
+    # once more when the process exits.
+
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self.flush_interval = 0.5
+        self._lock = threading.Lock()
+        self._pending = defaultdict(lambda: defaultdict(int))
+        self._flushing = {}
+        self._settled = {}
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('COUNTER_BUFFER_ENABLED', False)
+        self.flush_interval = app.config.get('COUNTER_BUFFER_FLUSH_INTERVAL', self.flush_interval)
+        if self.enabled and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='counter-buffer', daemon=True)
+            self._thread.start()
+            atexit.register(self.drain)
+
+    def record(self, session, post_id, column, delta):
+        session.info.setdefault('counter_deltas', []).append((post_id, column, delta))
+
+    def pending(self, post_id):
+        with self._lock:
+            return self._merged(post_id)
+
+    def _merged(self, post_id):
+        merged = dict(self._flushing.get(post_id, {}))
+        for column, delta in self._pending.get(post_id, {}).items():
+            merged[column] = merged.get(column, 0) + delta
+        return merged
+
+    def value(self, post_id, column, stored):
+        # Count to show for a post whose row had `stored`: the row, or what this
+        # process flushed if that is newer than the row may be, plus unflushed deltas
+        with self._lock:
+            settled = self._settled.get(post_id)
+            if settled is not None and settled[0] > time.monotonic():
+                stored = settled[1][column]
+            return max(stored + self._merged(post_id).get(column, 0), 0)
+
+    def pending_ids(self):
+        # Posts with deltas not yet visible in their rows
+        with self._lock:
+            return list(set(self._pending) | set(self._flushing))
+
+    def _commit_deltas(self, deltas):
+        with self._lock:
+            for post_id, column, delta in deltas:
+                self._pending[post_id][column] += delta
+
+    def flush(self):
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        with self._lock:
+            if not self._pending:
+                return 0
+            batch = {post_id: dict(columns) for post_id, columns in self._pending.items()}
+            self._pending.clear()
+            self._flushing = batch
+
+        from src.models.user import db, Post
+
+        params = [
+            {
+                'post_id': post_id,
+                'likes_count': columns.get('likes_count', 0),
+                'comments_count': columns.get('comments_count', 0)
+            }
+            for post_id, columns in batch.items()
+        ]
+        try:
+            with self.app.app_context():
+                db.session.execute(FLUSH_SQL, params)
+                rows = db.session.query(Post.id, Post.likes_count, Post.comments_count)\
+                                 .filter(Post.id.in_(list(batch))).all()
+                # The commit and the hand-over from _flushing to _settled happen under
+                # the lock, so value() never sees the new rows together with the deltas
+                # already in them, nor a stale row without them
+                with self._lock:
+                    db.session.commit()
+                    expires = time.monotonic() + SETTLED_TTL
+                    for post_id, likes_count, comments_count in rows:
+                        self._settled[post_id] = (expires, {
+                            'likes_count': likes_count or 0, 'comments_count': comments_count or 0
+                        })
+                    self._flushing = {}
+        except Exception:
+            # Put the deltas back so the next flush retries them
+            with self._lock:
+                for post_id, columns in batch.items():
+                    for column, delta in columns.items():
+                        self._pending[post_id][column] += delta
+                self._flushing = {}
+            raise
+        self._expire_settled()
+        return len(params)
+
+    def _expire_settled(self):
+        now = time.monotonic()
+        with self._lock:
+            for post_id in [post_id for post_id, (expires, _) in self._settled.items() if expires <= now]:
+                del self._settled[post_id]
+
+    def drain(self):
+        # Final flush at exit (deltas of the last interval would otherwise die with
+        # the daemon thread) and before maintenance commands; logs instead of raising
+        if self.app is None:
+            return
+        try:
+            self.flush()
+        except Exception as e:
+            self.app.logger.warning(f'Final counter buffer flush failed: {str(e)}')
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                self.app.logger.warning(f'Counter buffer flush failed: {str(e)}')
+
+
+counter_buffer = CounterBuffer()
+
+
+@event.listens_for(Session, 'after_commit')
+def _move_committed_deltas(session):
+    deltas = session.info.pop('counter_deltas', None)
+    if deltas:
+        counter_buffer._commit_deltas(deltas)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _drop_rolled_back_deltas(session, previous_transaction):
+    session.info.pop('counter_deltas', None)
@@ -0,0 +1,30 @@
+from src.models.user import db, User, Post, Follow
+from src.services.cache import entity_cache
+from sqlalchemy import select, update, func, or_
+
+
+def reconcile_user_counters():
+    # Recompute every denormalized User counter in one UPDATE and return how many
+    # rows had drifted; cached dicts of the repaired users are invalidated after commit
+    followers = select(func.count(Follow.id))\
+        .where(Follow.following_id == User.id).scalar_subquery()
+    following = select(func.count(Follow.id))\
+        .where(Follow.follower_id == User.id).scalar_subquery()
+    posts = select(func.count(Post.id))\
+        .where(Post.user_id == User.id).scalar_subquery()
+
+    result = db.session.execute(
+        update(User)
+        .where(or_(
+            User.followers_count.is_distinct_from(followers),
+            User.following_count.is_distinct_from(following),
+            User.posts_count.is_distinct_from(posts)
+        ))
+        .values(followers_count=followers, following_count=following, posts_count=posts)
+        .returning(User.id)
+        .execution_options(synchronize_session=False)
+    )
+    repaired = [row[0] for row in result]
+    db.session.commit()
+    entity_cache.invalidate('user', *repaired)
+    return len(repaired)
@@ -0,0 +1,126 @@
+import hashlib
+from flask import request, make_response
+from sqlalchemy import Integer, cast, func, literal
+from sqlalchemy.orm import aliased
+from src.models.user import db, User, Post, Note, Like
+from src.services import permissions
+from src.services.counter_buffer import counter_buffer
+
+# Strong ETags for notes, posts and lists of them, computed from a handful of
+# columns instead of the serialized body. Entity tags look like "note12-v7.<hash>":
+# the part before the dot is the row's version (bumped by every write, see
+# version_id_col on the models) and is what If-Match compares; the hash covers
+# everything else the response depends on, i.e. updated_at, counters, the embedded
+# author, the viewer-specific fields and the query string.
+
+# Row hashes for collection tags: a polynomial over the row's columns modulo a prime,
+# squared so the sum over a set isn't linear in any one column. All intermediates
+# stay below 2**63, so SQLite never falls back to floating point.
+_PRIME = 2147483647
+_MIX = 1000003
+
+
+def _digest(*parts):
+    args = sorted(request.args.items(multi=True))
+    return hashlib.blake2b(repr((parts, args)).encode(), digest_size=8).hexdigest()
+
+
+def state(kind, entity_id, version):
+    return f'{kind}{entity_id}-v{version}'
+
+
+def _author_columns(author=User):
+    return (author.updated_at, author.followers_count, author.following_count, author.posts_count)
+
+
+def note_tag(note_id, *viewer):
+    # ETag for the note as served to this viewer, or None when the note doesn't exist
+    row = db.session.query(Note.version, Note.updated_at, *_author_columns())\
+                    .join(User, User.id == Note.user_id)\
+                    .filter(Note.id == note_id).first()
+    if row is None:
+        return None
+    return f"{state('note', note_id, row[0])}.{_digest(*row[1:], *viewer)}"
+
+
+def post_tag(post_id, *viewer):
+    row = db.session.query(Post.version, Post.updated_at, Post.likes_count, Post.comments_count,
+                           *_author_columns())\
+                    .join(User, User.id == Post.user_id)\
+                    .filter(Post.id == post_id).first()
+    if row is None:
+        return None
+    pending = counter_buffer.pending(post_id) if counter_buffer.enabled else {}
+    return f"{state('post', post_id, row[0])}.{_digest(*row[1:], sorted(pending.items()), *viewer)}"
+
+
+def _row_hash(*columns):
+    mixed = literal(0)
+    for column in columns:
+        mixed = (mixed * _MIX + func.coalesce(column, 0)) % _PRIME
+    return mixed * mixed % _PRIME
+
+
+def _milliseconds(column):
+    # Integer form of a DateTime column for _row_hash; SQLite would otherwise read
+    # the stored string as just its leading year
+    return cast((func.julianday(column) - 2440587.5) * 86400000, Integer)
+
+
+def collection_tag(kind, query, model, *columns, viewer=()):
+    # ETag for a list from one aggregate over the whole filtered query: row count,
+    # newest updated_at and the sum of per-row hashes of id, version, the embedded
+    # author's updated_at and counters, and any extra `columns`, so swapping one row
+    # for another or moving a count between rows changes it too
+    author = aliased(User)
+    author_updated_at, *author_counters = _author_columns(author)
+    aggregate = query.order_by(None)\
+        .join(author, author.id == model.user_id)\
+        .with_entities(
+            func.count(model.id), func.max(model.updated_at),
+            func.sum(_row_hash(model.id, model.version, _milliseconds(author_updated_at),
+                               *author_counters, *columns))
+        ).one()
+    return f'{kind}.{_digest(*aggregate, *viewer)}'
+
+
+def notes_tag(kind, query, viewer_id):
+    # Note lists also carry the viewer's permission level on each note
+    return collection_tag(kind, query, Note, permissions.level_rank(viewer_id))
+
+
+def feed_tag(query, viewer_id):
+    # Post lists also depend on the viewer's like rows (liked_by_user) and on counter
+    # deltas still in the write-behind buffer; counters change without a version bump
+    post_ids = query.order_by(None).with_entities(Post.id)
+    likes = db.session.query(func.count(Like.id), func.sum(_row_hash(Like.id, Like.post_id)))\
+                      .filter(Like.user_id == viewer_id, Like.post_id.in_(post_ids)).one()
+    pending = []
+    buffered = counter_buffer.pending_ids() if counter_buffer.enabled else []
+    if buffered:
+        listed = sorted(row[0] for row in post_ids.filter(Post.id.in_(buffered)))
+        pending = [(post_id, sorted(counter_buffer.pending(post_id).items())) for post_id in listed]
+    return collection_tag('feed', query, Post, Post.likes_count, Post.comments_count,
+                          viewer=(tuple(likes), pending))
+
+
+def not_modified(tag):
+    # 304 response when If-None-Match already names `tag`, else None
+    if tag is None or not request.if_none_match.contains(tag):
+        return None
+    response = make_response('', 304)
+    response.set_etag(tag)
+    return response
+
+
+def if_match_failed(current_state):
+    # True when If-Match is sent and none of its tags is for `current_state`
+    if not request.if_match or request.if_match.star_tag:
+        return False
+    return not any(tag.split('.', 1)[0] == current_state for tag in request.if_match.as_set())
+
+
+def tagged(response, tag):
+    if tag is not None:
+        response.set_etag(tag)
+    return response
@@ -0,0 +1,58 @@
+from flask import request
+from sqlalchemy import inspect
+from sqlalchemy.orm import load_only, selectinload
+
+# Sparse fieldsets. ?fields=id,title keeps only the listed response keys and
+# ?exclude=content,author drops keys; nested objects such as `author` are keys like
+# any other. List routes turn the fieldset into loader options so the columns behind
+# unrequested keys are never selected, and to_dict only reads the keys it is asked
+# for. `id` is always returned.
+
+
+def _split(value):
+    return {key.strip() for key in value.split(',') if key.strip()} if value else None
+
+
+class Fieldset:
+
+    def __init__(self, include=None, exclude=None):
+        self.include = set(include) | {'id'} if include else None
+        self.exclude = set(exclude or ()) - {'id'}
+
+    @classmethod
+    def from_request(cls):
+        return cls(_split(request.args.get('fields')), _split(request.args.get('exclude')))
+
+    @property
+    def is_full(self):
+        return self.include is None and not self.exclude
+
+    def wants(self, key):
+        return (self.include is None or key in self.include) and key not in self.exclude
+
+    def filter(self, data):
+        if data is None or self.is_full:
+            return data
+        return {key: value for key, value in data.items() if self.wants(key)}
+
+    def load_options(self, model, *always):
+        # load_only for the columns behind wanted keys plus `always`, selectinload for
+        # wanted relationships. Keys default to the column of the same name; models
+        # list the others in `field_sources`.
+        mapper = inspect(model)
+        sources = {column.key: (column.key,) for column in mapper.column_attrs}
+        sources.update(getattr(model, 'field_sources', {}))
+
+        attributes = set(always)
+        for key, needed in sources.items():
+            if self.wants(key):
+                attributes.update(needed)
+
+        options = [
+            selectinload(getattr(model, name))
+            for name in sorted(attributes) if name in mapper.relationships
+        ]
+        if not self.is_full:
+            columns = [getattr(model, name) for name in sorted(attributes) if name in mapper.column_attrs]
+            options.append(load_only(*columns))
+        return options
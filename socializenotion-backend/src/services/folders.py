@@ -0,0 +1,157 @@
+from src.models.user import (
+    db, Folder, FolderClosure, FolderGrant, Note, NoteBlock, NoteRevision, NoteOp, NoteTag, Collaboration
+)
+from src.services import note_search
+from sqlalchemy import delete, func, insert, literal, select, true
+from sqlalchemy.orm import aliased
+
+# Folder hierarchy. FolderClosure stores every ancestor/descendant pair, so subtree
+# and ancestor questions are one indexed query each, and moves and recursive
+# deletes are a few set-based statements however deep the tree is.
+#
+# The sidebar tree is built from one query for the user's folders and one GROUP BY
+# for their note counts, in a single pass over the list.
+
+
+def note_counts(user_id):
+    # {folder_id: notes directly in that folder}
+    rows = db.session.query(Note.folder_id, func.count(Note.id))\
+                     .filter(Note.user_id == user_id, Note.folder_id.isnot(None))\
+                     .group_by(Note.folder_id).all()
+    return dict(rows)
+
+
+def build_tree(user_id, max_depth=None):
+    # Nested folder dicts with notes_count (direct), total_notes_count (whole
+    # subtree) and subfolders_count. With max_depth only that many levels are
+    # returned; deeper folders still count towards the totals.
+    folders = Folder.query.filter_by(user_id=user_id).order_by(Folder.name, Folder.id).all()
+    counts = note_counts(user_id)
+
+    nodes = {}
+    for folder in folders:
+        node = folder.to_dict()
+        node['children'] = []
+        node['notes_count'] = counts.get(folder.id, 0)
+        nodes[folder.id] = node
+
+    roots = []
+    for folder in folders:
+        parent = nodes.get(folder.parent_folder_id)
+        (parent['children'] if parent else roots).append(nodes[folder.id])
+
+    # Breadth-first order puts every parent before its children, so walking it
+    # backwards adds each subtree total into its parent exactly once
+    order = []
+    queue = [(node, 1) for node in roots]
+    for node, depth in queue:
+        order.append((node, depth))
+        queue.extend((child, depth + 1) for child in node['children'])
+    for node, _ in reversed(order):
+        node['subfolders_count'] = len(node['children'])
+        node['total_notes_count'] = node['notes_count'] + sum(
+            child['total_notes_count'] for child in node['children']
+        )
+    if max_depth is not None:
+        for node, depth in order:
+            if depth >= max_depth:
+                node['children'] = []
+    return roots
+
+
+def folder_counts(folder_id):
+    # (subfolders, notes) directly inside one folder, in one query
+    return db.session.query(
+        select(func.count(Folder.id)).where(Folder.parent_folder_id == folder_id).scalar_subquery(),
+        select(func.count(Note.id)).where(Note.folder_id == folder_id).scalar_subquery()
+    ).one()
+
+
+def add_folder(folder):
+    # Call after the new folder is flushed: links it to itself and its parent's ancestors
+    db.session.execute(insert(FolderClosure).values(ancestor_id=folder.id, descendant_id=folder.id, depth=0))
+    if folder.parent_folder_id:
+        db.session.execute(insert(FolderClosure).from_select(
+            ['ancestor_id', 'descendant_id', 'depth'],
+            select(FolderClosure.ancestor_id, literal(folder.id), FolderClosure.depth + 1)
+            .where(FolderClosure.descendant_id == folder.parent_folder_id)
+        ))
+
+
+def subtree_ids(folder_id):
+    # Subquery of the folder and every folder below it
+    return select(FolderClosure.descendant_id).where(FolderClosure.ancestor_id == folder_id)
+
+
+def is_within(folder_id, ancestor_id):
+    # True when `folder_id` is `ancestor_id` or below it
+    return db.session.query(FolderClosure.depth).filter_by(
+        ancestor_id=ancestor_id, descendant_id=folder_id
+    ).first() is not None
+
+
+def path(folder_id):
+    # Breadcrumb from the root down to the folder itself
+    return Folder.query.join(FolderClosure, FolderClosure.ancestor_id == Folder.id)\
+                       .filter(FolderClosure.descendant_id == folder_id)\
+                       .order_by(FolderClosure.depth.desc()).all()
+
+
+def move(folder, parent_id):
+    # Re-parents the whole subtree: drops its links to the old ancestors and links
+    # every folder in it to the new parent's ancestors. The caller rules out cycles.
+    ancestors = select(FolderClosure.ancestor_id).where(
+        FolderClosure.descendant_id == folder.id, FolderClosure.depth > 0
+    )
+    db.session.execute(delete(FolderClosure).where(
+        FolderClosure.descendant_id.in_(subtree_ids(folder.id)),
+        FolderClosure.ancestor_id.in_(ancestors)
+    ).execution_options(synchronize_session=False))
+    if parent_id:
+        above, below = aliased(FolderClosure), aliased(FolderClosure)
+        db.session.execute(insert(FolderClosure).from_select(
+            ['ancestor_id', 'descendant_id', 'depth'],
+            # Every new ancestor crossed with every folder of the subtree
+            select(above.ancestor_id, below.descendant_id, above.depth + below.depth + 1)
+            .select_from(above).join(below, true())
+            .where(above.descendant_id == parent_id, below.ancestor_id == folder.id)
+        ))
+    folder.parent_folder_id = parent_id or None
+
+
+def delete_subtree(folder_id):
+    # Deletes the folder, every folder below it and all their notes with a fixed
+    # number of statements. Returns the ids of the deleted notes, for cache invalidation.
+    folder_ids = subtree_ids(folder_id)
+    note_ids = select(Note.id).where(Note.folder_id.in_(folder_ids))
+    deleted_notes = [row[0] for row in db.session.execute(note_ids)]
+
+    note_search.remove_notes(note_ids)
+    statements = [delete(model).where(model.note_id.in_(note_ids))
+                  for model in (NoteBlock, NoteRevision, NoteOp, NoteTag, Collaboration)]
+    statements += [
+        delete(Note).where(Note.folder_id.in_(folder_ids)),
+        delete(FolderGrant).where(FolderGrant.folder_id.in_(folder_ids)),
+        delete(Folder).where(Folder.id.in_(folder_ids)),
+        # Last, since the statements above find the subtree through these rows
+        delete(FolderClosure).where(FolderClosure.descendant_id.in_(folder_ids)),
+    ]
+    for statement in statements:
+        db.session.execute(statement.execution_options(synchronize_session=False))
+    return deleted_notes
+
+
+def rebuild_closure():
+    # Recomputes the closure table from parent_folder_id in one recursive statement
+    db.session.execute(delete(FolderClosure).execution_options(synchronize_session=False))
+    paths = select(
+        Folder.id.label('ancestor_id'), Folder.id.label('descendant_id'), literal(0).label('depth')
+    ).cte('paths', recursive=True)
+    paths = paths.union_all(
+        select(paths.c.ancestor_id, Folder.id, paths.c.depth + 1)
+        .join(Folder, Folder.parent_folder_id == paths.c.descendant_id)
+    )
+    db.session.execute(insert(FolderClosure).from_select(
+        ['ancestor_id', 'descendant_id', 'depth'],
+        select(paths.c.ancestor_id, paths.c.descendant_id, paths.c.depth)
+    ))
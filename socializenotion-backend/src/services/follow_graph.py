@@ -0,0 +1,218 @@
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, insort
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+# Typecode for the edge arrays: 4-byte signed ints, enough for any user id SQLite
+# hands out here and half the size of a Python int list's pointers alone
+TYPECODE = 'i'
+
+
+def _contains(edges, user_id):
+    i = bisect_left(edges, user_id)
+    return i < len(edges) and edges[i] == user_id
+
+
+def _intersect(a, b):
+    # Sorted intersection; binary-searches the smaller array into the larger one
+    if len(a) > len(b):
+        a, b = b, a
+    if not a:
+        return []
+    if len(b) > len(a) * 8:
+        return [x for x in a if _contains(b, x)]
+    result = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        if a[i] == b[j]:
+            result.append(a[i])
+            i += 1
+            j += 1
+        elif a[i] < b[j]:
+            i += 1
+        else:
+            j += 1
+    return result
+
+
+class FollowGraph:
+    # In-process copy of the follow graph as two sorted int arrays per user, one of
+    # followees (out-edges) and one of followers (in-edges). Membership is a binary
+    # search, degree a len() and "followed by people you know" a sorted intersection.
+    # Follows and unfollows are staged on the session and applied once the
+    # transaction commits, like the counter buffer. Other processes' writes are only
+    # seen after a reload, so with several workers set FOLLOW_GRAPH_RELOAD_INTERVAL.
+
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self.reload_interval = None
+        self._lock = threading.Lock()
+        self._out = {}
+        self._in = {}
+        self._edges = 0
+        self._loaded_at = None
+        self._load_seconds = None
+        self._replay = None
+        self._thread = None
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('FOLLOW_GRAPH_ENABLED', False)
+        self.reload_interval = app.config.get('FOLLOW_GRAPH_RELOAD_INTERVAL')
+        if not self.enabled:
+            return
+        with app.app_context():
+            self.load()
+        if self.reload_interval and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='follow-graph', daemon=True)
+            self._thread.start()
+
+    def load(self, batch_size=50000):
+        # Rebuilds both indexes from the follow table and swaps them in at once
+        from src.models.user import db, Follow
+        started = time.monotonic()
+        with self._lock:
+            # Changes committed while the table is read are replayed onto the new copy
+            self._replay = []
+        out_edges, in_edges = {}, {}
+        edges = 0
+        try:
+            rows = db.session.query(Follow.follower_id, Follow.following_id)\
+                             .order_by(Follow.follower_id, Follow.following_id)\
+                             .yield_per(batch_size)
+            for follower_id, following_id in rows:
+                followees = out_edges.get(follower_id)
+                if followees is None:
+                    followees = out_edges[follower_id] = array(TYPECODE)
+                followees.append(following_id)
+                followers = in_edges.get(following_id)
+                if followers is None:
+                    followers = in_edges[following_id] = array(TYPECODE)
+                followers.append(follower_id)
+                edges += 1
+            db.session.commit()
+        except Exception:
+            with self._lock:
+                self._replay = None
+            raise
+        # Out-edges arrive sorted; in-edges only grouped, so sort them once
+        for user_id, followers in in_edges.items():
+            in_edges[user_id] = array(TYPECODE, sorted(followers))
+
+        with self._lock:
+            self._out, self._in, self._edges = out_edges, in_edges, edges
+            replay, self._replay = self._replay, None
+            self._apply_locked(replay)
+            self._loaded_at = time.time()
+            self._load_seconds = time.monotonic() - started
+        return edges
+
+    def _run(self):
+        while True:
+            time.sleep(self.reload_interval)
+            try:
+                with self.app.app_context():
+                    self.load()
+            except Exception as e:
+                self.app.logger.warning(f'Follow graph reload failed: {str(e)}')
+
+    def record(self, session, follower_id, following_id, followed):
+        # Stage a follow (followed=True) or unfollow until the session commits
+        if self.enabled:
+            session.info.setdefault('follow_edges', []).append((follower_id, following_id, followed))
+
+    def _apply(self, changes):
+        with self._lock:
+            if self._replay is not None:
+                self._replay.extend(changes)
+            self._apply_locked(changes)
+
+    def _apply_locked(self, changes):
+        # Idempotent, so replaying a change the reload already saw is harmless
+        for follower_id, following_id, followed in changes:
+            followees = self._out.setdefault(follower_id, array(TYPECODE))
+            followers = self._in.setdefault(following_id, array(TYPECODE))
+            if followed and not _contains(followees, following_id):
+                insort(followees, following_id)
+                insort(followers, follower_id)
+                self._edges += 1
+            elif not followed and _contains(followees, following_id):
+                followees.pop(bisect_left(followees, following_id))
+                followers.pop(bisect_left(followers, follower_id))
+                self._edges -= 1
+
+    def is_following(self, follower_id, following_id):
+        with self._lock:
+            return _contains(self._out.get(follower_id, ()), following_id)
+
+    def following_ids(self, user_id, user_ids):
+        # Users in `user_ids` that `user_id` follows
+        with self._lock:
+            followees = self._out.get(user_id, ())
+            return {other for other in user_ids if _contains(followees, other)}
+
+    def follower_ids(self, user_id, user_ids):
+        # Users in `user_ids` who follow `user_id`
+        with self._lock:
+            followers = self._in.get(user_id, ())
+            return {other for other in user_ids if _contains(followers, other)}
+
+    def followees(self, user_id):
+        with self._lock:
+            return list(self._out.get(user_id, ()))
+
+    def follower_count(self, user_id):
+        with self._lock:
+            return len(self._in.get(user_id, ()))
+
+    def following_count(self, user_id):
+        with self._lock:
+            return len(self._out.get(user_id, ()))
+
+    def mutual_followers(self, viewer_id, user_id):
+        # Followees of the viewer who follow `user_id`, in id order
+        with self._lock:
+            return _intersect(self._out.get(viewer_id, ()), self._in.get(user_id, ()))
+
+    def memory_bytes(self):
+        # Edge arrays plus the per-user array objects and the two dicts holding them
+        with self._lock:
+            total = sys.getsizeof(self._out) + sys.getsizeof(self._in)
+            for index in (self._out, self._in):
+                for edges in index.values():
+                    total += sys.getsizeof(edges)
+            return total
+
+    def stats(self):
+        if not self.enabled:
+            return {'enabled': False}
+        memory = self.memory_bytes()
+        with self._lock:
+            return {
+                'enabled': True,
+                'users': len(set(self._out) | set(self._in)),
+                'edges': self._edges,
+                'memory_bytes': memory,
+                'bytes_per_edge': round(memory / self._edges, 1) if self._edges else None,
+                'loaded_at': self._loaded_at,
+                'load_seconds': round(self._load_seconds, 3) if self._load_seconds is not None else None,
+            }
+
+
+follow_graph = FollowGraph()
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_committed_edges(session):
+    changes = session.info.pop('follow_edges', None)
+    if changes:
+        follow_graph._apply(changes)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _drop_rolled_back_edges(session, previous_transaction):
+    session.info.pop('follow_edges', None)
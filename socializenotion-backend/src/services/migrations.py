@@ -0,0 +1,202 @@
+from datetime import datetime
+from src.models.user import db
+from src.services import folders, note_search, revisions, suggestions, tags, timeline, threads, user_search
+from src.services.counters import reconcile_user_counters
+from sqlalchemy import inspect, text
+
+# Versioned schema migrations. db.create_all() builds fresh databases straight from
+# the models, so a fresh database is only stamped with every version; an existing
+# one runs the pending migrations in order, each in its own transaction, and
+# records them in schema_migrations. Migrations that create objects the models
+# can't describe (virtual tables, triggers) set run_on_fresh and must be idempotent.
+MIGRATIONS = []
+
+# Columns added to existing tables. Data steps go through the models, which select
+# every current column, so all of these are added before any pending migration runs.
+ADDED_COLUMNS = [
+    ('user', 'followers_count', "INTEGER NOT NULL DEFAULT '0'"),
+    ('user', 'following_count', "INTEGER NOT NULL DEFAULT '0'"),
+    ('user', 'posts_count', "INTEGER NOT NULL DEFAULT '0'"),
+    ('comment', 'parent_id', 'INTEGER REFERENCES comment (id)'),
+    ('comment', 'root_id', 'INTEGER'),
+    ('comment', 'path', 'VARCHAR(255)'),
+    ('comment', 'depth', "INTEGER NOT NULL DEFAULT '0'"),
+    ('comment', 'reply_count', "INTEGER NOT NULL DEFAULT '0'"),
+    ('note', 'content_format', "VARCHAR(10) NOT NULL DEFAULT 'text'"),
+    ('note', 'block_shape', 'VARCHAR(10)'),
+    ('note', 'op_version', "INTEGER NOT NULL DEFAULT '0'"),
+    ('note', 'version', "INTEGER NOT NULL DEFAULT '1'"),
+    ('post', 'version', "INTEGER NOT NULL DEFAULT '1'"),
+    ('post', 'fanned_out', "BOOLEAN NOT NULL DEFAULT '1'"),
+    ('user', 'token_version', "INTEGER NOT NULL DEFAULT '0'"),
+    ('user', 'suggestions_refreshed_at', 'DATETIME'),
+    ('note_block', 'generated_id', "BOOLEAN NOT NULL DEFAULT '0'"),
+]
+
+
+def migration(version, name, run_on_fresh=False):
+    def register(fn):
+        MIGRATIONS.append((version, name, fn, run_on_fresh))
+        return fn
+    return register
+
+
+def column_exists(table, column):
+    rows = db.session.execute(text(f'PRAGMA table_info("{table}")')).fetchall()
+    return any(row[1] == column for row in rows)
+
+
+def add_column(table, column, ddl):
+    if not column_exists(table, column):
+        db.session.execute(text(f'ALTER TABLE "{table}" ADD COLUMN {column} {ddl}'))
+
+
+def create_index(name, table, columns, where=None):
+    # SQLite blocks writers while an index builds, so every index is committed on its
+    # own to keep each lock window as short as one index build
+    partial = f' WHERE {where}' if where else ''
+    db.session.execute(text(f'CREATE INDEX IF NOT EXISTS {name} ON "{table}" ({columns}){partial}'))
+    db.session.commit()
+
+
+@migration(1, 'user counters and comment threading')
+def add_counters_and_threads():
+    # Comments written before threading are all roots
+    legacy = db.session.execute(text('SELECT id FROM comment WHERE path IS NULL')).fetchall()
+    if legacy:
+        db.session.execute(
+            text('UPDATE comment SET root_id = :id, path = :path WHERE id = :id'),
+            [{'id': row[0], 'path': threads.path_segment(row[0])} for row in legacy]
+        )
+    create_index('ix_comment_root_path', 'comment', 'root_id, path')
+
+    reconcile_user_counters()
+    timeline.rebuild_all()
+
+
+@migration(2, 'composite indexes for hot filters')
+def add_composite_indexes():
+    create_index('ix_post_user_created', 'post', 'user_id, created_at')
+    create_index('ix_note_user_updated', 'note', 'user_id, updated_at')
+    create_index('ix_note_folder_updated', 'note', 'folder_id, updated_at')
+    create_index('ix_comment_post_created', 'comment', 'post_id, created_at')
+    create_index('ix_follow_following_created', 'follow', 'following_id, created_at')
+    create_index('ix_collaboration_user_note', 'collaboration', 'user_id, note_id')
+    create_index('ix_collaboration_note_user', 'collaboration', 'note_id, user_id')
+    create_index('ix_notification_user_read_created', 'notification', 'user_id, is_read, created_at')
+
+
+@migration(3, 'full-text index for notes', run_on_fresh=True)
+def add_note_search():
+    if not note_search.fts5_supported():
+        return
+    note_search.create_index_table()
+    note_search.rebuild()
+
+
+@migration(4, 'normalized note tags')
+def add_note_tags():
+    # Tag and NoteTag are created by create_all; copy the comma-separated tags over
+    tags.backfill()
+
+
+@migration(5, 'block storage for note content')
+def add_note_blocks():
+    # NoteBlock is created by create_all. Existing notes stay text: block storage is
+    # opt-in per note (content_format 'blocks'), so nothing is converted here.
+    pass
+
+
+@migration(6, 'note revision history')
+def add_note_revisions():
+    # Baseline snapshot so the current content of existing notes can be restored
+    revisions.backfill()
+
+
+@migration(7, 'folder sharing')
+def add_folder_grants():
+    # FolderGrant is created by create_all; grants resolve subtrees through parent_folder_id
+    create_index('ix_folder_parent', 'folder', 'parent_folder_id')
+
+
+@migration(8, 'folder listing index')
+def add_folder_listing_index():
+    # Serves the per-user folder tree and the name-ordered listing of one level
+    create_index('ix_folder_user_parent_name', 'folder', 'user_id, parent_folder_id, name')
+
+
+@migration(9, 'folder closure table')
+def add_folder_closure():
+    # FolderClosure is created by create_all; fill it from parent_folder_id
+    folders.rebuild_closure()
+
+
+@migration(10, 'user search index', run_on_fresh=True)
+def add_user_search():
+    create_index('ix_user_followers_username', 'user', 'followers_count, username')
+    if not user_search.fts5_supported():
+        return
+    user_search.create_index_table()
+    user_search.rebuild()
+
+
+@migration(11, 'user suggestions')
+def add_user_suggestions():
+    # UserSuggestion is created by create_all; score every existing user
+    suggestions.rebuild_all()
+
+
+@migration(12, 'per-post fan-out decision')
+def add_post_fanout_flag():
+    # Posts record whether they were fanned out; take the decision for existing posts
+    # from their author's current follower count and rebuild timelines to match
+    create_index('ix_post_pulled', 'post', 'user_id, created_at', where='fanned_out = 0')
+    timeline.rebuild_all()
+
+
+def ensure_version_table():
+    db.session.execute(text(
+        'CREATE TABLE IF NOT EXISTS schema_migrations '
+        '(version INTEGER PRIMARY KEY, name VARCHAR(255) NOT NULL, applied_at DATETIME NOT NULL)'
+    ))
+    db.session.commit()
+
+
+def applied_versions():
+    rows = db.session.execute(text('SELECT version FROM schema_migrations')).fetchall()
+    return {row[0] for row in rows}
+
+
+def upgrade():
+    fresh = not inspect(db.engine).has_table('user')
+    db.create_all()
+    ensure_version_table()
+    if not fresh:
+        for table, column, ddl in ADDED_COLUMNS:
+            add_column(table, column, ddl)
+        db.session.commit()
+
+    applied = applied_versions()
+    ran = []
+    for version, name, fn, run_on_fresh in sorted(MIGRATIONS, key=lambda m: m[0]):
+        if version in applied:
+            continue
+        try:
+            if run_on_fresh or not fresh:
+                fn()
+            db.session.execute(
+                text('INSERT INTO schema_migrations (version, name, applied_at) VALUES (:version, :name, :applied_at)'),
+                {'version': version, 'name': name, 'applied_at': datetime.utcnow()}
+            )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        ran.append((version, name))
+    return ran
+
+
+def status():
+    ensure_version_table()
+    applied = applied_versions()
+    return [(version, name, version in applied) for version, name, _, _ in sorted(MIGRATIONS, key=lambda m: m[0])]
@@ -0,0 +1,146 @@
+import html
+import json
+import re
+from src.models.user import db, Note
+from sqlalchemy import text, column, table, func, literal_column
+from sqlalchemy.orm import selectinload
+
+# Full-text search over notes with an FTS5 table keyed by note id. The body column
+# holds the plain text pulled out of the rich-text block JSON, so markup, ids and
+# URLs never match. The write routes keep it in sync inside their own transaction.
+
+FTS_TABLE = 'note_fts'
+TEXT_KEYS = {'text', 'content', 'title', 'code', 'caption', 'label', 'items', 'children', 'blocks'}
+
+note_fts = table(FTS_TABLE, column('rowid'), column('title'), column('body'))
+_fts_ref = literal_column(FTS_TABLE)
+
+_fts5_supported = None
+
+# FTS5 brackets matches with these private-use characters; the note text around them
+# is HTML-escaped before they become <mark> tags, so snippets are safe to render
+_MATCH_START = '\ue000'
+_MATCH_END = '\ue001'
+
+
+def fts5_supported():
+    global _fts5_supported
+    if _fts5_supported is None:
+        options = db.session.execute(text('PRAGMA compile_options')).fetchall()
+        _fts5_supported = any(row[0] == 'ENABLE_FTS5' for row in options)
+    return _fts5_supported
+
+
+def create_index_table():
+    if fts5_supported():
+        db.session.execute(text(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} "
+            f"USING fts5(title, body, tokenize='unicode61 remove_diacritics 2')"
+        ))
+
+
+def plain_text(content):
+    # Rich-text content is JSON blocks; anything that doesn't parse is plain text
+    if not content:
+        return ''
+    try:
+        document = json.loads(content)
+    except (ValueError, TypeError):
+        return content
+
+    parts = []
+
+    def walk(value, key=None):
+        if isinstance(value, str):
+            if key is None or key in TEXT_KEYS:
+                parts.append(value)
+        elif isinstance(value, list):
+            for item in value:
+                walk(item, key)
+        elif isinstance(value, dict):
+            for child_key, child in value.items():
+                walk(child, child_key)
+
+    walk(document)
+    return '\n'.join(parts)
+
+
+def index_note(note):
+    if not fts5_supported():
+        return
+    remove_note(note.id)
+    db.session.execute(
+        text(f'INSERT INTO {FTS_TABLE} (rowid, title, body) VALUES (:id, :title, :body)'),
+        {'id': note.id, 'title': note.title, 'body': plain_text(note.get_content())}
+    )
+
+
+def remove_note(note_id):
+    if fts5_supported():
+        db.session.execute(text(f'DELETE FROM {FTS_TABLE} WHERE rowid = :id'), {'id': note_id})
+
+
+def remove_notes(note_ids):
+    # `note_ids` is a select of note ids, so bulk deletes don't have to load the notes
+    if fts5_supported():
+        db.session.execute(note_fts.delete().where(note_fts.c.rowid.in_(note_ids)))
+
+
+def rebuild(batch_size=500):
+    db.session.execute(text(f'DELETE FROM {FTS_TABLE}'))
+    last_id = 0
+    indexed = 0
+    while True:
+        notes = Note.query.filter(Note.id > last_id).options(selectinload(Note.blocks))\
+                          .order_by(Note.id).limit(batch_size).all()
+        if not notes:
+            break
+        db.session.execute(
+            text(f'INSERT INTO {FTS_TABLE} (rowid, title, body) VALUES (:id, :title, :body)'),
+            [{'id': note.id, 'title': note.title, 'body': plain_text(note.get_content())} for note in notes]
+        )
+        # Read before the commit expires the batch and expunge detaches it
+        last_id = notes[-1].id
+        indexed += len(notes)
+        db.session.commit()
+        db.session.expunge_all()
+    return indexed
+
+
+def match_expression(search):
+    # Quote every term so user input can't inject FTS5 syntax; the last term is a
+    # prefix so results update as the user types
+    terms = re.findall(r'\w+', search)
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
+
+def matches(search):
+    # Subquery of (note_id, rank) for notes matching `search`; lower rank is better
+    expression = match_expression(search)
+    if expression is None:
+        return None
+    return db.session.query(
+        note_fts.c.rowid.label('note_id'),
+        func.bm25(_fts_ref).label('rank')
+    ).filter(_fts_ref.op('MATCH')(expression)).subquery()
+
+
+def snippets(search, note_ids):
+    expression = match_expression(search)
+    if expression is None or not note_ids:
+        return {}
+    rows = db.session.query(
+        note_fts.c.rowid,
+        func.snippet(_fts_ref, -1, _MATCH_START, _MATCH_END, '…', 16)
+    ).filter(_fts_ref.op('MATCH')(expression), note_fts.c.rowid.in_(note_ids)).all()
+    return {row[0]: highlight(row[1]) for row in rows}
+
+
+def highlight(snippet):
+    if snippet is None:
+        return None
+    return html.escape(snippet).replace(_MATCH_START, '<mark>').replace(_MATCH_END, '</mark>')
@@ -0,0 +1,203 @@
+import copy
+from src.services.blocks import key_between
+
+# Operational transformation for collaborative editing of block-format notes. This
+# module is pure (no database), so the server in collab.py and any number of
+# simulated clients run the same code.
+#
+# Ops address blocks by their stable id:
+#   {"op": "insert", "id": id, "after": id|None, "block": {...}}   None = at the start
+#   {"op": "move", "id": id, "after": id|None}
+#   {"op": "delete", "id": id}
+#   {"op": "set", "id": id, "attrs": {key: value|None}}          None removes the key
+#   {"op": "text", "id": id, "field": key, "pos": n, "insert": s}
+#   {"op": "text", "id": id, "field": key, "pos": n, "delete": n}
+# The server resolves `after` into a `position` key before logging an op, so every
+# op a client receives places blocks by key and block order is simply key order.
+# Text positions count code points.
+
+
+def transform(op, against, against_first):
+    # `op` rewritten to apply after `against`, both written against the same state;
+    # `against_first` says which of the two the server ordered first. Returns a list
+    # because a delete can split around a concurrent insert or vanish entirely.
+    kind, other = op['op'], against['op']
+    if op.get('id') != against.get('id'):
+        return [op]
+    if other == 'delete':
+        return []
+    if kind == 'move' and other == 'move':
+        # Last move wins
+        return [op] if against_first else []
+    if kind == 'set' and other == 'set':
+        if against_first:
+            return [op]
+        attrs = {key: value for key, value in op['attrs'].items() if key not in against['attrs']}
+        return [dict(op, attrs=attrs)] if attrs else []
+    if kind == 'text' and other == 'set':
+        # Replacing the whole field wins over edits inside it
+        return [] if op['field'] in against['attrs'] else [op]
+    if kind == 'text' and other == 'text' and op['field'] == against['field']:
+        return _transform_text(op, against, against_first)
+    return [op]
+
+
+def _transform_text(op, against, against_first):
+    pos = op['pos']
+    if 'insert' in against:
+        at, length = against['pos'], len(against['insert'])
+        if 'insert' in op:
+            if at < pos or (at == pos and against_first):
+                return [dict(op, pos=pos + length)]
+            return [op]
+        count = op['delete']
+        if at <= pos:
+            return [dict(op, pos=pos + length)]
+        if at < pos + count:
+            # Keep the concurrently inserted text: delete around it
+            before = at - pos
+            return [dict(op, delete=before), dict(op, pos=pos + length, delete=count - before)]
+        return [op]
+
+    at, length = against['pos'], against['delete']
+    if 'insert' in op:
+        if pos <= at:
+            return [op]
+        return [dict(op, pos=max(at, pos - length))]
+
+    count = op['delete']
+    end, other_end = pos + count, at + length
+    remaining = max(0, min(end, at) - pos) + max(0, end - max(pos, other_end))
+    if remaining == 0:
+        return []
+    return [dict(op, pos=pos if pos <= at else max(at, pos - length), delete=remaining)]
+
+
+def transform_lists(ops, against, against_first):
+    # Transforms two concurrent op lists past each other: returns (ops applied after
+    # `against`, `against` applied after ops)
+    if not ops or not against:
+        return list(ops), list(against)
+    if len(ops) == 1 and len(against) == 1:
+        return (transform(ops[0], against[0], against_first),
+                transform(against[0], ops[0], not against_first))
+    if len(ops) > 1:
+        head, against = transform_lists(ops[:1], against, against_first)
+        tail, against = transform_lists(ops[1:], against, against_first)
+        return head + tail, against
+    ops, head = transform_lists(ops, against[:1], against_first)
+    ops, tail = transform_lists(ops, against[1:], against_first)
+    return ops, head + tail
+
+
+def splice(value, op):
+    # Applies a text op to a string, raising ValueError when it doesn't fit
+    value = value if isinstance(value, str) else ''
+    pos = op['pos']
+    if 'insert' in op:
+        if not 0 <= pos <= len(value):
+            raise ValueError(f'Text position {pos} out of range')
+        return value[:pos] + op['insert'] + value[pos:]
+    if not (0 <= pos and pos + op['delete'] <= len(value)):
+        raise ValueError(f'Text range {pos}+{op["delete"]} out of range')
+    return value[:pos] + value[pos + op['delete']:]
+
+
+def set_attrs(data, attrs):
+    for key, value in attrs.items():
+        if value is None:
+            data.pop(key, None)
+        else:
+            data[key] = value
+
+
+class Document:
+    # In-memory block document: id -> (position, data), ordered by (position, id)
+
+    def __init__(self, blocks=None):
+        self.blocks = {}
+        for block in blocks or []:
+            block = dict(block)
+            block_id, position = block.pop('id'), block.pop('position')
+            self.blocks[block_id] = (position, block)
+
+    def ordered_ids(self):
+        return sorted(self.blocks, key=lambda block_id: (self.blocks[block_id][0], block_id))
+
+    def to_list(self):
+        return [dict(self.blocks[block_id][1], id=block_id) for block_id in self.ordered_ids()]
+
+    def position_after(self, block_id):
+        # Local keys of unacknowledged inserts can tie with other keys, so skip ties
+        before = self.blocks[block_id][0] if block_id is not None else None
+        later = [position for position, _ in self.blocks.values() if before is None or position > before]
+        return key_between(before, min(later) if later else None)
+
+    def apply(self, op):
+        # Applies an op in server form (placed by `position`); ops on missing blocks are no-ops
+        kind, block_id = op['op'], op['id']
+        if kind == 'insert':
+            self.blocks[block_id] = (op['position'], copy.deepcopy(op['block']))
+            return
+        if block_id not in self.blocks:
+            return
+        position, data = self.blocks[block_id]
+        if kind == 'delete':
+            del self.blocks[block_id]
+        elif kind == 'move':
+            self.blocks[block_id] = (op['position'], data)
+        elif kind == 'set':
+            set_attrs(data, op['attrs'])
+        elif kind == 'text':
+            data[op['field']] = splice(data.get(op['field']), op)
+
+
+class Client:
+    # Reference implementation of the client side of the protocol, used to drive the
+    # server with simulated editors. At most one batch is in flight; edits made
+    # meanwhile are buffered and sent once the server acknowledges it. Entries from
+    # the server are processed in version order: our own entry is the ack, anything
+    # else is transformed past our unacknowledged ops before it is applied.
+
+    def __init__(self, client_id, blocks, version):
+        self.client_id = client_id
+        self.document = Document(blocks)
+        self.version = version
+        self.inflight = None
+        self.buffer = []
+
+    def edit(self, op):
+        op = copy.deepcopy(op)
+        local = dict(op)
+        if op['op'] in ('insert', 'move'):
+            if op['op'] == 'move' and op['id'] not in self.document.blocks:
+                return
+            local['position'] = self.document.position_after(op.get('after'))
+        self.document.apply(local)
+        self.buffer.append(op)
+
+    def flush(self):
+        # The next batch to send, or None
+        if self.inflight is not None or not self.buffer:
+            return None
+        self.inflight, self.buffer = self.buffer, []
+        return {'client_id': self.client_id, 'version': self.version, 'ops': self.inflight}
+
+    def receive(self, entry):
+        self.version = entry['version']
+        if entry['client_id'] == self.client_id and self.inflight is not None:
+            # Our batch as the server applied it; adopt the keys it chose
+            pending = {op['id'] for op in self.buffer if op['op'] in ('insert', 'move')}
+            for op in entry['ops']:
+                if op['op'] in ('insert', 'move') and op['id'] not in pending:
+                    self.document.apply({'op': 'move', 'id': op['id'], 'position': op['position']})
+            self.inflight = None
+            return
+
+        ops = entry['ops']
+        if self.inflight:
+            ops, self.inflight = transform_lists(ops, self.inflight, False)
+        if self.buffer:
+            ops, self.buffer = transform_lists(ops, self.buffer, False)
+        for op in ops:
+            self.document.apply(op)
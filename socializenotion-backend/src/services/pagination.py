@@ -0,0 +1,123 @@
+import base64
+import json
+import math
+import time
+from datetime import datetime
+from flask import request
+from sqlalchemy import desc, tuple_
+
+DEFAULT_PER_PAGE = 20
+MAX_PER_PAGE = 100
+
+# totals=exact runs COUNT(*) every time, totals=approx reuses a recent count for the
+# same query, totals=none skips counting altogether.
+TOTALS_MODES = ('exact', 'approx', 'none')
+APPROX_TOTAL_TTL = 60  # seconds
+APPROX_TOTAL_MAX_ENTRIES = 10000
+
+_approx_totals = {}
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class Page:
+    def __init__(self, items, pagination):
+        self.items = items
+        self.pagination = pagination
+
+
+def encode_cursor(sort_value, id_value):
+    if isinstance(sort_value, datetime):
+        sort_value = sort_value.isoformat()
+    payload = json.dumps([sort_value, id_value], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        sort_value, id_value = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if isinstance(sort_value, str):
+            sort_value = datetime.fromisoformat(sort_value)
+        return sort_value, int(id_value)
+    except (ValueError, TypeError):
+        raise InvalidCursor('Invalid cursor')
+
+
+def _count(query, mode):
+    if mode == 'none':
+        return None
+
+    count_query = query.order_by(None)
+    if mode == 'exact':
+        return count_query.count()
+
+    statement = count_query.statement
+    key = (str(statement), repr(sorted(statement.compile().params.items())))
+    now = time.monotonic()
+    cached = _approx_totals.get(key)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    total = count_query.count()
+    if len(_approx_totals) >= APPROX_TOTAL_MAX_ENTRIES:
+        _approx_totals.clear()
+    _approx_totals[key] = (now + APPROX_TOTAL_TTL, total)
+    return total
+
+
+def paginate(query, order_by, per_page=DEFAULT_PER_PAGE):
+    # Pages `query` newest first by the (sort_column, id_column) pair in `order_by`.
+    #
+    # Without a `cursor` argument this keeps the old page/per_page behaviour and the
+    # legacy pagination dict. With `cursor` (empty for the first page) it switches to
+    # keyset mode: no OFFSET, and no COUNT(*) unless `totals` asks for one. Both modes
+    # return `next_cursor` so clients can move over to keyset paging mid-scroll.
+    sort_column, id_column = order_by
+    per_page = min(max(request.args.get('per_page', per_page, type=int), 1), MAX_PER_PAGE)
+    cursor = request.args.get('cursor')
+    totals = request.args.get('totals', 'none' if cursor is not None else 'exact')
+    if totals not in TOTALS_MODES:
+        totals = 'exact'
+
+    ordered = query.add_columns(sort_column, id_column)\
+                   .order_by(desc(sort_column), desc(id_column))
+
+    if cursor is not None:
+        page = None
+        if cursor:
+            ordered = ordered.filter(tuple_(sort_column, id_column) < tuple_(*decode_cursor(cursor)))
+    else:
+        page = max(request.args.get('page', 1, type=int), 1)
+        ordered = ordered.offset((page - 1) * per_page)
+
+    rows = ordered.limit(per_page + 1).all()
+    has_next = len(rows) > per_page
+    rows = rows[:per_page]
+
+    next_cursor = None
+    if has_next:
+        next_cursor = encode_cursor(rows[-1][-2], rows[-1][-1])
+
+    total = _count(query, totals)
+    items = [row[0] for row in rows]
+
+    if page is None:
+        return Page(items, {
+            'per_page': per_page,
+            'total': total,
+            'has_next': has_next,
+            'next_cursor': next_cursor
+        })
+
+    return Page(items, {
+        'page': page,
+        'pages': math.ceil(total / per_page) if total is not None else None,
+        'per_page': per_page,
+        'total': total,
+        'has_next': has_next,
+        'has_prev': page > 1,
+        'next_cursor': next_cursor
+    })
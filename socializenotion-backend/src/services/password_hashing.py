@@ -0,0 +1,165 @@
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.security import generate_password_hash, check_password_hash
+
+# Password hashing off the request threads. Hashes run in a small process pool, so
+# a burst of logins costs at most PASSWORD_HASH_WORKERS cores while feed reads keep
+# theirs. At most PASSWORD_HASH_MAX_QUEUE hashes may be running or waiting; past
+# that callers get PasswordHasherBusy, which the auth routes turn into a 503 with
+# Retry-After. A hash counts against the bound until the pool is done with it, not
+# until its caller stops waiting. A pool broken by a dead worker is replaced on the
+# next hash. PASSWORD_HASH_WORKERS = 0 hashes inline, as before.
+#
+# PASSWORD_HASH_METHOD is any Werkzeug method string ('scrypt:32768:8:1',
+# 'pbkdf2:sha256:1000000', ...). Hashes made with other parameters still verify,
+# and needs_rehash() tells login to replace them.
+
+OPERATIONS = ('hash', 'verify')
+
+
+class PasswordHasherBusy(Exception):
+
+    def __init__(self, retry_after):
+        super().__init__('Too many sign-ins right now, please retry shortly')
+        self.retry_after = retry_after
+
+
+def _timed(fn, *args):
+    # Runs in the worker; returns the result and the seconds spent hashing
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - started
+
+
+class PasswordHasher:
+
+    def __init__(self):
+        self.method = 'scrypt'
+        self.workers = 2
+        self.max_queue = 8
+        self.timeout = 30
+        self.retry_after = 1
+        self._prefix = None
+        self._pool = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._peak = 0
+        self._rejected = 0
+        self._metrics = {op: {'count': 0, 'hash_seconds': 0.0, 'wait_seconds': 0.0, 'max_seconds': 0.0}
+                         for op in OPERATIONS}
+
+    def init_app(self, app):
+        self.method = app.config.get('PASSWORD_HASH_METHOD', self.method)
+        self.workers = app.config.get('PASSWORD_HASH_WORKERS', self.workers)
+        self.max_queue = app.config.get('PASSWORD_HASH_MAX_QUEUE', self.workers * 4)
+        self.timeout = app.config.get('PASSWORD_HASH_TIMEOUT', self.timeout)
+        self.retry_after = app.config.get('PASSWORD_HASH_RETRY_AFTER', self.retry_after)
+        self._prefix = None
+
+    def _executor(self):
+        # Started on first use so CLI commands and migrations never fork. Fork, where
+        # available, keeps workers from re-importing the app the way spawn would.
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    methods = multiprocessing.get_all_start_methods()
+                    context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+                    self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+        return self._pool
+
+    def _discard(self, pool):
+        # Drops a broken pool so the next hash starts a new one
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _release(self, future=None):
+        with self._lock:
+            self._in_flight -= 1
+
+    def _shed(self):
+        with self._lock:
+            self._rejected += 1
+        return PasswordHasherBusy(self.retry_after)
+
+    def _run(self, op, fn, *args):
+        started = time.perf_counter()
+        if not self.workers:
+            result, hash_seconds = _timed(fn, *args)
+        else:
+            with self._lock:
+                if self._in_flight >= self.max_queue:
+                    self._rejected += 1
+                    raise PasswordHasherBusy(self.retry_after)
+                self._in_flight += 1
+                self._peak = max(self._peak, self._in_flight)
+            pool = self._executor()
+            try:
+                future = pool.submit(_timed, fn, *args)
+            except RuntimeError:
+                # Broken, or shut down by another thread that found it broken
+                self._release()
+                self._discard(pool)
+                raise self._shed()
+            # The slot is freed when the pool finishes or drops the hash
+            future.add_done_callback(self._release)
+            try:
+                result, hash_seconds = future.result(timeout=self.timeout)
+            except FutureTimeoutError:
+                # The pool is backed up beyond what queue depth shows; shed the request
+                # and take the hash out of the queue if no worker has started it
+                future.cancel()
+                raise self._shed()
+            except BrokenProcessPool:
+                self._discard(pool)
+                raise self._shed()
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            metrics = self._metrics[op]
+            metrics['count'] += 1
+            metrics['hash_seconds'] += hash_seconds
+            metrics['wait_seconds'] += max(elapsed - hash_seconds, 0.0)
+            metrics['max_seconds'] = max(metrics['max_seconds'], elapsed)
+        return result
+
+    def hash(self, password):
+        return self._run('hash', generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        return self._run('verify', check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        # True when `pwhash` was made with other parameters than the configured ones
+        if self._prefix is None:
+            # Werkzeug expands shorthand methods ('scrypt') to their full parameters,
+            # so take the prefix from a real hash of the configured method
+            self._prefix = generate_password_hash('', self.method).split('$', 1)[0]
+        return pwhash.split('$', 1)[0] != self._prefix
+
+    def stats(self):
+        with self._lock:
+            operations = {}
+            for op, metrics in self._metrics.items():
+                count = metrics['count']
+                operations[op] = {
+                    'count': count,
+                    'avg_hash_ms': round(metrics['hash_seconds'] / count * 1000, 2) if count else None,
+                    'avg_wait_ms': round(metrics['wait_seconds'] / count * 1000, 2) if count else None,
+                    'max_ms': round(metrics['max_seconds'] * 1000, 2),
+                }
+            return {
+                'method': self.method,
+                'workers': self.workers,
+                'max_queue': self.max_queue,
+                'queue_depth': self._in_flight,
+                'peak_queue_depth': self._peak,
+                'rejected': self._rejected,
+                'operations': operations,
+            }
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,105 @@
+from src.models.user import db, Note, Folder, FolderClosure, FolderGrant, Collaboration
+from sqlalchemy import select, union, union_all, case, func, literal
+
+# Effective permissions on notes. A user's level on a note is the highest of owning
+# it, a Collaboration on the note, a FolderGrant on its folder or any folder above
+# it, and 'public' when the note is public. Folder grants reach down the hierarchy
+# through FolderClosure. levels() resolves a whole page of notes in one query;
+# shared_note_ids() is the matching subquery for list filters.
+
+LEVELS = ('public', 'view', 'edit', 'admin', 'owner')
+GRANT_LEVELS = ('view', 'edit', 'admin')
+RANK = {level: rank for rank, level in enumerate(LEVELS)}
+
+
+def at_least(level, minimum):
+    return level is not None and RANK[level] >= RANK[minimum]
+
+
+def _rank(column):
+    return case({level: RANK[level] for level in GRANT_LEVELS}, value=column, else_=-1)
+
+
+def levels(user_id, note_ids):
+    # {note_id: level} for the notes in `note_ids` the user can see at all
+    note_ids = list(note_ids)
+    if not note_ids:
+        return {}
+
+    candidates = union_all(
+        select(Note.id.label('note_id'), literal(RANK['owner']).label('rank'))
+        .where(Note.id.in_(note_ids), Note.user_id == user_id),
+        select(Note.id, literal(RANK['public']))
+        .where(Note.id.in_(note_ids), Note.is_public.is_(True)),
+        select(Collaboration.note_id, _rank(Collaboration.permission_level))
+        .where(Collaboration.note_id.in_(note_ids), Collaboration.user_id == user_id),
+        select(Note.id, _rank(FolderGrant.permission_level))
+        .join(FolderClosure, FolderClosure.descendant_id == Note.folder_id)
+        .join(FolderGrant, FolderGrant.folder_id == FolderClosure.ancestor_id)
+        .where(Note.id.in_(note_ids), FolderGrant.user_id == user_id)
+    ).subquery()
+
+    rows = db.session.query(candidates.c.note_id, func.max(candidates.c.rank))\
+                     .group_by(candidates.c.note_id).all()
+    return {note_id: LEVELS[rank] for note_id, rank in rows if rank >= 0}
+
+
+def level_rank(user_id):
+    # The user's rank on each Note row of an enclosing query, -1 for none; a
+    # correlated form of levels() for aggregates over a whole note list
+    collaboration = select(func.max(_rank(Collaboration.permission_level)))\
+        .where(Collaboration.note_id == Note.id, Collaboration.user_id == user_id)\
+        .scalar_subquery()
+    granted = select(func.max(_rank(FolderGrant.permission_level)))\
+        .join(FolderClosure, FolderClosure.ancestor_id == FolderGrant.folder_id)\
+        .where(FolderClosure.descendant_id == Note.folder_id, FolderGrant.user_id == user_id)\
+        .scalar_subquery()
+    return func.max(
+        case((Note.user_id == user_id, RANK['owner']), else_=-1),
+        case((Note.is_public.is_(True), RANK['public']), else_=-1),
+        func.coalesce(collaboration, -1),
+        func.coalesce(granted, -1)
+    )
+
+
+def level(user_id, note_id):
+    return levels(user_id, [note_id]).get(note_id)
+
+
+def folder_level(user_id, folder_id):
+    # Level on a folder itself: 'owner' or the highest grant on it or above it
+    candidates = union_all(
+        select(literal(RANK['owner']).label('rank')).where(Folder.id == folder_id, Folder.user_id == user_id),
+        select(_rank(FolderGrant.permission_level))
+        .join(FolderClosure, FolderClosure.ancestor_id == FolderGrant.folder_id)
+        .where(FolderClosure.descendant_id == folder_id, FolderGrant.user_id == user_id)
+    ).subquery()
+
+    rank = db.session.query(func.max(candidates.c.rank)).scalar()
+    return LEVELS[rank] if rank is not None and rank >= 0 else None
+
+
+def folder_grants(folder_id):
+    # Grants that reach a folder: its own and those on every folder above it
+    ancestors = select(FolderClosure.ancestor_id).where(FolderClosure.descendant_id == folder_id)
+    return FolderGrant.query.filter(FolderGrant.folder_id.in_(ancestors))\
+                            .order_by(FolderGrant.folder_id, FolderGrant.id).all()
+
+
+def _shared_selects(user_id):
+    granted = select(FolderClosure.descendant_id)\
+        .join(FolderGrant, FolderGrant.folder_id == FolderClosure.ancestor_id)\
+        .where(FolderGrant.user_id == user_id)
+    return [
+        select(Collaboration.note_id).where(Collaboration.user_id == user_id),
+        select(Note.id).where(Note.folder_id.in_(granted))
+    ]
+
+
+def shared_note_ids(user_id):
+    # Notes shared with the user directly or through a granted folder's subtree
+    return union(*_shared_selects(user_id))
+
+
+def accessible_note_ids(user_id):
+    return union(select(Note.id).where(Note.user_id == user_id), *_shared_selects(user_id))
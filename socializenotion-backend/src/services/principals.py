@@ -0,0 +1,188 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from src.services.cache import entity_cache
+
+# Verified bearer tokens mapped to the few user columns nearly every handler needs,
+# so token_required skips both jwt.decode and the user query on a hit. Entries live
+# until the token expires or PRINCIPAL_CACHE_TTL passes, whichever is first.
+# Commits that change or delete a user (token_version bumps, profile edits) and
+# session revocations drop that user's entries here and bump the user's revocation
+# stamp in the entity cache backend; every hit compares the stamp it was cached
+# under with the current one, so with the shared sqlite backend a revocation made
+# in one worker takes effect in all of them on their next request.
+
+
+class Principal:
+    # What token_required passes to handlers. id, username, token_version and the
+    # token's session come from the cache; anything else loads the User row once per request and is
+    # read from it, so handlers that only use the id never touch the user table.
+    # Writes go through `user`.
+
+    __slots__ = ('id', 'username', 'token_version', 'session_id', '_user')
+
+    def __init__(self, user_id, username, token_version, session_id=None, user=None):
+        self.id = user_id
+        self.username = username
+        self.token_version = token_version
+        self.session_id = session_id
+        self._user = user
+
+    @property
+    def user(self):
+        if self._user is None:
+            from src.models.user import db, User
+            self._user = db.session.get(User, self.id)
+        return self._user
+
+    def __getattr__(self, name):
+        user = self.user
+        if user is None:
+            raise AttributeError(name)
+        return getattr(user, name)
+
+
+class PrincipalCache:
+
+    def __init__(self):
+        self.enabled = False  # until init_app finds a backend for revocation stamps
+        self.ttl = 60
+        self.max_entries = 10000
+        self._revocations = None  # entity cache backend holding the revocation stamps
+        self._entries = OrderedDict()
+        self._keys_by_user = defaultdict(set)
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def init_app(self, app):
+        self.enabled = app.config.get('PRINCIPAL_CACHE_ENABLED', True)
+        self.ttl = app.config.get('PRINCIPAL_CACHE_TTL', self.ttl)
+        self.max_entries = app.config.get('PRINCIPAL_CACHE_MAX_ENTRIES', self.max_entries)
+        # Without a backend there is no revocation stamp to check, so nothing is cached.
+        # The memory backend forgets a stamp two of its TTLs after the last bump, which
+        # entries never outlive.
+        self._revocations = entity_cache.backend
+        if self._revocations is None:
+            self.enabled = False
+        else:
+            self.ttl = min(self.ttl, self._revocations.ttl)
+
+    @staticmethod
+    def _key(token):
+        # Digest, so raw tokens are not kept in memory
+        return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+    @staticmethod
+    def _stamp_key(user_id):
+        return f'revoked:{user_id}'
+
+    def stamp(self, user_id):
+        # The user's current revocation stamp; read it before checking the token
+        # against the database and pass it to put()
+        if not self.enabled:
+            return None
+        return self._revocations.get_version(self._stamp_key(user_id))
+
+    def get(self, token):
+        # A fresh Principal for a cached token, or None on a miss, an expired entry or
+        # one cached before the user's last revocation
+        if not self.enabled:
+            return None
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.time():
+                self._drop(key)
+                entry = None
+        if entry is not None and self.stamp(entry[1][0]) != entry[2]:
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    self._drop(key)
+            entry = None
+        with self._lock:
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+        return Principal(*entry[1])
+
+    def put(self, token, principal, expires_at, stamp):
+        # `expires_at` is the token's exp claim (seconds since the epoch), if any;
+        # `stamp` is what stamp() returned before the token was checked
+        if not self.enabled:
+            return
+        key = self._key(token)
+        expires = time.time() + self.ttl
+        if expires_at is not None:
+            expires = min(expires, expires_at)
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = (
+                expires,
+                (principal.id, principal.username, principal.token_version, principal.session_id),
+                stamp
+            )
+            self._keys_by_user[principal.id].add(key)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            user_id = entry[1][0]
+            keys = self._keys_by_user.get(user_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_user[user_id]
+
+    def invalidate(self, *user_ids):
+        # Call after the commit that revoked or changed the users
+        with self._lock:
+            for user_id in user_ids:
+                for key in list(self._keys_by_user.get(user_id, ())):
+                    self._drop(key)
+                self._stats['invalidations'] += 1
+        if self._revocations is not None:
+            for user_id in user_ids:
+                self._revocations.bump_version(self._stamp_key(user_id))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_user.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            return dict(self._stats, entries=len(self._entries), enabled=self.enabled,
+                        hit_rate=round(self._stats['hits'] / lookups, 4) if lookups else None)
+
+
+principal_cache = PrincipalCache()
+
+
+@event.listens_for(Session, 'after_flush')
+def _stage_changed_users(session, flush_context):
+    from src.models.user import User
+    changed = [obj.id for obj in session.deleted if isinstance(obj, User)]
+    changed += [obj.id for obj in session.dirty if isinstance(obj, User) and session.is_modified(obj)]
+    if changed:
+        session.info.setdefault('changed_users', set()).update(changed)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_committed_users(session):
+    changed = session.info.pop('changed_users', None)
+    if changed:
+        principal_cache.invalidate(*changed)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _drop_rolled_back_users(session, previous_transaction):
+    session.info.pop('changed_users', None)
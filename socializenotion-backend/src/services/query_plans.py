@@ -0,0 +1,181 @@
+import json
+import re
+from flask import Flask
+from sqlalchemy import event
+from src.models.user import db
+from src.services import migrations
+
+# Runs every GET route of the API against a scratch database, records EXPLAIN QUERY
+# PLAN for each SELECT it issues, and reports full scans of tables that grow with
+# the user base, and every route that answers with an unexpected status (one that
+# fails early may never run the queries it is meant to check). Used by
+# `flask --app src.main check-query-plans` and tests/test_query_plans.py, which
+# fail on either.
+
+LARGE_TABLES = {
+    'user', 'post', 'note', 'comment', 'follow', 'like', 'collaboration',
+    'notification', 'feed_entry', 'note_tag', 'note_block',
+    'note_revision', 'note_op', 'folder_grant', 'folder_closure',
+    'user_suggestion', 'refresh_token', 'folder', 'tag'
+}
+
+# Known full scans, keyed by (route, table), with the reason they are tolerated
+KNOWN_SCANS = {}
+
+# Error statuses expected on the seeded data, keyed by (route, status), with the
+# reason; every other request must answer 2xx or 304
+EXPECTED_STATUSES = {
+    ('/api/notes/{note_id}/ops', 400): 'needs ?since=, which EXTRA_REQUESTS sends',
+}
+
+# Extra query-string variants on top of the bare routes
+EXTRA_REQUESTS = [
+    '/api/posts?cursor=',
+    '/api/posts/{post_id}/comments?replies=3',
+    '/api/notes?search=seed',
+    '/api/notes?tag=seed',
+    '/api/notes?tags=seed,other&tag_mode=all',
+    '/api/notes?tags=seed,other&tag_mode=any',
+    '/api/notes?folder_id={folder_id}',
+    '/api/notes?folder_id={folder_id}&recursive=1',
+    '/api/notes/{note_id}/blocks?after=seed-1&limit=1',
+    '/api/notes/{note_id}/ops?since=0',
+    '/api/notes?fields=id,title&exclude=author',
+    '/api/posts?fields=caption,author',
+    '/api/users/search?q=seed',
+    '/api/users/autocomplete?q=s',
+    '/api/users/autocomplete?q=seed',
+]
+
+SCAN_PATTERN = re.compile(r'^SCAN (\w+)(?: AS \w+)?(.*)$')
+
+
+def is_full_scan(detail):
+    match = SCAN_PATTERN.match(detail)
+    if not match:
+        return None
+    table, rest = match.group(1), match.group(2)
+    if 'USING' in rest and 'INDEX' in rest:
+        return None
+    return table
+
+
+def seed(client):
+    def register(name):
+        response = client.post('/api/auth/register', json={
+            'username': name, 'email': f'{name}@example.com', 'password': 'seed-password'
+        })
+        data = response.get_json()
+        return {'Authorization': f"Bearer {data['token']}"}, data['user']['id']
+
+    owner_headers, owner_id = register('seedowner')
+    other_headers, other_id = register('seedother')
+    client.post(f'/api/users/{owner_id}/follow', headers=other_headers)
+    client.post(f'/api/users/{other_id}/follow', headers=owner_headers)
+
+    post_id = client.post('/api/posts', headers=owner_headers, json={
+        'content_type': 'text', 'caption': 'seed post'
+    }).get_json()['post']['id']
+    client.post(f'/api/posts/{post_id}/like', headers=other_headers)
+    comment_id = client.post(f'/api/posts/{post_id}/comments', headers=other_headers, json={
+        'content': 'seed comment'
+    }).get_json()['comment']['id']
+    client.post(f'/api/posts/{post_id}/comments', headers=owner_headers, json={
+        'content': 'seed reply', 'parent_id': comment_id
+    })
+
+    folder_id = client.post('/api/folders', headers=owner_headers, json={
+        'name': 'seed folder'
+    }).get_json()['folder']['id']
+    note_id = client.post('/api/notes', headers=owner_headers, json={
+        'title': 'seed note', 'tags': ['seed'], 'folder_id': folder_id, 'content_format': 'blocks',
+        'content': json.dumps({'blocks': [
+            {'id': 'seed-1', 'type': 'paragraph', 'text': 'seed content'},
+            {'id': 'seed-2', 'type': 'paragraph', 'text': 'more seed content'},
+        ]})
+    }).get_json()['note']['id']
+    client.post(f'/api/notes/{note_id}/collaborate', headers=owner_headers, json={
+        'username': 'seedother', 'permission_level': 'edit'
+    })
+    client.post(f'/api/folders/{folder_id}/collaborate', headers=owner_headers, json={
+        'username': 'seedother', 'permission_level': 'view'
+    })
+
+    ids = {
+        'user_id': other_id, 'post_id': post_id, 'comment_id': comment_id,
+        'folder_id': folder_id, 'note_id': note_id, 'number': 1
+    }
+    return owner_headers, ids
+
+
+def route_urls(app, ids):
+    urls = []
+    for rule in app.url_map.iter_rules():
+        if 'GET' not in rule.methods or not rule.rule.startswith('/api/'):
+            continue
+        if any(arg not in ids for arg in rule.arguments):
+            continue
+        urls.append(re.sub(r'<(?:\w+:)?(\w+)>', lambda m: str(ids[m.group(1)]), rule.rule))
+    urls.extend(url.format(**ids) for url in EXTRA_REQUESTS)
+    return urls
+
+
+def expected_status(url, status, ids):
+    if 200 <= status < 300 or status == 304:
+        return True
+    path = url.split('?')[0]
+    return any(path == known_path.format(**ids) and status == known_status
+               for known_path, known_status in EXPECTED_STATUSES)
+
+
+def check(blueprints):
+    # `blueprints` is a list of (blueprint, url_prefix) pairs to mount on the scratch app.
+    # Returns (plans, full scans, [(url, status)] for routes with unexpected statuses).
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['TESTING'] = True
+    for blueprint, url_prefix in blueprints:
+        app.register_blueprint(blueprint, url_prefix=url_prefix)
+    db.init_app(app)
+
+    plans = []
+    failures = []
+    current = {'route': None}
+
+    with app.app_context():
+        migrations.upgrade()
+        client = app.test_client()
+        headers, ids = seed(client)
+
+        def explain(conn, cursor, statement, parameters, context, executemany):
+            if current['route'] is None or executemany:
+                return
+            if not statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+                return
+            raw = cursor.connection
+            for row in raw.execute('EXPLAIN QUERY PLAN ' + statement, parameters or ()):
+                plans.append((current['route'], row[-1], statement))
+
+        event.listen(db.engine, 'before_cursor_execute', explain)
+        try:
+            for url in route_urls(app, ids):
+                current['route'] = url
+                status = client.get(url, headers=headers).status_code
+                if not expected_status(url, status, ids):
+                    failures.append((url, status))
+        finally:
+            current['route'] = None
+            event.remove(db.engine, 'before_cursor_execute', explain)
+
+    violations = []
+    for route, detail, statement in plans:
+        table = is_full_scan(detail)
+        if table not in LARGE_TABLES:
+            continue
+        path = route.split('?')[0]
+        if any(path == known_path.format(**ids) and table == known_table
+               for known_path, known_table in KNOWN_SCANS):
+            continue
+        violations.append((route, detail, statement))
+    return plans, violations, failures
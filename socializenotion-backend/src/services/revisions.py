@@ -0,0 +1,204 @@
+import json
+import re
+from datetime import datetime, timedelta
+from difflib import SequenceMatcher
+from src.models.user import db, Note, NoteRevision
+from sqlalchemy.orm import selectinload
+
+# Note revision history. Every SNAPSHOT_INTERVAL-th revision stores the full content
+# and the ones in between store token-level edits against the revision before them,
+# so rebuilding any revision replays at most SNAPSHOT_INTERVAL - 1 deltas. Saves by
+# the same user within COALESCE_WINDOW are folded into their latest revision.
+
+SNAPSHOT_INTERVAL = 20
+COALESCE_WINDOW = timedelta(minutes=2)
+MAX_COALESCE_SPAN = timedelta(minutes=15)
+
+# Compaction keeps every revision for KEEP_ALL, then the last one per day until
+# KEEP_DAILY, then the last one per ISO week
+KEEP_ALL = timedelta(days=7)
+KEEP_DAILY = timedelta(days=90)
+
+# Tokens end at newlines, commas and closing braces, which lines up with fields and
+# blocks in the single-line JSON the editor saves as well as with plain text lines
+TOKEN_PATTERN = re.compile(r'[^\n,}]*[\n,}]|[^\n,}]+')
+
+
+def tokenize(content):
+    return TOKEN_PATTERN.findall(content or '')
+
+
+def make_delta(base, target):
+    base_tokens, target_tokens = tokenize(base), tokenize(target)
+    matcher = SequenceMatcher(None, base_tokens, target_tokens)
+    edits = [
+        [i1, i2, ''.join(target_tokens[j1:j2])]
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != 'equal'
+    ]
+    return json.dumps(edits, separators=(',', ':'))
+
+
+def apply_delta(base, delta):
+    tokens = tokenize(base)
+    parts = []
+    position = 0
+    for start, end, text in json.loads(delta):
+        parts.extend(tokens[position:start])
+        parts.append(text)
+        position = end
+    parts.extend(tokens[position:])
+    return ''.join(parts)
+
+
+def _replay(note_id, number):
+    # [(revision, content)] from the nearest snapshot up to revision `number`
+    snapshot = NoteRevision.query.filter(
+        NoteRevision.note_id == note_id,
+        NoteRevision.number <= number,
+        NoteRevision.kind == 'snapshot'
+    ).order_by(NoteRevision.number.desc()).first()
+    chain = NoteRevision.query.filter(
+        NoteRevision.note_id == note_id,
+        NoteRevision.number >= snapshot.number,
+        NoteRevision.number <= number
+    ).order_by(NoteRevision.number).all()
+
+    replayed = []
+    content = None
+    for revision in chain:
+        data = revision.get_data()
+        content = data if revision.kind == 'snapshot' else apply_delta(content, data)
+        replayed.append((revision, content))
+    return replayed
+
+
+def content_at(revision):
+    return _replay(revision.note_id, revision.number)[-1][1]
+
+
+def latest(note_id):
+    return NoteRevision.query.filter_by(note_id=note_id).order_by(NoteRevision.number.desc()).first()
+
+
+def record(note, user_id, force_new=False, now=None):
+    # Call after the note's title/content changed and before commit
+    now = now or datetime.utcnow()
+    content = note.get_content() or ''
+    current = latest(note.id)
+    if current is None:
+        revision = NoteRevision(note_id=note.id, number=1, user_id=user_id, title=note.title,
+                                kind='snapshot', data=content, created_at=now, updated_at=now)
+        db.session.add(revision)
+        return revision
+
+    replayed = _replay(note.id, current.number)
+    if current.title == note.title and replayed[-1][1] == content:
+        return None
+
+    coalesce = (
+        not force_new and
+        current.user_id == user_id and
+        now - current.updated_at <= COALESCE_WINDOW and
+        now - current.created_at <= MAX_COALESCE_SPAN
+    )
+    if coalesce:
+        current.data = content if current.kind == 'snapshot' else make_delta(replayed[-2][1], content)
+        current.title = note.title
+        current.updated_at = now
+        return current
+
+    # replayed[0] is the latest snapshot, so this counts the deltas stacked on it
+    snapshot = len(replayed) >= SNAPSHOT_INTERVAL
+    revision = NoteRevision(
+        note_id=note.id,
+        number=current.number + 1,
+        user_id=user_id,
+        title=note.title,
+        kind='snapshot' if snapshot else 'delta',
+        data=content if snapshot else make_delta(replayed[-1][1], content),
+        created_at=now,
+        updated_at=now
+    )
+    db.session.add(revision)
+    return revision
+
+
+def _bucket(revision, now):
+    age = now - revision.updated_at
+    if age <= KEEP_ALL:
+        return ('all', revision.number)
+    if age <= KEEP_DAILY:
+        return ('day', revision.updated_at.date())
+    return ('week', tuple(revision.updated_at.isocalendar())[:2])
+
+
+def compact_note(note_id, now=None):
+    # Drops thinned-out revisions and re-encodes the survivors as a fresh chain
+    now = now or datetime.utcnow()
+    rows = NoteRevision.query.filter_by(note_id=note_id).order_by(NoteRevision.number).all()
+
+    keep = {}
+    for revision in rows:
+        keep[_bucket(revision, now)] = revision.number
+    kept_numbers = set(keep.values())
+    if len(kept_numbers) == len(rows):
+        return 0
+
+    contents = {}
+    content = None
+    for revision in rows:
+        data = revision.get_data()
+        content = data if revision.kind == 'snapshot' else apply_delta(content, data)
+        if revision.number in kept_numbers:
+            contents[revision.number] = content
+
+    removed = 0
+    previous = None
+    since_snapshot = 0
+    for revision in rows:
+        if revision.number not in kept_numbers:
+            db.session.delete(revision)
+            removed += 1
+            continue
+        if previous is None or since_snapshot >= SNAPSHOT_INTERVAL - 1:
+            kind, data = 'snapshot', contents[revision.number]
+            since_snapshot = 0
+        else:
+            kind, data = 'delta', make_delta(previous, contents[revision.number])
+            since_snapshot += 1
+        if revision.kind != kind or revision.get_data() != data:
+            revision.kind, revision.data = kind, data
+        previous = contents[revision.number]
+    return removed
+
+
+def compact(now=None):
+    # Returns (notes compacted, revisions removed)
+    now = now or datetime.utcnow()
+    note_ids = [row[0] for row in db.session.query(NoteRevision.note_id)
+                                            .filter(NoteRevision.updated_at < now - KEEP_ALL)
+                                            .distinct().all()]
+    notes = 0
+    removed = 0
+    for note_id in note_ids:
+        count = compact_note(note_id, now)
+        db.session.commit()
+        if count:
+            notes += 1
+            removed += count
+    return notes, removed
+
+
+def backfill(batch_size=200):
+    # Baseline snapshot for notes written before revisions were recorded
+    last_id = 0
+    while True:
+        notes = Note.query.filter(Note.id > last_id).options(selectinload(Note.blocks))\
+                          .order_by(Note.id).limit(batch_size).all()
+        if not notes:
+            break
+        for note in notes:
+            if latest(note.id) is None:
+                record(note, note.user_id, now=note.updated_at or datetime.utcnow())
+        db.session.commit()
+        last_id = notes[-1].id
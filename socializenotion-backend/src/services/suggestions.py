@@ -0,0 +1,189 @@
+import math
+from datetime import datetime, timedelta
+from src.models.user import db, User, Follow, Note, Collaboration, UserSuggestion
+from sqlalchemy import select, delete, update, union, union_all, func, exists, tuple_, literal
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import aliased
+
+# "People you may know". Each user's best candidates are stored in UserSuggestion
+# with a score made of friends-of-friends overlap (followees who follow the
+# candidate), notes both users own or collaborate on, and a damped follower count.
+# refresh_user() recomputes one user's list; follow and unfollow adjust the mutual
+# counts of the rows they affect, so the discover page is one indexed read.
+
+MUTUAL_WEIGHT = 3.0
+SHARED_NOTE_WEIGHT = 2.0
+POPULARITY_WEIGHT = 1.0  # per power of ten followers
+
+MAX_SUGGESTIONS = 50
+CANDIDATE_POOL = 200  # candidates scored in full before the list is cut to MAX_SUGGESTIONS
+MAX_SOURCES = 500  # most recent followees walked for friends-of-friends
+POPULAR_CANDIDATES = 20  # most-followed users added so new accounts get suggestions
+EMPTY_RETRY = timedelta(hours=1)  # how long an empty list is trusted before recomputing it
+
+
+def popularity(followers_count):
+    return POPULARITY_WEIGHT * math.log10(1 + max(followers_count or 0, 0))
+
+
+def score(mutual_count, shared_notes_count, followers_count):
+    return MUTUAL_WEIGHT * mutual_count + SHARED_NOTE_WEIGHT * shared_notes_count + popularity(followers_count)
+
+
+def _mutual_counts(user_id):
+    # {candidate: followees of the user who follow them}
+    sources = select(Follow.following_id).where(Follow.follower_id == user_id)\
+        .order_by(Follow.id.desc()).limit(MAX_SOURCES)
+    rows = db.session.query(Follow.following_id, func.count(Follow.id))\
+                     .filter(Follow.follower_id.in_(sources))\
+                     .group_by(Follow.following_id).all()
+    return dict(rows)
+
+
+def _shared_note_counts(user_id):
+    # {candidate: notes the user and the candidate both own or collaborate on}
+    notes = union(
+        select(Note.id).where(Note.user_id == user_id),
+        select(Collaboration.note_id).where(Collaboration.user_id == user_id)
+    )
+    people = union_all(
+        select(Note.user_id.label('person_id'), Note.id.label('note_id')).where(Note.id.in_(notes)),
+        select(Collaboration.user_id, Collaboration.note_id).where(Collaboration.note_id.in_(notes))
+    ).subquery()
+    rows = db.session.query(people.c.person_id, func.count(func.distinct(people.c.note_id)))\
+                     .group_by(people.c.person_id).all()
+    return dict(rows)
+
+
+def refresh_user(user_id):
+    # Recomputes and replaces one user's suggestions; returns how many were stored
+    mutual = _mutual_counts(user_id)
+    shared = _shared_note_counts(user_id)
+    popular = db.session.query(User.id).order_by(User.followers_count.desc())\
+                        .limit(POPULAR_CANDIDATES).all()
+
+    excluded = {row[0] for row in db.session.query(Follow.following_id).filter(Follow.follower_id == user_id)}
+    excluded.add(user_id)
+    candidates = (set(mutual) | set(shared) | {row[0] for row in popular}) - excluded
+
+    # Popularity adds a few points at most, so the graph signals pick the pool
+    pool = sorted(candidates, key=lambda c: (-score(mutual.get(c, 0), shared.get(c, 0), 0), -c))[:CANDIDATE_POOL]
+    followers = dict(db.session.query(User.id, User.followers_count).filter(User.id.in_(pool)).all()) if pool else {}
+
+    now = datetime.utcnow()
+    rows = [{
+        'user_id': user_id,
+        'suggested_id': candidate,
+        'mutual_count': mutual.get(candidate, 0),
+        'shared_notes_count': shared.get(candidate, 0),
+        'score': score(mutual.get(candidate, 0), shared.get(candidate, 0), followers.get(candidate, 0)),
+        'updated_at': now,
+    } for candidate in pool if candidate in followers]
+    rows = sorted(rows, key=lambda row: (-row['score'], -row['suggested_id']))[:MAX_SUGGESTIONS]
+
+    db.session.execute(delete(UserSuggestion).where(UserSuggestion.user_id == user_id)
+                       .execution_options(synchronize_session=False))
+    if rows:
+        db.session.execute(insert(UserSuggestion), rows)
+    db.session.execute(update(User).where(User.id == user_id)
+                       .values(suggestions_refreshed_at=now, updated_at=User.updated_at)
+                       .execution_options(synchronize_session=False))
+    return len(rows)
+
+
+def needs_refresh(user_id):
+    # True when the user has no suggestions and they weren't computed within EMPTY_RETRY
+    if db.session.query(exists().where(UserSuggestion.user_id == user_id)).scalar():
+        return False
+    refreshed_at = db.session.query(User.suggestions_refreshed_at).filter(User.id == user_id).scalar()
+    return refreshed_at is None or refreshed_at < datetime.utcnow() - EMPTY_RETRY
+
+
+def rebuild_all(batch_size=200):
+    # Recomputes every user's suggestions, one batch of users per transaction
+    last_id = 0
+    stored = 0
+    while True:
+        user_ids = [row[0] for row in db.session.query(User.id).filter(User.id > last_id)
+                    .order_by(User.id).limit(batch_size)]
+        if not user_ids:
+            break
+        for user_id in user_ids:
+            stored += refresh_user(user_id)
+        db.session.commit()
+        last_id = user_ids[-1]
+    return stored
+
+
+def _trim(user_id):
+    keep = select(UserSuggestion.suggested_id).where(UserSuggestion.user_id == user_id)\
+        .order_by(UserSuggestion.score.desc(), UserSuggestion.suggested_id.desc()).limit(MAX_SUGGESTIONS)
+    db.session.execute(delete(UserSuggestion).where(
+        UserSuggestion.user_id == user_id, UserSuggestion.suggested_id.not_in(keep)
+    ).execution_options(synchronize_session=False))
+
+
+def _adjust_mutuals(suggested_id, via_id, delta):
+    # Suggestions of `suggested_id` to followers of `via_id` gain or lose a mutual.
+    # Walks the followers of `via_id` through ix_follow_following_created and updates
+    # their rows by primary key, instead of every row suggesting `suggested_id`.
+    followers = select(Follow.follower_id, literal(suggested_id)).where(Follow.following_id == via_id)
+    db.session.execute(update(UserSuggestion).where(
+        tuple_(UserSuggestion.user_id, UserSuggestion.suggested_id).in_(followers),
+        UserSuggestion.mutual_count + delta >= 0
+    ).values(
+        mutual_count=UserSuggestion.mutual_count + delta,
+        score=UserSuggestion.score + delta * MUTUAL_WEIGHT,
+        updated_at=datetime.utcnow()
+    ).execution_options(synchronize_session=False))
+
+
+def on_follow(follower_id, followee_id):
+    # Call in the transaction that creates the follow
+    db.session.execute(delete(UserSuggestion).where(
+        UserSuggestion.user_id == follower_id, UserSuggestion.suggested_id == followee_id
+    ).execution_options(synchronize_session=False))
+
+    # Whoever the new followee follows is one mutual closer for the follower
+    already = aliased(Follow)
+    candidates = db.session.query(User.id, User.followers_count)\
+        .join(Follow, Follow.following_id == User.id)\
+        .filter(Follow.follower_id == followee_id, User.id != follower_id,
+                ~exists().where(already.follower_id == follower_id, already.following_id == User.id))\
+        .limit(MAX_SOURCES).all()
+    if candidates:
+        now = datetime.utcnow()
+        statement = insert(UserSuggestion).values([{
+            'user_id': follower_id,
+            'suggested_id': candidate_id,
+            'mutual_count': 1,
+            'shared_notes_count': 0,
+            'score': score(1, 0, followers_count),
+            'updated_at': now,
+        } for candidate_id, followers_count in candidates])
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=['user_id', 'suggested_id'],
+            set_={
+                'mutual_count': UserSuggestion.mutual_count + 1,
+                'score': UserSuggestion.score + MUTUAL_WEIGHT,
+                'updated_at': now,
+            }
+        ))
+        _trim(follower_id)
+
+    # The follower's own followers now have one more mutual with the followee
+    _adjust_mutuals(followee_id, follower_id, 1)
+
+
+def on_unfollow(follower_id, followee_id):
+    # Call in the transaction that removes the follow
+    db.session.execute(update(UserSuggestion).where(
+        UserSuggestion.user_id == follower_id,
+        UserSuggestion.suggested_id.in_(select(Follow.following_id).where(Follow.follower_id == followee_id)),
+        UserSuggestion.mutual_count > 0
+    ).values(
+        mutual_count=UserSuggestion.mutual_count - 1,
+        score=UserSuggestion.score - MUTUAL_WEIGHT,
+        updated_at=datetime.utcnow()
+    ).execution_options(synchronize_session=False))
+    _adjust_mutuals(followee_id, follower_id, -1)
@@ -0,0 +1,85 @@
+from src.models.user import db, Note, Tag, NoteTag
+from src.services import permissions
+from sqlalchemy import select, insert, func, literal, union
+
+# Tags are normalized into per-owner Tag rows linked through NoteTag, indexed by
+# (user_id, name) and (tag_id, note_id). Note.tags keeps a comma-separated copy so
+# list responses don't need a join to render them.
+
+MAX_TAG_LENGTH = 100
+
+
+def normalize(names):
+    if isinstance(names, str):
+        names = names.split(',')
+    seen = []
+    for name in names or []:
+        name = str(name).replace(',', ' ').strip()[:MAX_TAG_LENGTH]
+        if name and name not in seen:
+            seen.append(name)
+    return seen
+
+
+def set_note_tags(note, names):
+    names = normalize(names)
+    note.tags = ','.join(names) if names else None
+
+    NoteTag.query.filter(NoteTag.note_id == note.id).delete(synchronize_session=False)
+    if not names:
+        return
+
+    db.session.execute(
+        insert(Tag).prefix_with('OR IGNORE'),
+        [{'user_id': note.user_id, 'name': name} for name in names]
+    )
+    tag_ids = select(Tag.id, note.id).where(Tag.user_id == note.user_id, Tag.name.in_(names))
+    db.session.execute(insert(NoteTag).from_select(['tag_id', 'note_id'], tag_ids))
+
+
+def visible_tag_ids(user_id, names):
+    # Tags named `names` owned by the user or by the owners of notes shared with them,
+    # each resolved through the unique (user_id, name) index
+    owners = union(
+        select(literal(user_id)),
+        select(Note.user_id).where(Note.id.in_(permissions.shared_note_ids(user_id)))
+    )
+    return db.session.query(Tag.id).filter(Tag.user_id.in_(owners), Tag.name.in_(names))
+
+
+def filter_notes(query, user_id, names, mode='all'):
+    names = normalize(names)
+    if not names:
+        return query
+
+    tagged = db.session.query(NoteTag.note_id)\
+                       .filter(NoteTag.tag_id.in_(visible_tag_ids(user_id, names)))
+    if mode == 'all' and len(names) > 1:
+        tagged = tagged.join(Tag, Tag.id == NoteTag.tag_id)\
+                       .group_by(NoteTag.note_id)\
+                       .having(func.count(func.distinct(Tag.name)) == len(names))
+    return query.filter(Note.id.in_(tagged))
+
+
+def facets(user_id):
+    # Per-tag note counts over owned and shared notes in one grouped query
+    accessible = permissions.accessible_note_ids(user_id)
+    rows = db.session.query(Tag.name, func.count(func.distinct(NoteTag.note_id)))\
+                     .join(NoteTag, NoteTag.tag_id == Tag.id)\
+                     .filter(NoteTag.note_id.in_(accessible))\
+                     .group_by(Tag.name)\
+                     .order_by(func.count(func.distinct(NoteTag.note_id)).desc(), Tag.name)\
+                     .all()
+    return [{'name': name, 'count': count} for name, count in rows]
+
+
+def backfill(batch_size=500):
+    last_id = 0
+    while True:
+        notes = Note.query.filter(Note.id > last_id, Note.tags.isnot(None))\
+                          .order_by(Note.id).limit(batch_size).all()
+        if not notes:
+            break
+        for note in notes:
+            set_note_tags(note, note.tags)
+        db.session.commit()
+        last_id = notes[-1].id
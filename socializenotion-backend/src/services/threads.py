@@ -0,0 +1,70 @@
+from src.models.user import db, Comment
+from sqlalchemy import func
+from sqlalchemy.orm import aliased, joinedload
+
+# Each path segment is a comment id in fixed-width base36, so lexical order of
+# paths is depth-first thread order with siblings oldest first.
+SEGMENT_WIDTH = 8
+MAX_DEPTH = Comment.path.type.length // SEGMENT_WIDTH - 1
+DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+def path_segment(comment_id):
+    segment = ''
+    while comment_id:
+        comment_id, digit = divmod(comment_id, 36)
+        segment = DIGITS[digit] + segment
+    return segment.rjust(SEGMENT_WIDTH, '0')
+
+
+def comment_path(comment):
+    # Rows written before threading existed have no path; they are roots
+    return comment.path or path_segment(comment.id)
+
+
+def place_comment(comment, parent=None):
+    # Fill the thread columns of a flushed comment and bump the parent's reply counter
+    if parent is None:
+        comment.root_id = comment.id
+        comment.path = path_segment(comment.id)
+        comment.depth = 0
+        return
+
+    comment.root_id = parent.root_id or parent.id
+    comment.path = comment_path(parent) + path_segment(comment.id)
+    comment.depth = (parent.depth or 0) + 1
+    Comment.query.filter_by(id=parent.id).update({Comment.reply_count: Comment.reply_count + 1})
+
+
+def subtree(comment, limit, options=None):
+    # All descendants of `comment` in thread order, using ix_comment_root_path
+    prefix = comment_path(comment)
+    return Comment.query.options(*(options or [joinedload(Comment.author)]))\
+                        .filter(Comment.root_id == (comment.root_id or comment.id))\
+                        .filter(Comment.path > prefix, Comment.path < prefix + '~')\
+                        .order_by(Comment.path)\
+                        .limit(limit)\
+                        .all()
+
+
+def top_replies(root_ids, per_root):
+    # The first `per_root` replies (thread order) under each root, in one query
+    if not root_ids or per_root <= 0:
+        return {}
+
+    ranked = db.session.query(
+        Comment,
+        func.row_number().over(partition_by=Comment.root_id, order_by=Comment.path).label('rank')
+    ).filter(Comment.root_id.in_(root_ids), Comment.parent_id.isnot(None)).subquery()
+
+    reply = aliased(Comment, ranked)
+    replies = db.session.query(reply)\
+                        .options(joinedload(reply.author))\
+                        .filter(ranked.c.rank <= per_root)\
+                        .order_by(reply.root_id, reply.path)\
+                        .all()
+
+    by_root = {root_id: [] for root_id in root_ids}
+    for comment in replies:
+        by_root[comment.root_id].append(comment)
+    return by_root
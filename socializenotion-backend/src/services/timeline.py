@@ -0,0 +1,126 @@
+from src.models.user import db, User, Post, Follow, FeedEntry
+from sqlalchemy import select, insert, update, literal, func, union
+
+# Posts by authors with more followers than this are not fanned out on write; they
+# are pulled into each follower's timeline at read time instead. The decision is
+# stored on the post (Post.fanned_out), so a post stays pulled, or fanned out, when
+# its author's follower count later crosses the limit.
+FANOUT_FOLLOWER_LIMIT = 5000
+
+# How many of a newly followed author's recent posts are copied into the timeline
+BACKFILL_LIMIT = 200
+
+FEED_COLUMNS = ['user_id', 'post_id', 'author_id', 'created_at']
+
+
+def is_high_fanout(user_id):
+    followers = db.session.query(User.followers_count).filter(User.id == user_id).scalar()
+    return (followers or 0) > FANOUT_FOLLOWER_LIMIT
+
+
+def fan_out_post(post):
+    # `post` was created with fanned_out=not is_high_fanout(author); the author
+    # always sees their own posts
+    db.session.add(FeedEntry(
+        user_id=post.user_id,
+        post_id=post.id,
+        author_id=post.user_id,
+        created_at=post.created_at
+    ))
+
+    if not post.fanned_out:
+        return
+
+    followers = select(
+        Follow.follower_id,
+        literal(post.id),
+        literal(post.user_id),
+        literal(post.created_at, db.DateTime)
+    ).where(Follow.following_id == post.user_id)
+
+    db.session.execute(insert(FeedEntry).from_select(FEED_COLUMNS, followers))
+
+
+def backfill_follow(follower_id, followee_id):
+    # Posts that were not fanned out are pulled on read once the follow exists
+    recent = select(
+        literal(follower_id),
+        Post.id,
+        Post.user_id,
+        Post.created_at
+    ).where(Post.user_id == followee_id, Post.fanned_out == db.true())\
+     .order_by(Post.created_at.desc())\
+     .limit(BACKFILL_LIMIT)
+
+    db.session.execute(
+        insert(FeedEntry).prefix_with('OR IGNORE').from_select(FEED_COLUMNS, recent)
+    )
+
+
+def prune_unfollow(follower_id, followee_id):
+    FeedEntry.query.filter_by(user_id=follower_id, author_id=followee_id)\
+                   .delete(synchronize_session=False)
+
+
+def remove_post(post_id):
+    FeedEntry.query.filter_by(post_id=post_id).delete(synchronize_session=False)
+
+
+def pulled_authors(user_id):
+    # Followed authors with posts that were not fanned out and must be pulled on read;
+    # one probe of ix_post_pulled per followee
+    rows = db.session.query(Follow.following_id)\
+                     .filter(Follow.follower_id == user_id)\
+                     .filter(select(Post.id).where(Post.user_id == Follow.following_id,
+                                                   Post.fanned_out == db.false()).exists())\
+                     .all()
+    return [row[0] for row in rows]
+
+
+def timeline_query(user):
+    # Returns a Post query joined to the viewer's timeline and the (created_at, post_id)
+    # columns to order it by. Without pulled posts this is a single range scan over
+    # ix_feed_entry_user_created.
+    entries = select(
+        FeedEntry.post_id.label('post_id'),
+        FeedEntry.created_at.label('created_at')
+    ).where(FeedEntry.user_id == user.id)
+
+    authors = pulled_authors(user.id)
+    if authors:
+        pulled = select(
+            Post.id.label('post_id'),
+            Post.created_at.label('created_at')
+        ).where(Post.user_id.in_(authors), Post.fanned_out == db.false())
+        entries = union(entries, pulled)
+
+    entries = entries.subquery()
+    query = Post.query.join(entries, entries.c.post_id == Post.id)
+    return query, (entries.c.created_at, entries.c.post_id)
+
+
+def rebuild_all():
+    # Offline backfill of every timeline from the follow graph. Every post's fan-out
+    # decision is retaken from its author's current follower count.
+    FeedEntry.query.delete(synchronize_session=False)
+
+    high_fanout = select(User.id).where(User.followers_count > FANOUT_FOLLOWER_LIMIT)
+    db.session.execute(
+        update(Post)
+        .where(Post.fanned_out != Post.user_id.not_in(high_fanout))
+        .values(fanned_out=Post.user_id.not_in(high_fanout), updated_at=Post.updated_at)
+        .execution_options(synchronize_session=False)
+    )
+
+    own_posts = select(Post.user_id, Post.id, Post.user_id, Post.created_at)
+    db.session.execute(insert(FeedEntry).from_select(FEED_COLUMNS, own_posts))
+
+    followed_posts = select(Follow.follower_id, Post.id, Post.user_id, Post.created_at)\
+        .join(Post, Post.user_id == Follow.following_id)\
+        .where(Post.fanned_out == db.true())
+    db.session.execute(
+        insert(FeedEntry).prefix_with('OR IGNORE').from_select(FEED_COLUMNS, followed_posts)
+    )
+
+    db.session.commit()
+    return db.session.query(func.count(FeedEntry.id)).scalar()
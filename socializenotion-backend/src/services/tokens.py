@@ -0,0 +1,161 @@
+import datetime
+import hashlib
+import secrets
+import uuid
+import jwt
+from flask import current_app
+from sqlalchemy import delete, exists, literal, update
+from src.models.user import db, User, RefreshToken
+
+# Access and refresh tokens. Access tokens are HS256 JWTs that live for
+# ACCESS_TOKEN_TTL seconds and carry the user's token_version (`ver`) and their
+# session (`sid`, the refresh token family). Refresh tokens are opaque, stored
+# hashed and single use: presenting one that was already rotated means it leaked,
+# so the whole family is revoked.
+#
+# Revocation never adds a query to a request with a cached principal: logout and
+# password changes drop the user's cached principals, and the next request
+# re-validates `ver` and `sid` against the database once.
+
+# JWT secret key (in production, use environment variable)
+JWT_SECRET = 'your-secret-key-here'
+
+ACCESS_TOKEN_TTL = 15 * 60
+REFRESH_TOKEN_TTL = 30 * 24 * 3600
+
+
+class InvalidRefreshToken(Exception):
+
+    def __init__(self, message, revoked_user_id=None):
+        super().__init__(message)
+        # Set when the failure signed a session out, so cached principals must go
+        self.revoked_user_id = revoked_user_id
+
+
+def _ttl(name, default):
+    return current_app.config.get(name, default)
+
+
+def _digest(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def access_token(user_id, token_version, session_id):
+    return jwt.encode({
+        'user_id': user_id,
+        'ver': token_version or 0,
+        'sid': session_id,
+        'exp': datetime.datetime.utcnow() + datetime.timedelta(seconds=_ttl('ACCESS_TOKEN_TTL', ACCESS_TOKEN_TTL))
+    }, JWT_SECRET, algorithm='HS256')
+
+
+def decode(token):
+    # Raises jwt.InvalidTokenError (or ExpiredSignatureError) for bad tokens
+    return jwt.decode(token, JWT_SECRET, algorithms=['HS256'])
+
+
+def _refresh_token(user_id, family_id):
+    token = secrets.token_urlsafe(32)
+    db.session.add(RefreshToken(
+        user_id=user_id,
+        family_id=family_id,
+        token_hash=_digest(token),
+        expires_at=datetime.datetime.utcnow() + datetime.timedelta(seconds=_ttl('REFRESH_TOKEN_TTL', REFRESH_TOKEN_TTL))
+    ))
+    return token
+
+
+def _response(user_id, token_version, family_id, refresh_token):
+    return {
+        'token': access_token(user_id, token_version, family_id),
+        'refresh_token': refresh_token,
+        'expires_in': _ttl('ACCESS_TOKEN_TTL', ACCESS_TOKEN_TTL),
+    }
+
+
+def start_session(user):
+    # Token fields for a new sign-in; the caller commits
+    family_id = uuid.uuid4().hex
+    return _response(user.id, user.token_version, family_id, _refresh_token(user.id, family_id))
+
+
+def rotate(refresh_token):
+    # Swaps a refresh token for a new pair; returns (user, token fields). The caller
+    # commits, also when InvalidRefreshToken is raised for a reused token.
+    stored = RefreshToken.query.filter_by(token_hash=_digest(refresh_token or '')).first()
+    if stored is None:
+        raise InvalidRefreshToken('Refresh token is invalid')
+    now = datetime.datetime.utcnow()
+    if stored.expires_at <= now:
+        raise InvalidRefreshToken('Refresh token has expired')
+
+    # Conditional update, so of two concurrent refreshes with one token only one wins
+    claimed = db.session.execute(
+        update(RefreshToken)
+        .where(RefreshToken.id == stored.id, RefreshToken.revoked_at.is_(None))
+        .values(revoked_at=now)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not claimed:
+        revoke_session(stored.user_id, stored.family_id)
+        raise InvalidRefreshToken('Refresh token was already used; the session has been signed out',
+                                  revoked_user_id=stored.user_id)
+
+    user = db.session.get(User, stored.user_id)
+    return user, _response(user.id, user.token_version, stored.family_id,
+                           _refresh_token(user.id, stored.family_id))
+
+
+def sign_out(refresh_token, all_sessions=False):
+    # Logout by refresh token: revokes its session, or every session of its user when
+    # the token is still live. Returns the user id, or None for an unknown or expired
+    # token. The caller commits.
+    stored = RefreshToken.query.filter_by(token_hash=_digest(refresh_token or '')).first()
+    if stored is None or stored.expires_at <= datetime.datetime.utcnow():
+        return None
+    if all_sessions and stored.revoked_at is None:
+        revoke_all(db.session.get(User, stored.user_id))
+    else:
+        revoke_session(stored.user_id, stored.family_id)
+    return stored.user_id
+
+
+def revoke_session(user_id, family_id):
+    # Signs one session out: its refresh tokens stop working and so do its access
+    # tokens, once they are next checked against the database
+    db.session.execute(
+        update(RefreshToken)
+        .where(RefreshToken.family_id == family_id, RefreshToken.user_id == user_id,
+               RefreshToken.revoked_at.is_(None))
+        .values(revoked_at=datetime.datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+
+
+def revoke_all(user):
+    # Signs every session out: bumping token_version invalidates all access tokens
+    user.token_version = (user.token_version or 0) + 1
+    db.session.execute(
+        update(RefreshToken)
+        .where(RefreshToken.user_id == user.id, RefreshToken.revoked_at.is_(None))
+        .values(revoked_at=datetime.datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+
+
+def session_active(session_id):
+    # Column expression for token_required's lookup: False once the session is revoked.
+    # Tokens issued before sessions existed have no `sid` and only answer to `ver`.
+    if session_id is None:
+        return literal(True)
+    return exists().where(RefreshToken.family_id == session_id, RefreshToken.revoked_at.is_(None))
+
+
+def prune_expired():
+    # Deletes refresh tokens past their expiry; returns how many went
+    result = db.session.execute(
+        delete(RefreshToken).where(RefreshToken.expires_at <= datetime.datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return result.rowcount
@@ -0,0 +1,150 @@
+import re
+from src.models.user import db, User, Follow
+from src.services.note_search import fts5_supported
+from src.services.viewer import ViewerContext
+from sqlalchemy import text, column, table, func, literal_column
+
+# User search over an FTS5 table keyed by user id, holding the username and bio.
+# Email is never indexed, so searching can't be used to probe addresses. Register
+# and profile updates keep the index in sync inside their own transaction. The
+# prefix index makes one- to three-character prefixes (the as-you-type case) cheap.
+#
+# autocomplete() ranks a bounded candidate set instead of every match: usernames
+# starting with the text come first, then users the viewer follows, then users who
+# follow the viewer, then the most followed.
+
+FTS_TABLE = 'user_fts'
+
+DEFAULT_LIMIT = 8
+MAX_LIMIT = 20
+MAX_CANDIDATES = 200  # token-prefix matches read from the index per request
+POPULAR_POOL = 5000  # most-followed users checked for a prefix when matches are plentiful
+
+user_fts = table(FTS_TABLE, column('rowid'), column('username'), column('bio'))
+_fts_ref = literal_column(FTS_TABLE)
+
+
+def create_index_table():
+    if fts5_supported():
+        db.session.execute(text(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} "
+            f"USING fts5(username, bio, tokenize='unicode61 remove_diacritics 2', prefix='1 2 3')"
+        ))
+
+
+def index_user(user):
+    # Call after the user is flushed, so it has an id
+    if not fts5_supported():
+        return
+    db.session.execute(text(f'DELETE FROM {FTS_TABLE} WHERE rowid = :id'), {'id': user.id})
+    db.session.execute(
+        text(f'INSERT INTO {FTS_TABLE} (rowid, username, bio) VALUES (:id, :username, :bio)'),
+        {'id': user.id, 'username': user.username, 'bio': user.bio or ''}
+    )
+
+
+def rebuild(batch_size=1000):
+    db.session.execute(text(f'DELETE FROM {FTS_TABLE}'))
+    last_id = 0
+    indexed = 0
+    while True:
+        rows = db.session.query(User.id, User.username, User.bio)\
+                         .filter(User.id > last_id).order_by(User.id).limit(batch_size).all()
+        if not rows:
+            break
+        db.session.execute(
+            text(f'INSERT INTO {FTS_TABLE} (rowid, username, bio) VALUES (:id, :username, :bio)'),
+            [{'id': row[0], 'username': row[1], 'bio': row[2] or ''} for row in rows]
+        )
+        db.session.commit()
+        last_id = rows[-1][0]
+        indexed += len(rows)
+    return indexed
+
+
+def match_expression(search, field=None):
+    # Quoted terms so input can't inject FTS5 syntax, the last one a prefix;
+    # `field` limits every term to one column
+    terms = re.findall(r'\w+', search)
+    if not terms:
+        return None
+    scope = f'{field} : ' if field else ''
+    quoted = [f'{scope}"{term}"' for term in terms]
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
+
+def matches(search):
+    # Subquery of (user_id, rank) for users matching `search`; lower rank is better
+    expression = match_expression(search)
+    if expression is None:
+        return None
+    return db.session.query(
+        user_fts.c.rowid.label('user_id'),
+        func.bm25(_fts_ref).label('rank')
+    ).filter(_fts_ref.op('MATCH')(expression)).subquery()
+
+
+def _candidate_ids(viewer_id, search, prefix, limit):
+    ids = set()
+    expression = match_expression(search, 'username')
+    if expression is not None and fts5_supported():
+        rows = db.session.query(user_fts.c.rowid)\
+                         .filter(_fts_ref.op('MATCH')(expression))\
+                         .limit(MAX_CANDIDATES + 1).all()
+        crowded = len(rows) > MAX_CANDIDATES
+        ids.update(row[0] for row in rows[:MAX_CANDIDATES])
+    else:
+        crowded = True
+
+    # Followees whose username starts with the text, wherever they fall in the index
+    rows = db.session.query(Follow.following_id)\
+                     .join(User, User.id == Follow.following_id)\
+                     .filter(Follow.follower_id == viewer_id,
+                             User.username.startswith(prefix, autoescape=True))\
+                     .limit(MAX_CANDIDATES).all()
+    ids.update(row[0] for row in rows)
+
+    if crowded:
+        # Too many matches to read them all: make sure the best-known prefix matches
+        # are in, walking only the top of the followers index
+        popular = db.session.query(User.id, User.username)\
+                            .order_by(User.followers_count.desc())\
+                            .limit(POPULAR_POOL).subquery()
+        rows = db.session.query(popular.c.id)\
+                         .filter(popular.c.username.startswith(prefix, autoescape=True))\
+                         .limit(limit).all()
+        ids.update(row[0] for row in rows)
+
+    ids.discard(viewer_id)
+    return ids
+
+
+def autocomplete(viewer_id, search, limit=DEFAULT_LIMIT):
+    # Up to `limit` lightweight user dicts for a typeahead box
+    prefix = search.strip().lower()
+    if not prefix:
+        return []
+    ids = _candidate_ids(viewer_id, search, prefix, limit)
+    if not ids:
+        return []
+
+    users = db.session.query(User.id, User.username, User.profile_picture_url, User.followers_count)\
+                      .filter(User.id.in_(ids)).all()
+    viewer = ViewerContext(viewer_id)
+    following = viewer.following_ids(ids)
+    followers = viewer.follower_ids(ids)
+
+    def rank(user):
+        name = user.username.lower()
+        match = 0 if name == prefix else 1 if name.startswith(prefix) else 2
+        proximity = 2 if user.id in following else 1 if user.id in followers else 0
+        return (match, -proximity, -user.followers_count, name)
+
+    return [{
+        'id': user.id,
+        'username': user.username,
+        'profile_picture_url': user.profile_picture_url,
+        'followers_count': user.followers_count,
+        'is_following': user.id in following,
+    } for user in sorted(users, key=rank)[:limit]]
@@ -0,0 +1,90 @@
+from src.models.user import db, Like, Follow, User
+from src.services.follow_graph import follow_graph
+from sqlalchemy import func, inspect
+
+
+class ViewerContext:
+    # Answers viewer-relative flags for a whole page of posts or users with one
+    # set-based query per flag type instead of one lookup per row. Follow flags come
+    # from the in-process follow graph when it is enabled.
+
+    def __init__(self, viewer_id):
+        self.viewer_id = viewer_id
+
+    def liked_post_ids(self, post_ids):
+        post_ids = list(set(post_ids))
+        if not post_ids:
+            return set()
+        rows = db.session.query(Like.post_id)\
+                         .filter(Like.user_id == self.viewer_id, Like.post_id.in_(post_ids))\
+                         .all()
+        return {row[0] for row in rows}
+
+    def following_ids(self, user_ids):
+        # Users in `user_ids` the viewer follows
+        user_ids = list(set(user_ids))
+        if not user_ids:
+            return set()
+        if follow_graph.enabled:
+            return follow_graph.following_ids(self.viewer_id, user_ids)
+        rows = db.session.query(Follow.following_id)\
+                         .filter(Follow.follower_id == self.viewer_id, Follow.following_id.in_(user_ids))\
+                         .all()
+        return {row[0] for row in rows}
+
+    def follower_ids(self, user_ids):
+        # Users in `user_ids` who follow the viewer
+        user_ids = list(set(user_ids))
+        if not user_ids:
+            return set()
+        if follow_graph.enabled:
+            return follow_graph.follower_ids(self.viewer_id, user_ids)
+        rows = db.session.query(Follow.follower_id)\
+                         .filter(Follow.following_id == self.viewer_id, Follow.follower_id.in_(user_ids))\
+                         .all()
+        return {row[0] for row in rows}
+
+    def mutual_followers(self, user_id, limit=3):
+        # (count, first `limit` ids) of the viewer's followees who follow `user_id`
+        if follow_graph.enabled:
+            mutual = follow_graph.mutual_followers(self.viewer_id, user_id)
+            return len(mutual), mutual[:limit]
+        followees = db.session.query(Follow.following_id).filter(Follow.follower_id == self.viewer_id)
+        mutual = db.session.query(Follow.follower_id)\
+                           .filter(Follow.following_id == user_id, Follow.follower_id.in_(followees))
+        count = mutual.with_entities(func.count()).scalar()
+        return count, [row[0] for row in mutual.order_by(Follow.follower_id).limit(limit)]
+
+    def authors(self, posts):
+        # Loads the authors of posts whose query didn't eager-load them in one query,
+        # so post.author resolves from the identity map instead of one lazy load each;
+        # keep the returned list alive while the posts are serialized
+        missing = {post.user_id for post in posts if 'author' in inspect(post).unloaded}
+        if not missing:
+            return []
+        return User.query.filter(User.id.in_(missing)).all()
+
+    def post_dicts(self, posts, fields=None):
+        with_liked = fields is None or fields.wants('liked_by_user')
+        liked = self.liked_post_ids(post.id for post in posts) if with_liked else set()
+        authors = self.authors(posts) if fields is None or fields.wants('author') else []
+        posts_data = []
+        for post in posts:
+            post_dict = post.to_dict(fields=fields)
+            if with_liked:
+                post_dict['liked_by_user'] = post.id in liked
+            posts_data.append(post_dict)
+        return posts_data
+
+    def user_dicts(self, users, follows_back=False):
+        user_ids = [user.id for user in users]
+        following = self.following_ids(user_ids)
+        followers = self.follower_ids(user_ids) if follows_back else None
+        users_data = []
+        for user in users:
+            user_dict = user.to_dict()
+            user_dict['is_following'] = user.id in following
+            if followers is not None:
+                user_dict['follows_back'] = user.id in followers
+            users_data.append(user_dict)
+        return users_data
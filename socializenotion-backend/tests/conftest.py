@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.routes.auth import auth_bp
+from src.routes.folders import folders_bp
+from src.routes.notes import notes_bp
+from src.routes.posts import posts_bp
+from src.routes.user import user_bp
+
+
+@pytest.fixture
+def blueprints():
+    # The API as src.main mounts it; the checks build their own scratch apps, so the
+    # tests never import src.main (which migrates the real database)
+    return [
+        (auth_bp, '/api/auth'),
+        (user_bp, '/api'),
+        (posts_bp, '/api'),
+        (notes_bp, '/api'),
+        (folders_bp, '/api'),
+    ]
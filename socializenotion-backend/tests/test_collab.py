@@ -0,0 +1,68 @@
+import pytest
+
+from src.services import collab_check, ot
+
+
+def text(pos, insert=None, delete=None):
+    op = {'op': 'text', 'id': 'b1', 'field': 'text', 'pos': pos}
+    if insert is not None:
+        op['insert'] = insert
+    else:
+        op['delete'] = delete
+    return op
+
+
+def apply_all(value, ops):
+    for op in ops:
+        value = ot.splice(value, op)
+    return value
+
+
+def converge(base, first, second):
+    # `first` is ordered before `second` by the server; both orders of application
+    # must give the same text
+    after_first = apply_all(ot.splice(base, first), ot.transform(second, first, True))
+    after_second = apply_all(ot.splice(base, second), ot.transform(first, second, False))
+    assert after_first == after_second
+    return after_first
+
+
+def test_insert_insert_tie_puts_the_first_insert_first():
+    assert converge('abc', text(1, insert='X'), text(1, insert='Y')) == 'aXYbc'
+    assert ot.transform(text(1, insert='Y'), text(1, insert='X'), True) == [text(2, insert='Y')]
+    assert ot.transform(text(1, insert='X'), text(1, insert='Y'), False) == [text(1, insert='X')]
+
+
+def test_insert_insert_at_different_positions():
+    assert converge('abcdef', text(1, insert='X'), text(4, insert='YY')) == 'aXbcdYYef'
+    assert converge('abcdef', text(5, insert='X'), text(0, insert='YY')) == 'YYabcdeXf'
+
+
+@pytest.mark.parametrize('first, second, expected', [
+    (text(1, delete=3), text(2, delete=3), 'af'),   # overlapping
+    (text(2, delete=3), text(1, delete=3), 'af'),   # overlapping, other way round
+    (text(1, delete=4), text(2, delete=1), 'af'),   # one inside the other
+    (text(2, delete=1), text(1, delete=4), 'af'),
+    (text(1, delete=2), text(1, delete=2), 'adef'),  # identical
+    (text(0, delete=2), text(3, delete=2), 'cf'),   # disjoint
+])
+def test_delete_delete_overlaps_delete_the_union(first, second, expected):
+    assert converge('abcdef', first, second) == expected
+
+
+def test_delete_covered_by_a_concurrent_delete_vanishes():
+    assert ot.transform(text(2, delete=1), text(1, delete=4), True) == []
+
+
+def test_delete_splits_around_a_concurrent_insert():
+    assert ot.transform(text(1, delete=3), text(2, insert='XY'), True) == [
+        text(1, delete=1), text(3, delete=2)
+    ]
+    assert converge('abcdef', text(2, insert='XY'), text(1, delete=3)) == 'aXYef'
+
+
+def test_simulated_editors_converge(blueprints):
+    results = collab_check.check(blueprints, runs=5, editors=3, steps=150, seed=0)
+
+    assert [error for _, _, error in results if error] == []
+    assert all(version for _, version, _ in results)
@@ -0,0 +1,9 @@
+from src.services import query_plans
+
+
+def test_get_routes_avoid_full_scans_of_large_tables(blueprints):
+    plans, violations, failures = query_plans.check(blueprints)
+
+    assert plans
+    assert failures == []
+    assert [(route, detail) for route, detail, _ in violations] == []
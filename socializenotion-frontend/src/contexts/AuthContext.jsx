@@ -52,6 +52,7 @@ export const AuthProvider = ({ children }) => {
       setToken(newToken);
       setUser(userData);
       localStorage.setItem('token', newToken);
+      localStorage.setItem('refreshToken', response.data.refresh_token);
       localStorage.setItem('user', JSON.stringify(userData));
       
       return { success: true, user: userData };
@@ -71,6 +72,7 @@ export const AuthProvider = ({ children }) => {
       setToken(newToken);
       setUser(newUser);
       localStorage.setItem('token', newToken);
+      localStorage.setItem('refreshToken', response.data.refresh_token);
       localStorage.setItem('user', JSON.stringify(newUser));
       
       return { success: true, user: newUser };
@@ -83,9 +85,15 @@ export const AuthProvider = ({ children }) => {
   };
 
   const logout = () => {
+    // Revoke the session server-side; signing out locally doesn't wait for it
+    const refreshToken = localStorage.getItem('refreshToken');
+    if (refreshToken) {
+      authAPI.logout(refreshToken).catch(() => {});
+    }
     setToken(null);
     setUser(null);
     localStorage.removeItem('token');
+    localStorage.removeItem('refreshToken');
     localStorage.removeItem('user');
   };
 
@@ -19,15 +19,69 @@ api.interceptors.request.use((config) => {
   return config;
 });
 
+const clearAuth = () => {
+  localStorage.removeItem('token');
+  localStorage.removeItem('refreshToken');
+  localStorage.removeItem('user');
+};
+
+// Endpoints whose 401s mean bad credentials rather than an expired access token
+const SIGN_IN_ENDPOINTS = ['/auth/login', '/auth/register', '/auth/refresh', '/auth/logout'];
+
+// Access tokens are short-lived and each refresh token can be used only once
+// (the server signs the session out if one is reused). Within a tab, one refresh
+// is shared by every request that fails while it is in flight; across tabs, which
+// share localStorage, refreshes take turns under a Web Lock and a tab that finds
+// the stored token already replaced uses that instead of refreshing again.
+let refreshing = null;
+
+const withRefreshLock = (task) => (
+  navigator.locks ? navigator.locks.request('socialize-auth-refresh', task) : task()
+);
+
+const refreshAccessToken = (failedToken) => {
+  if (!refreshing) {
+    refreshing = withRefreshLock(async () => {
+      const currentToken = localStorage.getItem('token');
+      if (currentToken && currentToken !== failedToken) {
+        return currentToken;
+      }
+      const refreshToken = localStorage.getItem('refreshToken');
+      if (!refreshToken) {
+        throw new Error('No refresh token');
+      }
+      const response = await axios.post(`${API_BASE_URL}/auth/refresh`, { refresh_token: refreshToken });
+      localStorage.setItem('token', response.data.token);
+      localStorage.setItem('refreshToken', response.data.refresh_token);
+      return response.data.token;
+    }).finally(() => {
+      refreshing = null;
+    });
+  }
+  return refreshing;
+};
+
 // Handle auth errors
 api.interceptors.response.use(
   (response) => response,
-  (error) => {
-    if (error.response?.status === 401) {
-      localStorage.removeItem('token');
-      localStorage.removeItem('user');
-      window.location.href = '/login';
+  async (error) => {
+    const request = error.config;
+    if (error.response?.status !== 401 || !request || SIGN_IN_ENDPOINTS.includes(request.url)) {
+      return Promise.reject(error);
+    }
+    if (!request._retried) {
+      request._retried = true;
+      try {
+        const failedToken = request.headers.Authorization?.replace('Bearer ', '');
+        const token = await refreshAccessToken(failedToken);
+        request.headers.Authorization = `Bearer ${token}`;
+        return api(request);
+      } catch (refreshError) {
+        // Fall through to signing out
+      }
     }
+    clearAuth();
+    window.location.href = '/login';
     return Promise.reject(error);
   }
 );
@@ -38,7 +92,10 @@ export const authAPI = {
   login: (credentials) => api.post('/auth/login', credentials),
   getProfile: () => api.get('/auth/profile'),
   updateProfile: (userData) => api.put('/auth/profile', userData),
-  logout: () => api.post('/auth/logout'),
+  // Takes the refresh token explicitly, since the caller clears it from storage right
+  // away; it signs the session out even after the access token has expired
+  logout: (refreshToken) => api.post('/auth/logout', { refresh_token: refreshToken }),
+  changePassword: (passwords) => api.put('/auth/password', passwords),
 };
 
 // Users API
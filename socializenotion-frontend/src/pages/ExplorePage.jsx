@@ -355,8 +355,6 @@ const UserCard = ({ user, onFollow, onUnfollow }) => {
               </Button>
             </div>
             
-            <p className="text-sm text-gray-600">{user.email}</p>
-            
             {user.bio && (
               <p className="text-sm text-gray-700 mt-2">{user.bio}</p>
             )}
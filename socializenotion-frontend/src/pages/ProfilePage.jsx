@@ -66,7 +66,7 @@ const ProfilePage = () => {
               <div className="flex flex-col sm:flex-row sm:items-center sm:justify-between">
                 <div>
                   <h1 className="text-2xl font-bold text-gray-900">{profile?.username}</h1>
-                  <p className="text-gray-600">{profile?.email}</p>
+                  {profile?.email && <p className="text-gray-600">{profile.email}</p>}
                 </div>
                 <Button className="mt-2 sm:mt-0">
                   <Edit3 className="w-4 h-4 mr-2" />